@@ -5,7 +5,6 @@ from configparser import ConfigParser
 import db
 
 from pydicom import dcmread
-from sqlalchemy.orm import sessionmaker
 
 
 from pydicom.uid import (
@@ -22,6 +21,10 @@ from pynetdicom import (
 )
 
 from handlers import handle_find, handle_echo, handle_create, handle_set
+from registry import SessionRegistry
+import slowlog
+import tracing
+import worklist
 
 # from pynetdicom.apps.common import setup_logging
 from pynetdicom.sop_class import (
@@ -97,7 +100,116 @@ def _setup_argparser():
         type=str,
         default="app/data/CTImageStorage.dcm"  # Default value set to "data/"
     )
+    db_opts.add_argument(
+        "--worklist-location",
+        metavar="[d]irectory",
+        help="add the worklist items in the DICOM files in directory d",
+        type=str,
+    )
+    db_opts.add_argument(
+        "--pool-size",
+        metavar="[n]umber",
+        help="number of pooled database connections (default: 5)",
+        type=int,
+        default=5,
+    )
+    db_opts.add_argument(
+        "--pool-max-overflow",
+        metavar="[n]umber",
+        help=(
+            "number of connections allowed above the pool size when the "
+            "pool is exhausted (default: 10)"
+        ),
+        type=int,
+        default=10,
+    )
+    db_opts.add_argument(
+        "--pool-timeout",
+        metavar="[s]econds",
+        help="timeout waiting for a pooled connection (default: 30 s)",
+        type=float,
+        default=30,
+    )
+    db_opts.add_argument(
+        "--no-pool-pre-ping",
+        help="don't test pooled connections for liveness on checkout",
+        action="store_true",
+    )
+    db_opts.add_argument(
+        "--result-cache-size",
+        metavar="[n]umber",
+        help=(
+            "number of C-FIND results to cache, 0 to disable (default: 0). "
+            "Writes by other processes, such as indexer.py, aren't seen until "
+            "a result expires, so only enable it if this is the only writer"
+        ),
+        type=int,
+        default=0,
+    )
+    db_opts.add_argument(
+        "--result-cache-ttl",
+        metavar="[s]econds",
+        help="time a cached C-FIND result is valid for (default: 30 s)",
+        type=float,
+        default=30,
+    )
+    db_opts.add_argument(
+        "--database-profile",
+        help="the SQLite performance profile (default: default)",
+        choices=list(db.SQLITE_PROFILES),
+        default="default",
+    )
+    db_opts.add_argument(
+        "--database-backend",
+        help=(
+            "search the database directly or a copy of it loaded into memory "
+            "(default: sqlite)"
+        ),
+        choices=["sqlite", "memory"],
+        default="sqlite",
+    )
+    db_opts.add_argument(
+        "--sqlite-pragma",
+        metavar="NAME=VALUE",
+        help="a SQLite PRAGMA to apply to every connection, overrides the profile",
+        action="append",
+        default=[],
+    )
+
+    trace_opts = parser.add_argument_group("Tracing")
+    trace_opts.add_argument(
+        "--trace",
+        help="time the phases of each C-FIND, N-CREATE and N-SET request",
+        action="store_true",
+    )
+    trace_opts.add_argument(
+        "--trace-interval",
+        metavar="[s]econds",
+        help="how often to print the request latency histograms (default: 60 s)",
+        type=float,
+        default=60,
+    )
     
+    slow_opts = parser.add_argument_group("Slow Query Log")
+    slow_opts.add_argument(
+        "--slow-query-threshold",
+        metavar="[m]illiseconds",
+        help="log C-FIND queries that take longer than this (default: disabled)",
+        type=float,
+    )
+    slow_opts.add_argument(
+        "--slow-query-log",
+        metavar="[f]ile",
+        help="also write the slow queries to this rotating log file",
+        type=str,
+    )
+    slow_opts.add_argument(
+        "--slow-query-port",
+        metavar="[p]ort",
+        help="serve the most recent slow queries as JSON over HTTP on this port",
+        type=int,
+    )
+
     return parser.parse_args()
     
 def main(args=None):
@@ -111,6 +223,7 @@ def main(args=None):
     print(f"Network timeout: {args.network_timeout} seconds")
     print(f"Bind address: {args.bind_address}")
     print(f"Database location: {args.database_location}")
+    print(f"Database profile: {args.database_profile}")
     print(f"Network timeout: {args.network_timeout}")
 
     # Use default or specified configuration file
@@ -121,13 +234,45 @@ def main(args=None):
     # The path to the database
     db_path = f"sqlite:///{db_path}"
     print(db_path)
-    engine = db.create(db_path)
-    session = sessionmaker(bind=engine)()
+    registry = SessionRegistry(
+        db_path,
+        pool_size=args.pool_size,
+        max_overflow=args.pool_max_overflow,
+        pool_timeout=args.pool_timeout,
+        pre_ping=not args.no_pool_pre_ping,
+        profile=args.database_profile,
+        pragmas=dict(pragma.split("=", 1) for pragma in args.sqlite_pragma),
+        backend=args.database_backend,
+    )
+    db.configure_result_cache(args.result_cache_size, ttl=args.result_cache_ttl)
+    tracing.configure(args.trace)
+    if args.trace:
+        tracing.start_reporter(args.trace_interval)
+
+    if args.slow_query_threshold is not None:
+        slowlog.configure(
+            args.slow_query_threshold / 1000, filename=args.slow_query_log
+        )
+        print(f"Slow query threshold: {args.slow_query_threshold} ms")
+        if args.slow_query_port:
+            slowlog.serve(args.bind_address, args.slow_query_port)
+            print(f"Slow queries served on port {args.slow_query_port}")
 
     # Add or update instance to the database
     ds = dcmread("app/data/CTImageStorage.dcm")
-    db.add_instance(ds, session)
-    session.close()
+    with registry.session() as session:
+        registry.backend.add_instance(ds, session)
+
+    # Add or update the worklist items
+    if args.worklist_location:
+        items = (
+            dcmread(os.path.join(args.worklist_location, fname), force=True)
+            for fname in sorted(os.listdir(args.worklist_location))
+        )
+        with registry.session() as session:
+            nr_steps = worklist.add_items(items, session)
+
+        print(f"Added {nr_steps} scheduled procedure steps to the worklist")
 
     # Try to create the instance storage directory
     os.makedirs(instance_dir, exist_ok=True)
@@ -147,7 +292,8 @@ def main(args=None):
 
     handlers = [
         (evt.EVT_N_CREATE, handle_create),
-        (evt.EVT_C_FIND, handle_find, [db_path, args]),
+        (evt.EVT_N_SET, handle_set),
+        (evt.EVT_C_FIND, handle_find, [registry, args]),
         (evt.EVT_C_ECHO, handle_echo)
     ]
     
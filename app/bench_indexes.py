@@ -0,0 +1,187 @@
+"""Benchmark C-FIND latency with and without the database indexes.
+
+Creates a synthetic database, times a set of Patient Root and Study Root
+queries against it without any secondary indexes, then adds the indexes with
+``db.migrate()`` and times the same queries again::
+
+    python app/bench_indexes.py --instances 1000000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from pydicom.dataset import Dataset
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind,
+)
+from sqlalchemy.orm import sessionmaker
+
+import db
+
+
+def _setup_argparser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark C-FIND latency with and without indexes"
+    )
+    parser.add_argument(
+        "--instances",
+        metavar="[n]umber",
+        help="number of instances in the synthetic database (default: 1000000)",
+        type=int,
+        default=1_000_000,
+    )
+    parser.add_argument(
+        "--repeat",
+        metavar="[n]umber",
+        help="number of times to run each query (default: 5)",
+        type=int,
+        default=5,
+    )
+
+    return parser.parse_args()
+
+
+def _rows(nr_instances):
+    """Yield synthetic instance rows, 200 instances per patient."""
+    for ii in range(nr_instances):
+        patient, study, series = ii // 200, ii // 50, ii // 10
+        yield {
+            "patient_id": f"PID{patient:07d}",
+            "patient_name": f"PATIENT^{patient:07d}",
+            "study_instance_uid": f"1.2.826.0.1.3680043.1.{study}",
+            "study_date": f"2020{(study % 12) + 1:02d}{(study % 28) + 1:02d}",
+            "study_time": f"{study % 24:02d}0000",
+            "accession_number": f"ACC{study:08d}",
+            "study_id": f"{study % 1000}",
+            "series_instance_uid": f"1.2.826.0.1.3680043.2.{series}",
+            "modality": ("CT", "MR", "US", "CR")[series % 4],
+            "series_number": f"{series % 10}",
+            "sop_instance_uid": f"1.2.826.0.1.3680043.3.{ii}",
+            "instance_number": f"{ii % 10}",
+        }
+
+
+def _populate(engine, nr_instances, chunk_size=50_000):
+    table = db.Instance.__table__
+    rows = _rows(nr_instances)
+    with engine.begin() as conn:
+        while True:
+            chunk = [row for _, row in zip(range(chunk_size), rows)]
+            if not chunk:
+                break
+
+            conn.execute(table.insert(), chunk)
+
+    db.populate_hierarchy(engine)
+
+
+def _queries(nr_instances):
+    """Return a list of (description, model, identifier) to benchmark."""
+    patient = (nr_instances // 2) // 200
+    study = (nr_instances // 2) // 50
+    series = (nr_instances // 2) // 10
+
+    def identifier(level, **kwargs):
+        ds = Dataset()
+        ds.QueryRetrieveLevel = level
+        for kw, value in kwargs.items():
+            setattr(ds, kw, value)
+
+        return ds
+
+    return [
+        (
+            "patient root PATIENT PatientID",
+            PatientRootQueryRetrieveInformationModelFind,
+            identifier("PATIENT", PatientID=f"PID{patient:07d}"),
+        ),
+        (
+            "patient root STUDY PatientID/StudyInstanceUID",
+            PatientRootQueryRetrieveInformationModelFind,
+            identifier(
+                "STUDY",
+                PatientID=f"PID{patient:07d}",
+                StudyInstanceUID=f"1.2.826.0.1.3680043.1.{study}",
+            ),
+        ),
+        (
+            "study root SERIES StudyInstanceUID/SeriesInstanceUID",
+            StudyRootQueryRetrieveInformationModelFind,
+            identifier(
+                "SERIES",
+                StudyInstanceUID=f"1.2.826.0.1.3680043.1.{study}",
+                SeriesInstanceUID=f"1.2.826.0.1.3680043.2.{series}",
+            ),
+        ),
+        (
+            "study root STUDY AccessionNumber",
+            StudyRootQueryRetrieveInformationModelFind,
+            identifier("STUDY", AccessionNumber=f"ACC{study:08d}"),
+        ),
+        (
+            "study root STUDY StudyDate range",
+            StudyRootQueryRetrieveInformationModelFind,
+            identifier("STUDY", StudyDate="20200101-20200102"),
+        ),
+        (
+            "patient root PATIENT PatientName",
+            PatientRootQueryRetrieveInformationModelFind,
+            identifier("PATIENT", PatientName=f"PATIENT^{patient:07d}"),
+        ),
+    ]
+
+
+def _run(session, queries, repeat):
+    results = {}
+    for desc, model, identifier in queries:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            matches = db.search(model, Dataset(identifier), session)
+            timings.append(time.perf_counter() - start)
+
+        results[desc] = (min(timings), len(matches))
+
+    return results
+
+
+def main():
+    args = _setup_argparser()
+
+    with tempfile.TemporaryDirectory() as tdir:
+        engine = db.create(f"sqlite:///{os.path.join(tdir, 'bench.sqlite')}")
+        for table in db.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(engine)
+
+        print(f"Populating database with {args.instances} instances...")
+        _populate(engine, args.instances)
+        session = sessionmaker(bind=engine)()
+        queries = _queries(args.instances)
+
+        without = _run(session, queries, args.repeat)
+        session.close()
+
+        print("Creating indexes...")
+        db.migrate(engine)
+        session = sessionmaker(bind=engine)()
+        with_idx = _run(session, queries, args.repeat)
+        session.close()
+        engine.dispose()
+
+    print()
+    print(f"{'query':<55} {'matches':>8} {'no index':>11} {'indexed':>11}")
+    for desc, _, _ in queries:
+        t_without, nr_matches = without[desc]
+        t_with, _ = with_idx[desc]
+        print(
+            f"{desc:<55} {nr_matches:>8} "
+            f"{t_without * 1000:>9.2f}ms {t_with * 1000:>9.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Benchmark the SQLite performance profiles under a concurrent workload.
+
+For each profile in ``db.SQLITE_PROFILES`` a synthetic database is created
+and for a fixed duration a number of reader threads run C-FIND queries with
+``db.iter_identifiers()`` while a writer thread adds new instances with
+``db.add_instances()``, as happens when the SCP is queried during a
+C-STORE or while ``indexer.py`` is running::
+
+    python app/bench_profiles.py --instances 100000 --readers 4
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from pydicom.dataset import Dataset
+from pynetdicom.sop_class import PatientRootQueryRetrieveInformationModelFind
+from sqlalchemy.exc import OperationalError
+
+from bench_indexes import _populate, _rows
+import db
+from registry import SessionRegistry
+
+
+def _setup_argparser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the SQLite performance profiles"
+    )
+    parser.add_argument(
+        "--instances",
+        metavar="[n]umber",
+        help="number of instances in the synthetic database (default: 100000)",
+        type=int,
+        default=100_000,
+    )
+    parser.add_argument(
+        "--readers",
+        metavar="[n]umber",
+        help="number of concurrent C-FIND threads (default: 4)",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        metavar="[n]umber",
+        help="number of instances written per transaction (default: 500)",
+        type=int,
+        default=500,
+    )
+    parser.add_argument(
+        "--duration",
+        metavar="[s]econds",
+        help="how long to run each profile for (default: 10 s)",
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        "--profile",
+        help="only benchmark the given profiles (default: all)",
+        choices=list(db.SQLITE_PROFILES),
+        action="append",
+    )
+
+    return parser.parse_args()
+
+
+def _identifiers(nr_instances):
+    """Yield the C-FIND request Identifiers to run, cycling over patients."""
+    nr_patients = max(nr_instances // 200, 1)
+    ii = 0
+    while True:
+        ds = Dataset()
+        ds.QueryRetrieveLevel = "STUDY"
+        ds.PatientID = f"PID{ii % nr_patients:07d}"
+        ds.StudyInstanceUID = ""
+        ds.StudyDate = ""
+        ds.AccessionNumber = ""
+        yield ds
+
+        ds = Dataset()
+        ds.QueryRetrieveLevel = "PATIENT"
+        ds.PatientName = f"PATIENT^{ii % nr_patients:03d}*"
+        ds.PatientID = ""
+        yield ds
+
+        ii += 7
+
+
+def _datasets(rows):
+    """Yield the synthetic instance `rows` as datasets for add_instances()."""
+    for row in rows:
+        ds = Dataset()
+        for attr, keyword, _, _ in db._REQUIRED:
+            setattr(ds, keyword, row[attr])
+
+        yield ds
+
+
+class _Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+
+    def add(self, count=0, errors=0):
+        with self._lock:
+            self.count += count
+            self.errors += errors
+
+
+def _reader(registry, nr_instances, stop, counter):
+    model = PatientRootQueryRetrieveInformationModelFind
+    for identifier in _identifiers(nr_instances):
+        if stop.is_set():
+            return
+
+        try:
+            with registry.session() as session:
+                for _ in db.iter_identifiers(model, identifier, session):
+                    pass
+        except OperationalError:
+            # 'database is locked'
+            counter.add(errors=1)
+        else:
+            counter.add(count=1)
+
+
+def _writer(registry, start, chunk_size, stop, counter):
+    # Rows that aren't already in the database
+    rows = _rows(start + 10_000_000)
+    for _ in range(start):
+        next(rows)
+
+    datasets = _datasets(rows)
+    while not stop.is_set():
+        chunk = [ds for _, ds in zip(range(chunk_size), datasets)]
+        try:
+            with registry.session() as session:
+                counter.add(count=db.add_instances(chunk, session, chunk_size))
+        except OperationalError:
+            counter.add(errors=1)
+
+
+def _run(profile, args, tdir):
+    """Return the query and ingest results for `profile`."""
+    path = os.path.join(tdir, f"{profile}.sqlite")
+    registry = SessionRegistry(
+        f"sqlite:///{path}", pool_size=args.readers + 1, profile=profile
+    )
+    _populate(registry.engine, args.instances)
+
+    stop = threading.Event()
+    queries, ingest = _Counter(), _Counter()
+    threads = [
+        threading.Thread(
+            target=_reader, args=(registry, args.instances, stop, queries)
+        )
+        for _ in range(args.readers)
+    ]
+    threads.append(
+        threading.Thread(
+            target=_writer,
+            args=(registry, args.instances, args.chunk_size, stop, ingest),
+        )
+    )
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+    registry.dispose()
+
+    return queries, ingest, elapsed
+
+
+def main():
+    args = _setup_argparser()
+
+    print(
+        f"{'profile':<10} {'queries/s':>10} {'instances/s':>12} "
+        f"{'query errors':>13} {'write errors':>13}"
+    )
+    with tempfile.TemporaryDirectory() as tdir:
+        for profile in args.profile or db.SQLITE_PROFILES:
+            queries, ingest, elapsed = _run(profile, args, tdir)
+            print(
+                f"{profile:<10} {queries.count / elapsed:>10.1f} "
+                f"{ingest.count / elapsed:>12.1f} "
+                f"{queries.errors:>13} {ingest.errors:>13}"
+            )
+
+
+if __name__ == "__main__":
+    main()
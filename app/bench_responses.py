@@ -0,0 +1,158 @@
+"""Benchmark building the C-FIND response Identifiers.
+
+Creates a synthetic database and times building the responses for queries
+with large result sets, first by loading each match as a record and calling
+``as_identifier()``, then with ``db.iter_identifiers()``, which only selects
+the returned columns and fills each response from a template::
+
+    python app/bench_responses.py --instances 200000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from pydicom.dataset import Dataset
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind,
+)
+from sqlalchemy.orm import sessionmaker
+
+from bench_indexes import _populate
+import db
+
+
+def _setup_argparser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark building the C-FIND response Identifiers"
+    )
+    parser.add_argument(
+        "--instances",
+        metavar="[n]umber",
+        help="number of instances in the synthetic database (default: 200000)",
+        type=int,
+        default=200_000,
+    )
+    parser.add_argument(
+        "--repeat",
+        metavar="[n]umber",
+        help="number of times to run each query (default: 3)",
+        type=int,
+        default=3,
+    )
+
+    return parser.parse_args()
+
+
+def _queries():
+    """Return a list of (description, model, identifier) to benchmark."""
+
+    def identifier(level, **kwargs):
+        ds = Dataset()
+        ds.QueryRetrieveLevel = level
+        for kw, value in kwargs.items():
+            setattr(ds, kw, value)
+
+        return ds
+
+    return [
+        (
+            "patient root PATIENT all",
+            PatientRootQueryRetrieveInformationModelFind,
+            identifier("PATIENT", PatientID="", PatientName=""),
+        ),
+        (
+            "study root STUDY all",
+            StudyRootQueryRetrieveInformationModelFind,
+            identifier(
+                "STUDY",
+                StudyInstanceUID="",
+                StudyDate="",
+                StudyTime="",
+                AccessionNumber="",
+                PatientID="",
+                PatientName="",
+            ),
+        ),
+        (
+            "study root SERIES modality CT",
+            StudyRootQueryRetrieveInformationModelFind,
+            identifier(
+                "SERIES",
+                StudyInstanceUID="",
+                SeriesInstanceUID="",
+                Modality="CT",
+                SeriesNumber="",
+            ),
+        ),
+    ]
+
+
+def _records(session, model, identifier):
+    """Return the responses built from the matching records."""
+    responses = []
+    for match in db.iter_search(model, identifier, session):
+        response = match.as_identifier(identifier, model)
+        response.RetrieveAETitle = "QRSCP"
+        responses.append(response)
+
+    return responses
+
+
+def _projection(session, model, identifier):
+    """Return the responses built from the selected columns."""
+    return list(
+        db.iter_identifiers(model, identifier, session, RetrieveAETitle="QRSCP")
+    )
+
+
+def _time(func, factory, model, identifier, repeat):
+    timings = []
+    for _ in range(repeat):
+        # Use a new session each time so the records from previous runs
+        #   aren't kept in its identity map
+        with factory() as session:
+            start = time.perf_counter()
+            responses = func(session, model, Dataset(identifier))
+            timings.append(time.perf_counter() - start)
+
+    return min(timings), responses
+
+
+def main():
+    args = _setup_argparser()
+
+    with tempfile.TemporaryDirectory() as tdir:
+        engine = db.create(f"sqlite:///{os.path.join(tdir, 'bench.sqlite')}")
+        print(f"Populating database with {args.instances} instances...")
+        _populate(engine, args.instances)
+        factory = sessionmaker(bind=engine)
+
+        print()
+        print(
+            f"{'query':<35} {'matches':>8} {'records':>11} {'projection':>11} "
+            f"{'speedup':>8}"
+        )
+        for desc, model, identifier in _queries():
+            t_records, expected = _time(
+                _records, factory, model, identifier, args.repeat
+            )
+            t_projection, responses = _time(
+                _projection, factory, model, identifier, args.repeat
+            )
+            # The responses should be identical, in the same order
+            assert responses == expected
+
+            print(
+                f"{desc:<35} {len(responses):>8} "
+                f"{t_records * 1000:>9.1f}ms {t_projection * 1000:>9.1f}ms "
+                f"{t_records / t_projection:>7.1f}x"
+            )
+
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
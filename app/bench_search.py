@@ -0,0 +1,351 @@
+"""Benchmark suite for the query engine.
+
+Runs every type of matching at every Query Retrieve Level of the Patient
+Root and Study Root C-FIND information models against a synthetic archive
+from ``synthetic.py``, and writes the results as JSON so they can be
+compared between releases::
+
+    python app/synthetic.py --size 1m --database-location synthetic.sqlite
+    python app/bench_search.py --database-location synthetic.sqlite \\
+        --output results.json
+
+If no database is given a temporary archive of ``--size`` is generated.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from pydicom.dataset import Dataset
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind,
+)
+import sqlalchemy
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+import db
+from memindex import ColumnarIndex
+import synthetic
+
+
+_ROOTS = {
+    "patient": PatientRootQueryRetrieveInformationModelFind,
+    "study": StudyRootQueryRetrieveInformationModelFind,
+}
+
+
+def _setup_argparser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the query engine against a synthetic archive"
+    )
+    parser.add_argument(
+        "--database-location",
+        metavar="[f]ile",
+        help="an existing archive from synthetic.py (default: generate one)",
+        type=str,
+    )
+    parser.add_argument(
+        "--size",
+        help="the size of the archive to generate (default: 100k)",
+        choices=list(synthetic.SIZES),
+        default="100k",
+    )
+    parser.add_argument(
+        "--seed",
+        metavar="[n]umber",
+        help="the random seed for the generated archive (default: 0)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--backend",
+        help="the search backend to benchmark (default: sqlite)",
+        choices=["sqlite", "memory"],
+        default="sqlite",
+    )
+    parser.add_argument(
+        "--repeat",
+        metavar="[n]umber",
+        help="number of times to run each query (default: 5)",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--output",
+        metavar="[f]ile",
+        help="write the JSON results to a file instead of stdout",
+        type=str,
+    )
+
+    return parser.parse_args()
+
+
+def _sample(session):
+    """Return the values used to build the queries.
+
+    The values are taken from the instance in the middle of the archive,
+    with up to three of its sibling patients, studies, series and instances
+    for the list of UID matching.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        The session for the archive.
+
+    Returns
+    -------
+    dict
+        The ``db.Instance`` column values of the sampled instance, plus
+        ``"studies"``, ``"series"`` and ``"instances"`` with the UID lists.
+    """
+    nr_instances = session.scalar(select(func.count()).select_from(db.Instance))
+    instance = session.scalars(
+        select(db.Instance).offset(nr_instances // 2).limit(1)
+    ).one()
+    sample = {attr: getattr(instance, attr) for attr in db._TRANSLATION.values()}
+
+    siblings = [
+        ("studies", db.Study.study_instance_uid, db.Study.patient_id, "patient_id"),
+        (
+            "series",
+            db.Series.series_instance_uid,
+            db.Series.study_instance_uid,
+            "study_instance_uid",
+        ),
+        (
+            "instances",
+            db.Instance.sop_instance_uid,
+            db.Instance.series_instance_uid,
+            "series_instance_uid",
+        ),
+    ]
+    for name, column, parent, attr in siblings:
+        statement = select(column).where(parent == sample[attr]).limit(3)
+        sample[name] = list(session.scalars(statement))
+
+    return sample
+
+
+def _cases(sample):
+    """Return the queries to benchmark.
+
+    Parameters
+    ----------
+    sample : dict
+        The sampled values, as from :func:`_sample`.
+
+    Returns
+    -------
+    list of (str, str, str, pydicom.dataset.Dataset)
+        The (root, Query Retrieve Level, matching type, Identifier) for each
+        query. Levels only have the matching types that apply to their keys,
+        there are no DA or TM keys below the STUDY level and no text keys at
+        the IMAGE level.
+    """
+    date = datetime.datetime.strptime(sample["study_date"], "%Y%m%d").date()
+    month_later = (date + datetime.timedelta(days=30)).strftime("%Y%m%d")
+    family = sample["patient_name"].split("^")[0]
+    accession = sample["accession_number"]
+
+    # (matching type, {keyword: value}) at each level
+    level_keys = {
+        "PATIENT": [
+            ("universal", {"PatientName": ""}),
+            ("single", {"PatientID": sample["patient_id"]}),
+            ("single", {"PatientName": sample["patient_name"]}),
+            ("wildcard", {"PatientName": f"{family}^*"}),
+            ("wildcard", {"PatientName": f"*{family[1:4]}*"}),
+        ],
+        "STUDY": [
+            ("universal", {"StudyDate": ""}),
+            ("single", {"AccessionNumber": accession}),
+            ("uid_list", {"StudyInstanceUID": sample["studies"]}),
+            ("wildcard", {"AccessionNumber": f"{accession[:4]}*"}),
+            ("wildcard", {"AccessionNumber": f"*{accession[-4:]}"}),
+            ("range", {"StudyDate": f"{sample['study_date']}-{month_later}"}),
+            ("range", {"StudyDate": f"{sample['study_date']}-"}),
+            (
+                "range",
+                {
+                    "StudyDate": f"{sample['study_date']}-{month_later}",
+                    "StudyTime": "0800-1200",
+                },
+            ),
+        ],
+        "SERIES": [
+            ("universal", {"Modality": ""}),
+            ("single", {"Modality": sample["modality"]}),
+            ("uid_list", {"SeriesInstanceUID": sample["series"]}),
+            ("wildcard", {"Modality": f"{sample['modality'][0]}*"}),
+        ],
+        "IMAGE": [
+            ("universal", {"InstanceNumber": ""}),
+            ("single", {"SOPInstanceUID": sample["sop_instance_uid"]}),
+            ("uid_list", {"SOPInstanceUID": sample["instances"]}),
+        ],
+    }
+    # In the Study Root the PATIENT keys are at the STUDY level
+    study_root_keys = {
+        "STUDY": level_keys["STUDY"] + level_keys["PATIENT"],
+        "SERIES": level_keys["SERIES"],
+        "IMAGE": level_keys["IMAGE"],
+    }
+
+    cases = []
+    for root, keys in (("patient", level_keys), ("study", study_root_keys)):
+        levels = list(keys)
+        for depth, level in enumerate(levels):
+            for matching, values in keys[level]:
+                ds = Dataset()
+                ds.QueryRetrieveLevel = level
+                # The unique keys of the levels above, then the level's own
+                for above in levels[:depth]:
+                    unique = db._PATIENT_ROOT_ATTRIBUTES[above][0]
+                    setattr(ds, unique, sample[db._TRANSLATION[unique]])
+
+                setattr(ds, db._PATIENT_ROOT_ATTRIBUTES[level][0], "")
+                for keyword, value in values.items():
+                    setattr(ds, keyword, value)
+
+                cases.append((root, level, matching, ds))
+
+    return cases
+
+
+def _describe(model, identifier):
+    """Return the keys and the planned matching for each as a :class:`dict`."""
+    _, shape, _ = db._query_shape(model, Dataset(identifier))
+    keys = {}
+    for elem in identifier:
+        if elem.keyword == "QueryRetrieveLevel":
+            continue
+
+        value = elem.value
+        keys[elem.keyword] = list(value) if elem.VM > 1 else str(value)
+
+    return {"keys": keys, "plan": dict(shape)}
+
+
+def _time(backend, session, model, identifier, repeat):
+    """Return the number of matches and the timings for a query, in ms."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        responses = list(
+            backend.iter_identifiers(model, Dataset(identifier), session)
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return len(responses), timings
+
+
+def run(session, backend, repeat=5):
+    """Run the benchmark suite.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        The session for the archive.
+    backend : module or memindex.ColumnarIndex
+        The search backend, either the ``db`` module or an in-memory index
+        loaded from the archive.
+    repeat : int, optional
+        The number of times to run each query (default ``5``).
+
+    Returns
+    -------
+    list of dict
+        The results for each query.
+    """
+    results = []
+    for root, level, matching, identifier in _cases(_sample(session)):
+        model = _ROOTS[root]
+        nr_matches, timings = _time(backend, session, model, identifier, repeat)
+        result = {"root": root, "level": level, "matching": matching}
+        result.update(_describe(model, identifier))
+        result.update(
+            {
+                "matches": nr_matches,
+                "min_ms": round(min(timings), 3),
+                "median_ms": round(statistics.median(timings), 3),
+                "max_ms": round(max(timings), 3),
+            }
+        )
+        results.append(result)
+
+    return results
+
+
+def _environment(session, args):
+    counts = {
+        model.__tablename__: session.scalar(select(func.count()).select_from(model))
+        for model in (db.Patient, db.Study, db.Series, db.Instance)
+    }
+
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "backend": args.backend,
+        "repeat": args.repeat,
+        "archive": counts,
+    }
+
+
+def _benchmark(db_path, args):
+    engine = db.create(f"sqlite:///{db_path}")
+    with sessionmaker(bind=engine)() as session:
+        backend = db
+        if args.backend == "memory":
+            backend = ColumnarIndex()
+            backend.load(session)
+
+        report = {
+            "environment": _environment(session, args),
+            "results": run(session, backend, args.repeat),
+        }
+
+    engine.dispose()
+
+    return report
+
+
+def main():
+    args = _setup_argparser()
+
+    # The result cache would answer the repeated queries
+    db.configure_result_cache(0)
+
+    if args.database_location:
+        report = _benchmark(os.path.abspath(args.database_location), args)
+    else:
+        with tempfile.TemporaryDirectory() as tdir:
+            db_path = os.path.join(tdir, "synthetic.sqlite")
+            print(f"Generating a {args.size} instance archive...", file=sys.stderr)
+            engine = db.create(f"sqlite:///{db_path}")
+            synthetic.populate(engine, synthetic.SIZES[args.size], args.seed)
+            engine.dispose()
+            report = _benchmark(db_path, args)
+            report["environment"]["seed"] = args.seed
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
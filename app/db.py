@@ -18,16 +18,43 @@ Required Keys
 """
 
 from collections import OrderedDict
+import datetime
+from functools import partial
+import re
 import sys
+import threading
+import time
 
 try:
-    from sqlalchemy import create_engine, Column, ForeignKey, Integer, String
+    from sqlalchemy import (
+        and_,
+        bindparam,
+        create_engine,
+        event,
+        exists,
+        func,
+        insert,
+        inspect,
+        literal_column,
+        select,
+        text,
+        Column,
+        ForeignKey,
+        Index,
+        Integer,
+        String,
+    )
 except ImportError:
     sys.exit("qrscp requires the sqlalchemy package")
 
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import contains_eager, declarative_base, relationship
 
+from pydicom import config
+from pydicom.datadict import dictionary_VR
+from pydicom.dataelem import DataElement
 from pydicom.dataset import Dataset
+from pydicom.tag import Tag
 
 from pynetdicom import build_context
 from pynetdicom.sop_class import (
@@ -39,6 +66,9 @@ from pynetdicom.sop_class import (
     StudyRootQueryRetrieveInformationModelGet,
 )
 
+from slowlog import SLOW_QUERIES
+from tracing import NULL_TRACE
+
 
 class InvalidIdentifier(Exception):
     pass
@@ -121,6 +151,62 @@ _STUDY_ROOT_ATTRIBUTES = OrderedDict(
     }
 )
 
+# VRs for Single Value Matching and Wild Card Matching
+_TEXT_VR = ["AE", "CS", "LO", "LT", "PN", "SH", "ST", "UC", "UR", "UT"]
+
+# The typed columns used for matching DA and TM keys, as {keyword: column}
+_TYPED_COLUMNS = {
+    "StudyDate": "study_date_value",
+    "StudyTime": "study_time_value",
+}
+# Date and time keys matched as a combined datetime range, as
+#   {date keyword: (time keyword, datetime column)}
+_DATE_TIME_KEYS = {"StudyDate": ("StudyTime", "study_datetime_value")}
+# The last microsecond of a day, as a TM value
+_END_OF_DAY = 86400 * 1000000 - 1
+
+# The SQLite PRAGMAs applied to every connection for each performance profile
+SQLITE_PROFILES = {
+    # The SQLite defaults: rollback journal, full sync, 2 MiB page cache
+    "default": {},
+    # Write-ahead log so readers don't block the writer, full sync so
+    #   commits survive a power failure
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -16384,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 10000,
+    },
+    # Write-ahead log with commits only synced at checkpoints, they can be
+    #   lost on power failure but the database can't be corrupted
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    # No syncing, for databases that can be rebuilt with indexer.py
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -262144,
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+
+# Trigram indexes used for Wild Card Matching, as {table: [(column, keyword)]}
+_TRIGRAM_INDEXES = {
+    "patient": [("patient_id", "PatientID"), ("patient_name", "PatientName")],
+    "study": [("accession_number", "AccessionNumber"), ("study_id", "StudyID")],
+}
+# The keywords with a trigram index in the current database
+_TRIGRAM_KEYWORDS = set()
+
 # Supported Information Models
 _C_FIND = [
     PatientRootQueryRetrieveInformationModelFind,
@@ -147,6 +233,24 @@ _STUDY_ROOT = {
 }
 
 
+# Unique or Required attributes
+_REQUIRED = [
+    # (Instance attribute, DICOM keyword, max length, req'd)
+    ("patient_id", "PatientID", 64, True),
+    ("patient_name", "PatientName", 64, False),
+    ("study_instance_uid", "StudyInstanceUID", 64, True),
+    ("study_date", "StudyDate", 8, False),
+    ("study_time", "StudyTime", 14, False),
+    ("accession_number", "AccessionNumber", 16, False),
+    ("study_id", "StudyID", 16, False),
+    ("series_instance_uid", "SeriesInstanceUID", 64, True),
+    ("modality", "Modality", 16, False),
+    ("series_number", "SeriesNumber", None, False),
+    ("sop_instance_uid", "SOPInstanceUID", 64, True),
+    ("instance_number", "InstanceNumber", None, False),
+]
+
+
 def add_instance(ds, session, fpath=None):
     """Add a SOP Instance to the database or update existing instance.
 
@@ -160,46 +264,138 @@ def add_instance(ds, session, fpath=None):
         The path to where the SOP Instance is stored, taken relative
         to the database file.
     """
+    values = _instance_values(ds, fpath)
+
     # Check if instance is already in the database
-    result = (
-        session.query(Instance)
-        .filter(Instance.sop_instance_uid == ds.SOPInstanceUID)
-        .all()
-    )
-    # print('check result....')
-    if result:
-        instance = result[0]
-        # print('di if result')
-    else:
-        instance = Instance()
-        # print('else nya if result')
-    
-    print('result.....: ', instance)
-    # Unique or Required attributes
-    required = [
-        # (Instance attribute, DICOM keyword, max length, req'd)
-        ("patient_id", "PatientID", 64, True),
-        ("patient_name", "PatientName", 64, False),
-        ("study_instance_uid", "StudyInstanceUID", 64, True),
-        ("study_date", "StudyDate", 8, False),
-        ("study_time", "StudyTime", 14, False),
-        ("accession_number", "AccessionNumber", 16, False),
-        ("study_id", "StudyID", 16, False),
-        ("series_instance_uid", "SeriesInstanceUID", 64, True),
-        ("modality", "Modality", 16, False),
-        ("series_number", "SeriesNumber", None, False),
-        ("sop_instance_uid", "SOPInstanceUID", 64, True),
-        ("instance_number", "InstanceNumber", None, False),
+    instance = _record(Instance, values["sop_instance_uid"], session)
+    # The cached results for the patient and study it was in are also stale
+    patients = {instance.patient_id, values["patient_id"]}
+    studies = {instance.study_instance_uid, values["study_instance_uid"]}
+    for attr, value in values.items():
+        setattr(instance, attr, value)
+
+    _update_hierarchy(instance, session)
+    session.commit()
+    _RESULTS.invalidate(patients, studies)
+
+
+def add_instances(datasets, session, chunk_size=1000):
+    """Add SOP Instances to the database or update existing instances in bulk.
+
+    Each chunk of `chunk_size` instances is written in a single transaction,
+    with the existing instances, patients, studies, series and images for the
+    chunk fetched using one query per table.
+
+    Parameters
+    ----------
+    datasets : iterable of pydicom.dataset.Dataset or (Dataset, str)
+        The SOP Instances to be added to the database, optionally paired with
+        the path to where the SOP Instance is stored.
+    session : sqlalchemy.orm.session.Session
+        The session we are using to query the database.
+    chunk_size : int, optional
+        The number of instances to write per transaction (default ``1000``).
+
+    Returns
+    -------
+    int
+        The number of instances added or updated. Datasets that are missing
+        a unique key or have invalid values are skipped.
+    """
+    nr_added = 0
+    chunk = []
+    for item in datasets:
+        ds, fpath = item if isinstance(item, tuple) else (item, None)
+        try:
+            chunk.append(_instance_values(ds, fpath))
+        except (AssertionError, AttributeError, KeyError, TypeError):
+            continue
+
+        if len(chunk) >= chunk_size:
+            nr_added += _add_chunk(chunk, session)
+            chunk = []
+
+    if chunk:
+        nr_added += _add_chunk(chunk, session)
+
+    return nr_added
+
+
+def _add_chunk(chunk, session):
+    """Add or update a chunk of instances and commit.
+
+    Parameters
+    ----------
+    chunk : list of dict
+        The attribute values for each instance, from :func:`_instance_values`.
+    session : sqlalchemy.orm.session.Session
+        The session we are using to query the database.
+
+    Returns
+    -------
+    int
+        The number of instances in the chunk.
+    """
+    # Fetch all the existing records for the chunk up front
+    keys = [
+        (Instance, "sop_instance_uid"),
+        (Patient, "patient_id"),
+        (Study, "study_instance_uid"),
+        (Series, "series_instance_uid"),
+        (Image, "sop_instance_uid"),
     ]
+    records = {}
+    for model, attr in keys:
+        wanted = {values[attr] for values in chunk}
+        column = getattr(model, attr)
+        for record in session.query(model).filter(column.in_(wanted)):
+            records[(model, getattr(record, attr))] = record
+
+    patients, studies = set(), set()
+    for values in chunk:
+        instance = _record(Instance, values["sop_instance_uid"], session, records)
+        patients.update((instance.patient_id, values["patient_id"]))
+        studies.update((instance.study_instance_uid, values["study_instance_uid"]))
+        for attr, value in values.items():
+            setattr(instance, attr, value)
+
+        _update_hierarchy(instance, session, records)
+
+    session.commit()
+    _RESULTS.invalidate(patients, studies)
+
+    return len(chunk)
+
+
+def _instance_values(ds, fpath=None):
+    """Return the Instance attribute values for the SOP Instance `ds`.
+
+    Parameters
+    ----------
+    ds : pydicom.dataset.Dataset
+        The SOP Instance to be added to the database.
+    fpath : str, optional
+        The path to where the SOP Instance is stored.
+
+    Returns
+    -------
+    dict
+        The Instance attribute names and their values.
+
+    Raises
+    ------
+    AssertionError
+        If a value is too long or out of range.
+    KeyError
+        If a unique key is missing.
+    """
+    values = {}
 
     # Unique and Required attributes
-    for attr, keyword, max_len, unique in required:
+    for attr, keyword, max_len, unique in _REQUIRED:
         if not unique and keyword not in ds:
             value = None
-            # print('hello'
         else:
-            # print('hello2')
-            print(ds[keyword])
             elem = ds[keyword]
             value = elem.value
 
@@ -214,16 +410,16 @@ def add_instance(ds, session, fpath=None):
             else:
                 assert -(2**31) <= value <= 2**31 - 1
 
-        setattr(instance, attr, value)
+        values[attr] = value
 
-    instance.filename = fpath
+    values["filename"] = fpath
 
     # Transfer Syntax UID
     try:
         tsyntax = ds.file_meta.TransferSyntaxUID
         if tsyntax:
             assert len(tsyntax) < 64
-            instance.transfer_syntax_uid = tsyntax
+            values["transfer_syntax_uid"] = tsyntax
     except (AttributeError, AssertionError):
         pass
 
@@ -232,79 +428,509 @@ def add_instance(ds, session, fpath=None):
         uid = ds.SOPClassUID
         if uid:
             assert len(uid) < 64
-            instance.sop_class_uid = uid
+            values["sop_class_uid"] = uid
     except (AttributeError, AssertionError):
         pass
 
-    session.add(instance)
-    session.commit()
+    return values
 
 
-def build_query(identifier, session, query=None):
-    """Perform a query against the database.
+def _record(model, key, session, records=None):
+    """Return the `model` record with primary `key`, adding it if missing.
 
     Parameters
     ----------
-    identifier : pydicom.dataset.Dataset
-        The request's *Identifier* dataset containing the query attributes.
+    model : type
+        The table class, such as :class:`Patient`.
+    key : str
+        The value of the record's primary key.
     session : sqlalchemy.orm.session.Session
         The session we are using to query the database.
-    query : sqlalchemy.orm.query.Query, optional
-        If not used then start a new query, otherwise extend the existing
-        `query`.
-
-    Returns
-    -------
-    sqlalchemy.orm.query.Query
-        The resulting query.
-    """
-    # VRs for Single Value Matching and Wild Card Matching
-    _text_vr = ["AE", "CS", "LO", "LT", "PN", "SH", "ST", "UC", "UR", "UT"]
-    for elem in [e for e in identifier if e.keyword in _ATTRIBUTES]:
-        vr = elem.VR
-        val = elem.value
-        # Convert PersonName3 to str
-        if vr == "PN" and val:
-            val = str(val)
-
-        # Part 4, C.2.2.2.1 Single Value Matching
-        if vr != "SQ" and val is not None:
-            if vr in _text_vr and ("*" in val or "?" in val):
-                pass
-            elif vr in ["DA", "TM", "DT"] and "-" in val:
-                pass
-            else:
-                # print('Performing single value matching...')
-                query = _search_single_value(elem, session, query)
-                continue
+    records : dict, optional
+        The records already fetched from the database, keyed by
+        ``(model, key)``. If not used then the database will be queried.
 
-        # Part 4, C.2.2.2.3 Universal Matching
-        if val is None:
-            # print('Performing universal matching...')
-            query = _search_universal(elem, session, query)
-            continue
+    Returns
+    -------
+    Base
+        The existing or newly added record.
+    """
+    if records is None:
+        record = session.get(model, key)
+    else:
+        record = records.get((model, key))
 
-        # Part 4, C.2.2.2.2 List of UID Matching
-        if vr == "UI":
-            # print('Performing list of UID matching...')
-            query = _search_uid_list(elem, session, query)
-            continue
+    if record is None:
+        record = model()
+        setattr(record, model.__mapper__.primary_key[0].key, key)
+        session.add(record)
+        if records is not None:
+            records[(model, key)] = record
 
-        # Part 4, C.2.2.2.4 Wild Card Matching
-        if vr in _text_vr and ("*" in val or "?" in val):
-            # print('Performing wildcard matching...')
-            query = _search_wildcard(elem, session, query)
-            continue
+    return record
 
-        # Part 4, C.2.2.2.5 Range Matching
-        if vr in ["DT", "TM", "DA"] and "-" in val:
-            query = _search_range(elem, session, query)
-            continue
 
-        # Part 4, C.2.2.2.6 Sequence Matching
-        #   No supported attributes are sequences
+def _update_hierarchy(instance, session, records=None):
+    """Add or update the patient, study, series and image for `instance`.
+
+    Parameters
+    ----------
+    instance : db.Instance
+        The instance whose hierarchy is to be added or updated.
+    session : sqlalchemy.orm.session.Session
+        The session we are using to query the database.
+    records : dict, optional
+        The records already fetched from the database, as used with
+        :func:`_record`.
+    """
+    patient = _record(Patient, instance.patient_id, session, records)
+    patient.patient_name = instance.patient_name
+    for attr, value in _name_values(instance.patient_name).items():
+        setattr(patient, attr, value)
+
+    study = _record(Study, instance.study_instance_uid, session, records)
+    study.patient_id = instance.patient_id
+    study.study_date = instance.study_date
+    study.study_time = instance.study_time
+    for attr, value in _date_time_values(study.study_date, study.study_time).items():
+        setattr(study, attr, value)
+    study.accession_number = instance.accession_number
+    study.study_id = instance.study_id
+
+    series = _record(Series, instance.series_instance_uid, session, records)
+    series.study_instance_uid = instance.study_instance_uid
+    series.modality = instance.modality
+    series.series_number = instance.series_number
+
+    image = _record(Image, instance.sop_instance_uid, session, records)
+    image.series_instance_uid = instance.series_instance_uid
+    image.instance_number = instance.instance_number
+
+
+def _normalize_name(value):
+    """Return the normalized form of a PN `value` used for matching.
+
+    The value is converted to upper case and trailing component and group
+    delimiters and spaces, which aren't significant, are removed.
+    """
+    return value.upper().rstrip("^= ")
+
+
+def _name_values(value):
+    """Return the normalized name columns for the *Patient's Name* `value`.
+
+    Parameters
+    ----------
+    value : str or None
+        The patient's name, as a PN string.
+
+    Returns
+    -------
+    dict
+        The ``patient_name_norm``, ``patient_name_family`` and
+        ``patient_name_given`` column values, with the family and given
+        names taken from the alphabetic component group.
+    """
+    if not value:
+        return {
+            "patient_name_norm": None,
+            "patient_name_family": None,
+            "patient_name_given": None,
+        }
+
+    components = value.split("=")[0].split("^")
+    given = components[1] if len(components) > 1 else ""
+    return {
+        "patient_name_norm": _normalize_name(value) or None,
+        "patient_name_family": _normalize_name(components[0]) or None,
+        "patient_name_given": _normalize_name(given) or None,
+    }
+
+
+def _parse_date(value):
+    """Return a DA `value` as an int in the form YYYYMMDD.
+
+    Raises
+    ------
+    ValueError
+        If the value isn't a valid date.
+    """
+    # Also accept the ACR-NEMA YYYY.MM.DD form
+    match = re.fullmatch(r"(\d{4})(\d\d)(\d\d)", value.strip().replace(".", ""))
+    if not match:
+        raise ValueError(f"Invalid DA value '{value}'")
+
+    year, month, day = (int(part) for part in match.groups())
+    try:
+        datetime.date(year, month, day)
+    except ValueError:
+        raise ValueError(f"Invalid DA value '{value}'")
+
+    return year * 10000 + month * 100 + day
+
+
+def _parse_time(value, end=False):
+    """Return a TM `value` as the number of microseconds since midnight.
+
+    Parameters
+    ----------
+    value : str
+        The TM value, as HH[MM[SS[.F{1-6}]]].
+    end : bool, optional
+        If ``False`` (default) then the missing components are taken as
+        zero, otherwise the value is the last microsecond within the
+        precision of the value, so ``"1800"`` is 18:00:59.999999.
+
+    Raises
+    ------
+    ValueError
+        If the value isn't a valid time.
+    """
+    # Also accept the ACR-NEMA HH:MM:SS form
+    match = re.fullmatch(
+        r"(\d\d)(\d\d)?(\d\d)?(?:\.(\d{1,6}))?", value.strip().replace(":", "")
+    )
+    if not match:
+        raise ValueError(f"Invalid TM value '{value}'")
+
+    hours, minutes, seconds, fraction = match.groups()
+    minutes = int(minutes) if minutes else (59 if end else 0)
+    # A seconds value of 60 is allowed for leap seconds
+    seconds = min(int(seconds), 59) if seconds else (59 if end else 0)
+    if fraction:
+        fraction = int(fraction.ljust(6, "9" if end else "0"))
+    else:
+        fraction = 999999 if end else 0
+
+    if int(hours) > 23 or minutes > 59:
+        raise ValueError(f"Invalid TM value '{value}'")
+
+    return ((int(hours) * 60 + minutes) * 60 + seconds) * 1000000 + fraction
+
+
+def _datetime_value(date, time):
+    """Return the number of microseconds from 0001-01-01 for a date and time.
+
+    Parameters
+    ----------
+    date : int
+        The date, as from :func:`_parse_date`.
+    time : int
+        The time, as from :func:`_parse_time`.
+    """
+    ordinal = datetime.date(date // 10000, date // 100 % 100, date % 100).toordinal()
+    return ordinal * 86400 * 1000000 + time
+
+
+def _date_time_values(date, time):
+    """Return the typed date and time columns for the *Study Date* and
+    *Study Time* values.
+
+    Parameters
+    ----------
+    date : str or None
+        The DA value.
+    time : str or None
+        The TM value.
+
+    Returns
+    -------
+    dict
+        The ``study_date_value``, ``study_time_value`` and
+        ``study_datetime_value`` column values. Missing or invalid values
+        are ``None``, and the datetime is only set if both are present.
+    """
+    values = {
+        "study_date_value": None,
+        "study_time_value": None,
+        "study_datetime_value": None,
+    }
+    try:
+        values["study_date_value"] = _parse_date(date) if date else None
+    except ValueError:
+        pass
+
+    try:
+        values["study_time_value"] = _parse_time(time) if time else None
+    except ValueError:
+        pass
+
+    if None not in (values["study_date_value"], values["study_time_value"]):
+        values["study_datetime_value"] = _datetime_value(
+            values["study_date_value"], values["study_time_value"]
+        )
+
+    return values
+
+
+def _prefix_range(prefix):
+    """Return the (lower, upper) bounds of the values starting with `prefix`."""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def build_query(shape, statement):
+    """Add the matching for an *Identifier* to a statement.
+
+    Parameters
+    ----------
+    shape : sequence of (str, str)
+        The (element keyword, matching type) for each key in the request's
+        *Identifier*, with the matching type from :func:`_matching_type`.
+    statement : sqlalchemy.sql.Select
+        The statement to extend.
+
+    Returns
+    -------
+    sqlalchemy.sql.Select
+        The resulting statement. The key values aren't included, instead
+        the statement has a bound parameter for each of the values from
+        :func:`_bind_values`.
+    """
+    for keyword, matching in shape:
+        statement = _SEARCH[matching](keyword, statement)
+
+    return statement
+
+
+def _matching_type(elem):
+    """Return the type of matching to perform for a key.
+
+    Parameters
+    ----------
+    elem : pydicom.dataelem.DataElement
+        The key from the request's *Identifier*.
+
+    Returns
+    -------
+    str
+        One of ``"universal"``, ``"single"``, ``"uid_list"``, ``"name"``
+        (single value matching of a PN using its normalized form), for wildcard
+        matching one of the plans from :func:`_plan_wildcard` or for range
+        matching ``"range"``, ``"range_from"`` (no upper bound) and
+        ``"range_to"`` (no lower bound). A single DA or TM value with a typed
+        column is ``"range_single"``, a range covering the precision of the
+        value.
+
+    Raises
+    ------
+    ValueError
+        If the value is invalid for range matching.
+    """
+    vr = elem.VR
+    val = elem.value
+    # Convert PersonName3 to str
+    if vr == "PN" and val:
+        val = str(val)
+
+    # Part 4, C.2.2.2.3 Universal Matching
+    if val is None or val == "":
+        return "universal"
+
+    # Part 4, C.2.2.2.2 List of UID Matching
+    if vr == "UI" and elem.VM > 1:
+        return "uid_list"
+
+    # Part 4, C.2.2.2.4 Wild Card Matching
+    if vr in _TEXT_VR and ("*" in val or "?" in val):
+        return _plan_wildcard(elem.keyword, vr, val)
+
+    # Part 4, C.2.2.2.5 Range Matching
+    if vr in ["DA", "TM", "DT"] and "-" in val:
+        start, end = val.split("-")
+        if start and end:
+            return "range"
+        elif start:
+            return "range_from"
+        elif end:
+            return "range_to"
+
+        raise ValueError("Invalid attribute value for range matching")
+
+    # Part 4, C.2.2.2.6 Sequence Matching
+    #   No supported attributes are sequences
+
+    # Part 4, C.2.2.2.1 Single Value Matching
+    #   PN values are matched case-insensitively against the normalized name
+    if vr == "PN":
+        return "name"
+
+    #   DA and TM values with a typed column are matched as a range covering
+    #   the precision of the value
+    if elem.keyword in _TYPED_COLUMNS:
+        return "range_single"
+
+    return "single"
+
+
+def _bind_values(elem, matching):
+    """Return the values to bind to the statement parameters for a key.
+
+    Parameters
+    ----------
+    elem : pydicom.dataelem.DataElement
+        The key from the request's *Identifier*.
+    matching : str
+        The type of matching from :func:`_matching_type`.
+
+    Returns
+    -------
+    dict
+        The bound parameter names and their values.
+    """
+    keyword = elem.keyword
+    if matching == "universal":
+        return {}
+
+    if matching == "uid_list":
+        return {keyword: list(elem.value)}
+
+    value = str(elem.value) if elem.VR == "PN" else elem.value
+    if matching == "name":
+        return {keyword: _normalize_name(value)}
+
+    if matching.startswith("wildcard"):
+        params = {keyword: _wildcard_pattern(value, elem.VR)}
+        if matching == "wildcard_prefix":
+            prefix = _literal_prefix(value, elem.VR)
+            lower, upper = _prefix_range(prefix)
+            params[f"{keyword}_lower"] = lower
+            params[f"{keyword}_upper"] = upper
+        elif matching.startswith("wildcard_name"):
+            family, given = _name_prefix(value)[:2]
+            params[f"{keyword}_family"] = family
+            if matching == "wildcard_name_given":
+                lower, upper = _prefix_range(given)
+                params[f"{keyword}_given_lower"] = lower
+                params[f"{keyword}_given_upper"] = upper
+        elif matching == "wildcard_trigram":
+            # Case-insensitive and '%' and '_' aren't escaped, so may have
+            #   more candidates than matches
+            params[f"{keyword}_trigram"] = value.replace("*", "%").replace("?", "_")
+
+        return params
+
+    if matching.startswith("range"):
+        start, end = value.split("-") if "-" in value else (value, value)
+        start, end = start or None, end or None
+        if keyword in _TYPED_COLUMNS and elem.VR == "DA":
+            start = _parse_date(start) if start else None
+            end = _parse_date(end) if end else None
+        elif keyword in _TYPED_COLUMNS and elem.VR == "TM":
+            start = _parse_time(start) if start else None
+            end = _parse_time(end, end=True) if end else None
+
+        params = {}
+        if start is not None:
+            params[f"{keyword}_start"] = start
+        if end is not None:
+            params[f"{keyword}_end"] = end
+
+        return params
+
+    return {keyword: value}
+
+
+def _plan_wildcard(keyword, vr, value):
+    """Return how wildcard matching should be performed for a key.
+
+    Parameters
+    ----------
+    keyword : str
+        The element keyword of the key.
+    vr : str
+        The key's VR.
+    value : str
+        The key's value, containing at least one ``*`` or ``?``.
+
+    Returns
+    -------
+    str
+        One of:
+
+        * ``"wildcard_name"`` for a PN value that starts with a literal
+          family name component, such as ``"SMITH^*"``, which is matched
+          using the index of the normalized family and given names, or
+          ``"wildcard_name_given"`` if the given name also starts with
+          literal characters, such as ``"SMITH^J*"``.
+        * ``"wildcard_prefix"`` if the value starts with literal characters,
+          which are matched using a range scan of the column's index (the
+          normalized name for PN).
+        * ``"wildcard_trigram"`` if the value contains at least 3
+          consecutive literal characters and the column has a trigram index.
+        * ``"wildcard"`` if neither index can be used, which scans the table.
+
+        In all cases the full pattern is also matched against each candidate.
+    """
+    # The family name is complete if followed by a component delimiter
+    components = _name_prefix(value) if vr == "PN" else []
+    if len(components) > 1 and components[0]:
+        if components[1]:
+            return "wildcard_name_given"
+
+        return "wildcard_name"
+
+    prefix = _literal_prefix(value, vr)
+
+    has_trigram = (
+        keyword in _TRIGRAM_KEYWORDS
+        and re.search(r"[^*?]{3}", value) is not None
+    )
+
+    if len(prefix) >= 3 or (prefix and not has_trigram):
+        return "wildcard_prefix"
+
+    if has_trigram:
+        return "wildcard_trigram"
+
+    return "wildcard"
+
+
+def _literal_prefix(value, vr):
+    """Return the characters in a wildcard `value` before the first wildcard.
+
+    For PN the prefix is normalized and only uses the alphabetic component
+    group, to match the normalized name columns.
+    """
+    prefix = re.split(r"[*?]", value, maxsplit=1)[0]
+    if vr == "PN":
+        prefix = _normalize_name(prefix.split("=")[0])
+
+    return prefix
+
+
+def _name_prefix(value):
+    """Return the normalized components of the alphabetic group in the
+    literal prefix of a PN wildcard `value`.
+    """
+    prefix = re.split(r"[*?]", value, maxsplit=1)[0]
+    return [_normalize_name(part) for part in prefix.split("=")[0].split("^")]
+
+
+def _wildcard_pattern(value, vr):
+    """Return the pattern to use for matching a wildcard `value`.
+
+    Parameters
+    ----------
+    value : str
+        The key's value.
+    vr : str
+        The key's VR.
+
+    Returns
+    -------
+    str
+        For PN, a case-insensitive ``LIKE`` pattern using ``\\`` as the
+        escape character, otherwise a case-sensitive ``GLOB`` pattern.
+    """
+    # Contains '*' or '?', case-sensitive if not PN
+    #   '*' shall match any sequence of characters (incl. zero length)
+    #   '?' shall match any single character
+    if vr == "PN":
+        value = re.sub(r"([\\%_])", r"\\\1", value)
+        return value.replace("*", "%").replace("?", "_")
 
-    return query
+    # GLOB uses the same wildcards, but '[' starts a character class
+    return value.replace("[", "[[]")
 
 
 def _check_identifier(identifier, model):
@@ -372,13 +998,14 @@ def clear(session):
     session : sqlalchemy.orm.session.Session
         The session we are using to clear the database.
     """
-    for instance in session.query(Instance).all():
-        session.delete(instance)
+    for model in (Instance, Image, Series, Study, Patient):
+        session.query(model).delete()
 
     session.commit()
+    _RESULTS.clear()
 
 
-def create(db_location, echo=False):
+def create(db_location, echo=False, pragmas=None, **kwargs):
     """Create a new database at `db_location` if one doesn't already exist.
 
     Parameters
@@ -387,51 +1014,301 @@ def create(db_location, echo=False):
         The location of the database.
     echo : bool, optional
         Turn the sqlalchemy logging on (default ``False``).
+    pragmas : dict, optional
+        The SQLite PRAGMAs to apply to every connection, as ``{name:
+        value}``, such as one of the :data:`SQLITE_PROFILES`.
+    **kwargs
+        Any other keyword parameters to pass to ``create_engine()``, such as
+        the connection pool configuration.
     """
-    engine = create_engine(db_location, echo=echo)
+    engine = create_engine(db_location, echo=echo, **kwargs)
+    if pragmas and engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", partial(_apply_pragmas, pragmas))
 
     # Create the tables (won't recreate tables already present)
     Base.metadata.create_all(engine)
+    migrate(engine)
 
     return engine
 
 
-def remove_instance(instance_uid, session):
-    """Remove a SOP Instance from the database.
+def _apply_pragmas(pragmas, dbapi_connection, connection_record):
+    """Apply the SQLite `pragmas` to a new connection."""
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+
+    cursor.close()
+
+
+def migrate(engine):
+    """Bring an existing database up to date with the current table setup.
+
+    ``create_all()`` only creates missing tables, so indexes added since a
+    database file was created have to be added separately.
 
     Parameters
     ----------
-    instance_uid : pydicom.uid.UID
-        The (0008,0018) *SOP Instance UID* of the SOP Instance to be removed
-        from the database.
-    session : sqlalchemy.orm.session.Session
-        The session to use when querying the database for the instance.
+    engine : sqlalchemy.engine.Engine
+        The engine for the database to update.
     """
-    matches = (
-        session.query(Instance).filter(
-            Instance.sop_instance_uid == instance_uid).all()
-    )
-    if matches:
-        session.delete(matches[0])
-        session.commit()
+    # Add any columns missing from tables created by an earlier version
+    inspector = inspect(engine)
+    added_columns = False
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            present = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+
+                col_type = column.type.compile(engine.dialect)
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {table.name} "
+                        f"ADD COLUMN {column.name} {col_type}"
+                    )
+                )
+                added_columns = True
 
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
-def search(model, identifier, session):
-    """Search the database.
+    # Earlier versions only wrote to the instance table
+    with engine.connect() as conn:
+        has_instances = conn.execute(select(exists().select_from(Instance))).scalar()
+        has_patients = conn.execute(select(exists().select_from(Patient))).scalar()
+
+    create_search_index(engine)
+
+    if added_columns or (has_instances and not has_patients):
+        populate_hierarchy(engine)
 
-    Optional keys are not supported.
+
+def create_search_index(engine):
+    """Create the trigram indexes used for wildcard matching.
+
+    Uses SQLite FTS5 tables with the trigram tokenizer, kept up to date with
+    the patient and study tables by triggers. If the database doesn't support
+    them then wildcard matching falls back to scanning the tables.
 
     Parameters
     ----------
-    model : pydicom.uid.UID
-        The Query/Retrieve Information Model. Supported models are:
+    engine : sqlalchemy.engine.Engine
+        The engine for the database to update.
+    """
+    _TRIGRAM_KEYWORDS.clear()
+    if engine.dialect.name != "sqlite":
+        return
+
+    for table, columns in _TRIGRAM_INDEXES.items():
+        fts = f"{table}_fts"
+        names = ", ".join(name for name, _ in columns)
+        new = ", ".join(f"new.{name}" for name, _ in columns)
+        old = ", ".join(f"old.{name}" for name, _ in columns)
+        statements = [
+            f"CREATE VIRTUAL TABLE {fts} USING fts5("
+            f"{names}, content='{table}', tokenize='trigram')",
+            f"CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {names}) VALUES (new.rowid, {new}); END",
+            f"CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {names}) "
+            f"VALUES ('delete', old.rowid, {old}); END",
+            f"CREATE TRIGGER {fts}_au AFTER UPDATE OF {names} ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {names}) "
+            f"VALUES ('delete', old.rowid, {old}); "
+            f"INSERT INTO {fts}(rowid, {names}) VALUES (new.rowid, {new}); END",
+            # Index any rows added before the table was created
+            f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+        ]
+        try:
+            with engine.begin() as conn:
+                if inspect(conn).has_table(fts):
+                    statements = []
+
+                for statement in statements:
+                    conn.execute(text(statement))
+        except OperationalError:
+            # FTS5 or the trigram tokenizer isn't available
+            continue
 
-        - *Patient Root Query Retrieve Information Model* for C-FIND, C-GET
-          and C-MOVE
-        - *Study Root Query Retrieve Information Model* for C-FIND, C-GET and
-          C-MOVE
-    identifier : pydicom.dataset.Dataset
-        The Query/Retrieve request's *Identifier* dataset.
+        _TRIGRAM_KEYWORDS.update(keyword for _, keyword in columns)
+
+
+def populate_hierarchy(engine):
+    """Add the patients, studies, series and images missing for the instances
+    in the database.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine for the database to update.
+    """
+    hierarchy = [
+        (
+            Patient,
+            Instance.patient_id,
+            [Instance.patient_name],
+        ),
+        (
+            Study,
+            Instance.study_instance_uid,
+            [
+                Instance.patient_id,
+                Instance.study_date,
+                Instance.study_time,
+                Instance.accession_number,
+                Instance.study_id,
+            ],
+        ),
+        (
+            Series,
+            Instance.series_instance_uid,
+            [
+                Instance.study_instance_uid,
+                Instance.modality,
+                Instance.series_number,
+            ],
+        ),
+        (
+            Image,
+            Instance.sop_instance_uid,
+            [Instance.series_instance_uid, Instance.instance_number],
+        ),
+    ]
+    with engine.begin() as conn:
+        for model, key, columns in hierarchy:
+            model_key = getattr(model, key.key)
+            query = (
+                select(key, *[func.max(col) for col in columns])
+                .where(~exists().where(model_key == key))
+                .group_by(key)
+            )
+            conn.execute(
+                insert(model).from_select(
+                    [key.key] + [col.key for col in columns], query
+                )
+            )
+
+        _populate_derived(conn)
+
+
+def _populate_derived(conn, chunk_size=10000):
+    """Set the columns derived from the stored values for the records
+    missing them.
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection
+        The connection to the database to update.
+    chunk_size : int, optional
+        The number of records to update per statement (default ``10000``).
+    """
+    # (table, source columns, function returning the derived columns)
+    derived = [
+        (Patient, [Patient.patient_name], _name_values),
+        (Study, [Study.study_date, Study.study_time], _date_time_values),
+    ]
+    for model, sources, values in derived:
+        key = model.__mapper__.primary_key[0]
+        targets = list(values(*[None] * len(sources)))
+        query = select(key, *sources).where(
+            sources[0].is_not(None), getattr(model, targets[0]).is_(None)
+        )
+        statement = (
+            model.__table__.update()
+            .where(key == bindparam("key"))
+            .values({attr: bindparam(f"new_{attr}") for attr in targets})
+        )
+        rows = conn.execute(query).all()
+        for idx in range(0, len(rows), chunk_size):
+            conn.execute(
+                statement,
+                [
+                    {
+                        "key": row[0],
+                        **{f"new_{k}": v for k, v in values(*row[1:]).items()},
+                    }
+                    for row in rows[idx:idx + chunk_size]
+                ],
+            )
+
+
+def remove_instance(instance_uid, session):
+    """Remove a SOP Instance from the database.
+
+    Parameters
+    ----------
+    instance_uid : pydicom.uid.UID
+        The (0008,0018) *SOP Instance UID* of the SOP Instance to be removed
+        from the database.
+    session : sqlalchemy.orm.session.Session
+        The session to use when querying the database for the instance.
+    """
+    matches = (
+        session.query(Instance).filter(
+            Instance.sop_instance_uid == instance_uid).all()
+    )
+    if matches:
+        instance = matches[0]
+        session.delete(instance)
+        image = session.get(Image, instance.sop_instance_uid)
+        if image is not None:
+            session.delete(image)
+
+        session.flush()
+        _remove_orphans(instance, session)
+        patient_id, study_uid = instance.patient_id, instance.study_instance_uid
+        session.commit()
+        _RESULTS.invalidate([patient_id], [study_uid])
+
+
+def _remove_orphans(instance, session):
+    """Remove the series, study and patient of a removed `instance` if they
+    no longer contain any instances.
+
+    Parameters
+    ----------
+    instance : db.Instance
+        The instance that has been removed.
+    session : sqlalchemy.orm.session.Session
+        The session to use when querying the database.
+    """
+    hierarchy = [
+        (Series, "series_instance_uid"),
+        (Study, "study_instance_uid"),
+        (Patient, "patient_id"),
+    ]
+    for model, attr in hierarchy:
+        value = getattr(instance, attr)
+        remaining = session.query(
+            exists().where(getattr(Instance, attr) == value)
+        ).scalar()
+        if remaining:
+            return
+
+        record = session.get(model, value)
+        if record is not None:
+            session.delete(record)
+
+
+def search(model, identifier, session):
+    """Search the database.
+
+    Optional keys are not supported.
+
+    Parameters
+    ----------
+    model : pydicom.uid.UID
+        The Query/Retrieve Information Model. Supported models are:
+
+        - *Patient Root Query Retrieve Information Model* for C-FIND, C-GET
+          and C-MOVE
+        - *Study Root Query Retrieve Information Model* for C-FIND, C-GET and
+          C-MOVE
+    identifier : pydicom.dataset.Dataset
+        The Query/Retrieve request's *Identifier* dataset.
     session : sqlalchemy.orm.session.Session
         The session we are using to query the database.
 
@@ -440,11 +1317,323 @@ def search(model, identifier, session):
     list of Instance
         The matching database Instances.
 
+    Raises
+    ------
+    InvalidIdentifier
+        If the `identifier` is invalid.
+    """
+    _prepare_identifier(model, identifier)
+
+    return _search_qr(model, identifier, session)
+
+
+def iter_search(model, identifier, session, batch_size=500):
+    """Search the database, streaming the matches as they're fetched.
+
+    Unlike :func:`search` the matches aren't all loaded into memory before
+    being returned, instead they're fetched from the database cursor in
+    batches of `batch_size` as the result is iterated over. The `session`
+    must stay open until the iteration is complete.
+
+    Parameters
+    ----------
+    model : pydicom.uid.UID
+        The Query/Retrieve Information Model, as used with :func:`search`.
+    identifier : pydicom.dataset.Dataset
+        The Query/Retrieve request's *Identifier* dataset.
+    session : sqlalchemy.orm.session.Session
+        The session we are using to query the database.
+    batch_size : int, optional
+        The number of rows to fetch from the cursor at a time (default
+        ``500``).
+
+    Returns
+    -------
+    iterable of Patient, Study, Series or Instance
+        The matches.
+
+    Raises
+    ------
+    ValueError
+        If the `identifier` is invalid.
+    """
+    _prepare_identifier(model, identifier)
+    statement, params = _query_qr(model, identifier)
+    statement = statement.execution_options(yield_per=batch_size)
+
+    return session.execute(statement, params).scalars()
+
+
+def iter_identifiers(
+    model, identifier, session, batch_size=500, trace=NULL_TRACE, **extra
+):
+    """Search the database, streaming the response *Identifier* for each match.
+
+    Unlike :func:`iter_search` the matches aren't loaded as records, only
+    the columns for the keys in the `identifier` are selected and each
+    response is filled from a template built once for the request. The
+    `session` must stay open until the iteration is complete.
+
+    If the result cache has been enabled with :func:`configure_result_cache`
+    then the selected rows are cached, keyed on the canonical form of the
+    query, and repeated queries are answered without the database.
+
+    If the slow query log has been enabled with ``slowlog.configure()`` then
+    queries whose database time is over the threshold are logged with their
+    query plan once all the matches have been fetched.
+
+    Parameters
+    ----------
+    model : pydicom.uid.UID
+        The Query/Retrieve Information Model, as used with :func:`search`.
+    identifier : pydicom.dataset.Dataset
+        The Query/Retrieve request's *Identifier* dataset.
+    session : sqlalchemy.orm.session.Session
+        The session we are using to query the database.
+    batch_size : int, optional
+        The number of rows to fetch from the cursor at a time (default
+        ``500``).
+    trace : tracing.Trace, optional
+        If used then the ``"validate"``, ``"build"``, ``"execute"`` and
+        ``"response"`` phases of the search are marked.
+    **extra
+        Any elements to add to every response as ``keyword=value``, such as
+        ``RetrieveAETitle``.
+
+    Returns
+    -------
+    iterable of pydicom.dataset.Dataset
+        The response *Identifier* for each match, the same as from
+        ``as_identifier()`` plus the `extra` elements.
+
     Raises
     ------
     ValueError
         If the `identifier` is invalid.
     """
+    _prepare_identifier(model, identifier)
+    statement, params = _query_qr(model, identifier, trace)
+    template = _ResponseTemplate(model, identifier, extra)
+
+    # The cached statements are reused so can key the projection
+    key = (statement, tuple(template.keywords))
+    projection = _PROJECTIONS.get(key)
+    if projection is None:
+        columns = [_attribute(kw, statement) for kw in template.keywords]
+        projection = statement.with_only_columns(
+            *columns, maintain_column_froms=False
+        )
+        _PROJECTIONS.put(key, projection)
+
+    trace.mark("build")
+
+    # The bound values are normalized, so are the canonical form of the keys
+    key = (projection, _params_key(params))
+    rows = _RESULTS.get(key)
+    if rows is None:
+        generation = _RESULTS.generation
+        if _RESULTS.maxsize:
+            scopes = _cache_scopes(identifier, session)
+
+        projection = projection.execution_options(yield_per=batch_size)
+        start = time.perf_counter()
+        rows = session.execute(projection, params)
+        if SLOW_QUERIES.enabled:
+            log = partial(
+                _log_slow_query, session, model, identifier, projection, params
+            )
+            rows = _timed_rows(rows, time.perf_counter() - start, log)
+
+        if _RESULTS.maxsize:
+            rows = _RESULTS.collect(key, scopes, rows, generation)
+
+    trace.mark("execute")
+
+    return trace_responses(rows, template, trace)
+
+
+def trace_responses(rows, template, trace):
+    """Return the responses built from `rows`, marking the phases of each.
+
+    Parameters
+    ----------
+    rows : iterable of sequence
+        The selected rows, fetching each is marked as ``"execute"``.
+    template : callable
+        Returns the response for a row, marked as ``"response"``.
+    trace : tracing.Trace
+        The request's trace.
+
+    Returns
+    -------
+    iterable of pydicom.dataset.Dataset
+        The responses.
+    """
+    if not trace.enabled:
+        return map(template, rows)
+
+    return _traced_responses(rows, template, trace)
+
+
+def _traced_responses(rows, template, trace):
+    for row in rows:
+        trace.mark("execute")
+        response = template(row)
+        trace.mark("response")
+        yield response
+
+
+def _params_key(params):
+    """Return the bound parameter values for a query as a hashable key."""
+    return tuple(
+        sorted(
+            (name, tuple(value) if isinstance(value, list) else value)
+            for name, value in params.items()
+        )
+    )
+
+
+def _cache_scopes(identifier, session):
+    """Return the writes that can change the result of a query.
+
+    Parameters
+    ----------
+    identifier : pydicom.dataset.Dataset
+        The request's *Identifier* dataset.
+    session : sqlalchemy.orm.session.Session
+        The session used to look up the patient of a study.
+
+    Returns
+    -------
+    tuple of (tuple of (str, str) or None)
+        ``(("patient", patient ID),)`` if the query matches a single
+        *Patient ID*, otherwise if it matches a single *Study Instance UID*
+        ``("study", study instance UID)`` and, if the study exists, its
+        ``("patient", patient ID)``, as the rows also have the values of
+        the patient, which a write to any of the patient's studies can
+        change. ``(None,)`` if the result can be changed by a write to any
+        patient.
+    """
+    for keyword, scope in (("PatientID", "patient"), ("StudyInstanceUID", "study")):
+        if keyword in identifier:
+            elem = identifier[keyword]
+            if _matching_type(elem) != "single":
+                continue
+
+            if scope == "patient":
+                return ((scope, elem.value),)
+
+            patient_id = session.scalar(
+                select(Study.patient_id).where(Study.study_instance_uid == elem.value)
+            )
+            if patient_id is None:
+                return ((scope, elem.value),)
+
+            return (scope, elem.value), ("patient", patient_id)
+
+    return (None,)
+
+
+def _response_keywords(model, identifier):
+    """Return the keywords for the values in the response *Identifier*.
+
+    Parameters
+    ----------
+    model : pydicom.uid.UID
+        The Query/Retrieve Information Model.
+    identifier : pydicom.dataset.Dataset
+        The request's *Identifier* dataset.
+
+    Returns
+    -------
+    list of str
+        The keywords of the unique and required keys in `identifier` at or
+        above the Query Retrieve Level.
+    """
+    if model in _PATIENT_ROOT:
+        attr = _PATIENT_ROOT[model]
+    else:
+        attr = _STUDY_ROOT[model]
+
+    all_keywords = []
+    for level, keywords in attr.items():
+        all_keywords.extend(keywords)
+        if level == identifier.QueryRetrieveLevel:
+            break
+
+    return [kw for kw in all_keywords if kw in identifier and kw in _TRANSLATION]
+
+
+class _ResponseTemplate:
+    """Build the response *Identifiers* for a request from selected rows.
+
+    The tags and VRs for the response are looked up once, so each row only
+    needs its values wrapped in elements. The values were validated when
+    they were added to the database so aren't validated again. The *Query
+    Retrieve Level* and any extra elements are the same for every response
+    and are shared.
+
+    Parameters
+    ----------
+    model : pydicom.uid.UID
+        The Query/Retrieve Information Model.
+    identifier : pydicom.dataset.Dataset
+        The request's *Identifier* dataset.
+    extra : dict, optional
+        Any elements to add to every response, as ``{keyword: value}``.
+    """
+
+    def __init__(self, model, identifier, extra=None):
+        self.keywords = _response_keywords(model, identifier)
+        self._fields = []
+        for kw in self.keywords:
+            tag = Tag(kw)
+            self._fields.append((tag, dictionary_VR(tag)))
+
+        constants = {"QueryRetrieveLevel": identifier.QueryRetrieveLevel}
+        constants.update(extra or {})
+        self._constants = {}
+        for kw, value in constants.items():
+            tag = Tag(kw)
+            self._constants[tag] = DataElement(tag, dictionary_VR(tag), value)
+
+    def __call__(self, row):
+        """Return the response *Identifier* for a row of values.
+
+        Parameters
+        ----------
+        row : sequence
+            The values for each of the keywords in :attr:`keywords`.
+
+        Returns
+        -------
+        pydicom.dataset.Dataset
+            The response *Identifier*.
+        """
+        elements = dict(self._constants)
+        for (tag, vr), value in zip(self._fields, row):
+            elements[tag] = DataElement(
+                tag, vr, value, validation_mode=config.IGNORE
+            )
+
+        return Dataset(elements)
+
+
+def _prepare_identifier(model, identifier):
+    """Remove the keys from `identifier` that aren't used for matching.
+
+    Parameters
+    ----------
+    model : pydicom.uid.UID
+        The Query/Retrieve Information Model.
+    identifier : pydicom.dataset.Dataset
+        The Query/Retrieve request's *Identifier* dataset, modified in place.
+
+    Raises
+    ------
+    ValueError
+        If the `model` isn't supported.
+    """
     if model not in _STUDY_ROOT and model not in _PATIENT_ROOT:
         raise ValueError(f"Unknown information model '{model.name}'")
 
@@ -460,11 +1649,187 @@ def search(model, identifier, session):
             if value[1] == "R" and kw in identifier:
                 delattr(identifier, kw)
 
-    return _search_qr(model, identifier, session)
 
+def _search_qr(model, identifier, session):
+    """Search the database using a Query/Retrieve *Identifier* query.
+
+    Parameters
+    ----------
+    model : pydicom.uid.UID
+        Either *Patient Root Query Retrieve Information Model* or *Study Root
+        Query Retrieve Information Model* for C-FIND, C-GET or C-MOVE.
+    identifier : pydicom.dataset.Dataset
+        The request's *Identifier* dataset.
+    session : sqlalchemy.orm.session.Session
+        The session we are using to query the database.
+
+    Returns
+    -------
+    list of db.Patient, db.Study, db.Series or db.Instance
+        For C-FIND, the records at the requested Query Retrieve Level that
+        match the query. For C-GET and C-MOVE the matching Instances.
+    """
+    statement, params = _query_qr(model, identifier)
+    start = time.perf_counter()
+    matches = session.execute(statement, params).scalars().all()
+    elapsed = time.perf_counter() - start
+    if SLOW_QUERIES.is_slow(elapsed):
+        _log_slow_query(
+            session, model, identifier, statement, params, len(matches), elapsed
+        )
+
+    return matches
+
+
+def _timed_rows(rows, elapsed, log):
+    """Yield `rows`, logging the query if the time spent fetching is slow.
+
+    Only the time spent fetching from `rows` is counted, not the time the
+    caller spends between rows sending the responses. The query is logged
+    once all the rows have been fetched, while the session is still open,
+    so a query that's cancelled part way through isn't logged.
+
+    Parameters
+    ----------
+    rows : iterable of sequence
+        The result rows.
+    elapsed : float
+        The time taken to execute the query, in seconds.
+    log : callable
+        Called with the number of rows and the total time if the query is
+        slow.
+
+    Yields
+    ------
+    sequence
+        The rows from `rows`.
+    """
+    nr_rows = 0
+    rows = iter(rows)
+    while True:
+        start = time.perf_counter()
+        row = next(rows, None)
+        elapsed += time.perf_counter() - start
+        if row is None:
+            break
+
+        nr_rows += 1
+        yield row
+
+    if SLOW_QUERIES.is_slow(elapsed):
+        log(nr_rows, elapsed)
+
+
+def _log_slow_query(session, model, identifier, statement, params, nr_rows, elapsed):
+    """Add a query to the slow query log with its SQLite query plan.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        The session the query was run with, used to get the query plan.
+    model : pydicom.uid.UID
+        The Query/Retrieve Information Model.
+    identifier : pydicom.dataset.Dataset
+        The request's *Identifier* dataset.
+    statement : sqlalchemy.sql.Select
+        The query's statement.
+    params : dict
+        The values for the statement's bound parameters.
+    nr_rows : int
+        The number of rows returned.
+    elapsed : float
+        The time taken by the query, in seconds.
+    """
+    # Expand the lists for UID list matching into their own parameters
+    compiled = statement.params(params).compile(
+        dialect=session.get_bind().dialect,
+        compile_kwargs={"render_postcompile": True},
+    )
+    values = compiled.params
+    if compiled.positiontup is not None:
+        values = tuple(values[name] for name in compiled.positiontup)
+
+    try:
+        result = session.connection().exec_driver_sql(
+            f"EXPLAIN QUERY PLAN {compiled.string}", values
+        )
+        plan = _format_plan(result.all())
+    except Exception as exc:
+        plan = [f"EXPLAIN QUERY PLAN failed: {exc}"]
+
+    SLOW_QUERIES.record(
+        {
+            "model": getattr(model, "keyword", None) or str(model),
+            "level": identifier.QueryRetrieveLevel,
+            "identifier": _identifier_values(identifier),
+            "elapsed_ms": round(elapsed * 1000, 3),
+            "rows": nr_rows,
+            "sql": compiled.string,
+            "params": params,
+            "plan": plan,
+        }
+    )
+
+
+def _format_plan(rows):
+    """Return the ``EXPLAIN QUERY PLAN`` `rows` as indented lines."""
+    lines = []
+    depths = {}
+    for node, parent, _, detail in rows:
+        depth = depths[node] = depths.get(parent, -1) + 1
+        lines.append(f"{'  ' * depth}{detail}")
+
+    return lines
+
+
+def _identifier_values(identifier):
+    """Return the keys in `identifier` as ``{keyword: value}``."""
+    values = {}
+    for elem in identifier:
+        if elem.VM > 1:
+            values[elem.keyword] = [str(value) for value in elem.value]
+        else:
+            values[elem.keyword] = "" if elem.value is None else str(elem.value)
+
+    return values
+
+
+def _query_qr(model, identifier, trace=NULL_TRACE):
+    """Return the statement and parameters for a Query/Retrieve *Identifier*.
+
+    Statements are cached by the shape of the *Identifier*, which is the
+    information model, the Query Retrieve Level and the keyword and type of
+    matching for each key, so repeated shapes only need their values bound.
+
+    Parameters
+    ----------
+    model : pydicom.uid.UID
+        Either *Patient Root Query Retrieve Information Model* or *Study Root
+        Query Retrieve Information Model* for C-FIND, C-GET or C-MOVE.
+    identifier : pydicom.dataset.Dataset
+        The request's *Identifier* dataset.
+    trace : tracing.Trace, optional
+        If used then the ``"validate"`` and ``"build"`` phases are marked.
+
+    Returns
+    -------
+    sqlalchemy.sql.Select, dict
+        The statement and the values for its bound parameters.
+    """
+    query_level, shape, params = _query_shape(model, identifier, trace)
+    key = (model, query_level, tuple(shape))
+    statement = _STATEMENTS.get(key)
+    if statement is None:
+        statement = build_query(shape, _level_statement(model, query_level))
+        _STATEMENTS.put(key, statement)
+
+    trace.mark("build")
+
+    return statement, params
 
-def _search_qr(model, identifier, session):
-    """Search the database using a Query/Retrieve *Identifier* query.
+
+def _query_shape(model, identifier, trace=NULL_TRACE):
+    """Return the shape and parameters for a Query/Retrieve *Identifier*.
 
     Parameters
     ----------
@@ -473,16 +1838,24 @@ def _search_qr(model, identifier, session):
         Query Retrieve Information Model* for C-FIND, C-GET or C-MOVE.
     identifier : pydicom.dataset.Dataset
         The request's *Identifier* dataset.
-    session : sqlalchemy.orm.session.Session
-        The session we are using to query the database.
+    trace : tracing.Trace, optional
+        If used then the ``"validate"`` phase is marked.
 
     Returns
     -------
-    list of db.Instance
-        The Instances that match the query.
+    str, list of (str, str), dict
+        The Query Retrieve Level, the (element keyword, matching type) for
+        each key at or above the level and the values for the bound
+        parameters, as used with :func:`build_query`.
+
+    Raises
+    ------
+    InvalidIdentifier
+        If the `identifier` is invalid.
     """
     # Will raise InvalidIdentifier if check failed
     _check_identifier(identifier, model)
+    trace.mark("validate")
 
     if model in _PATIENT_ROOT:
         attr = _PATIENT_ROOT[model]
@@ -490,39 +1863,455 @@ def _search_qr(model, identifier, session):
         attr = _STUDY_ROOT[model]
 
     # Hierarchical search method: C.4.1.3.1.1
-    query = None
+    query_level = identifier.QueryRetrieveLevel
+    shape = []
+    params = {}
     for level, keywords in attr.items():
         # Keywords at current level that are in the identifier
-        keywords = [kw for kw in keywords if kw in identifier]
-        # Create query dataset for only the current level and run it
-        ds = Dataset()
-        [setattr(ds, kw, getattr(identifier, kw)) for kw in keywords]
-        query = build_query(ds, session, query)
+        for kw in [kw for kw in keywords if kw in identifier]:
+            elem = identifier[kw]
+            # Such as a malformed DA or TM value
+            try:
+                matching = _matching_type(elem)
+                params.update(_bind_values(elem, matching))
+            except ValueError as exc:
+                raise InvalidIdentifier(str(exc))
 
-        if level == identifier.QueryRetrieveLevel:
+            shape.append((kw, matching))
+
+        if level == query_level:
             break
 
-    return query.all()
+    return query_level, _combine_date_time(shape, params), params
+
+
+# The matching types of the values with a range
+_RANGE_MATCHING = ("range", "range_from", "range_to")
 
 
-def _search_range(elem, session, query=None):
-    """Perform a range search for DA, DT and TM elements with '-' in them.
+def _combine_date_time(shape, params):
+    """Combine the range matching of date and time keys.
+
+    Part 4, C.2.2.2.5: if both the date and the paired time key use range
+    matching then they're matched as a single datetime range, so a date of
+    ``"20060705-20060707"`` and time of ``"1000-1800"`` matches July 5,
+    10 am to July 7, 6 pm. A single date or time value isn't a range, so
+    is matched separately: a time of ``"1000"`` with the same dates
+    matches 10:00 to 10:00:59 on each day.
 
     Parameters
     ----------
-    elem : pydicom.dataelem.DataElement
-        The attribute to perform the search with.
-    session : sqlalchemy.orm.session.Session
-        The session we are using to query the database.
-    query : sqlalchemy.orm.query.Query, optional
-        An existing query within which this search should be performed. If
-        not used then all the Instances in the database will be searched
-        (default).
+    shape : list of (str, str)
+        The (element keyword, matching type) for each key.
+    params : dict
+        The bound parameter values for the keys, updated in place with the
+        datetime bounds as ``"{date keyword}_start"`` and
+        ``"{date keyword}_end"``.
+
+    Returns
+    -------
+    list of (str, str)
+        The shape with each combined date and time replaced by the date
+        keyword with ``"datetime_range"``, ``"datetime_range_from"`` or
+        ``"datetime_range_to"`` matching.
+    """
+    matching = dict(shape)
+    for date_kw, (time_kw, _) in _DATE_TIME_KEYS.items():
+        date_matching = matching.get(date_kw)
+        if date_matching not in _RANGE_MATCHING:
+            continue
+
+        if matching.get(time_kw) not in _RANGE_MATCHING:
+            continue
+
+        time_start = params.pop(f"{time_kw}_start", 0)
+        time_end = params.pop(f"{time_kw}_end", _END_OF_DAY)
+        if f"{date_kw}_start" in params:
+            params[f"{date_kw}_start"] = _datetime_value(
+                params[f"{date_kw}_start"], time_start
+            )
+        if f"{date_kw}_end" in params:
+            params[f"{date_kw}_end"] = _datetime_value(
+                params[f"{date_kw}_end"], time_end
+            )
+
+        shape = [
+            (kw, f"datetime_{date_matching}" if kw == date_kw else kw_matching)
+            for kw, kw_matching in shape
+            if kw != time_kw
+        ]
+
+    return shape
+
+
+class _StatementCache:
+    """A bounded LRU cache of the statements for each *Identifier* shape.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of statements to keep (default ``256``).
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._statements = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached statement for `key` or ``None`` if missing."""
+        with self._lock:
+            statement = self._statements.get(key)
+            if statement is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._statements.move_to_end(key)
+
+            return statement
+
+    def put(self, key, statement):
+        """Add `statement` to the cache, evicting the least recently used."""
+        with self._lock:
+            self._statements[key] = statement
+            self._statements.move_to_end(key)
+            while len(self._statements) > self.maxsize:
+                self._statements.popitem(last=False)
+
+    def clear(self):
+        """Remove all the cached statements and reset the counters."""
+        with self._lock:
+            self._statements.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Return the cache's hit and miss counters and size."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._statements),
+                "maxsize": self.maxsize,
+            }
+
+
+_STATEMENTS = _StatementCache()
+# The column projections of the cached statements for each set of response
+#   keys, kept apart so they don't count towards the statement cache
+_PROJECTIONS = _StatementCache()
+
+
+def statement_cache_info():
+    """Return the statement cache's hit and miss counters.
+
+    Returns
+    -------
+    dict
+        The number of ``"hits"`` and ``"misses"``, and the current ``"size"``
+        and ``"maxsize"`` of the cache.
+    """
+    return _STATEMENTS.info()
+
+
+class _ResultCache:
+    """A bounded LRU cache of query results with a time to live.
+
+    Each result is cached with the scopes of the writes that can change it,
+    from :func:`_cache_scopes`, so when an instance is added or removed only
+    the results for its patient and study, and those not limited to a single
+    patient or study, need to be invalidated.
+
+    Writes made by other processes, such as ``indexer.py``, aren't seen, so
+    the time to live bounds how stale their results can be.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of results to keep, ``0`` (default) to disable
+        the cache.
+    ttl : float, optional
+        The number of seconds a result is valid for (default ``30``).
+    max_rows : int, optional
+        The largest result to cache, in rows (default ``1000``).
+    """
+
+    def __init__(self, maxsize=0, ttl=30.0, max_rows=1000):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # Incremented on every write, so results read before the write
+        #   completed aren't cached
+        self.generation = 0
+        # {key: (expiry time, scopes, rows)}
+        self._results = OrderedDict()
+        # {scope: set of keys}
+        self._scopes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached rows for `key` or ``None`` if missing."""
+        if not self.maxsize:
+            return None
+
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._results.move_to_end(key)
+
+            return entry[2]
+
+    def collect(self, key, scopes, rows, generation):
+        """Yield `rows`, caching them once they've all been fetched.
+
+        Parameters
+        ----------
+        key : hashable
+            The key for the query.
+        scopes : tuple of (tuple of (str, str) or None)
+            The scopes of the writes that can change the result.
+        rows : iterable of sequence
+            The result rows.
+        generation : int
+            The value of :attr:`generation` before the query was executed.
+            If there's been a write since then the result isn't cached.
+
+        Yields
+        ------
+        sequence
+            The rows from `rows`.
+        """
+        collected = []
+        for row in rows:
+            if collected is not None:
+                collected.append(tuple(row))
+                if len(collected) > self.max_rows:
+                    collected = None
+
+            yield row
+
+        if collected is not None:
+            self.put(key, scopes, collected, generation)
+
+    def put(self, key, scopes, rows, generation):
+        """Add `rows` to the cache, evicting the least recently used."""
+        with self._lock:
+            if generation != self.generation:
+                return
+
+            if key in self._results:
+                self._remove(key)
+
+            self._results[key] = (time.monotonic() + self.ttl, scopes, rows)
+            for scope in scopes:
+                self._scopes.setdefault(scope, set()).add(key)
+            while len(self._results) > self.maxsize:
+                self._remove(next(iter(self._results)))
+                self.evictions += 1
+
+    def invalidate(self, patients=(), studies=()):
+        """Remove the results that a write to `patients` and `studies` may
+        have changed.
+
+        Parameters
+        ----------
+        patients : iterable of str
+            The *Patient ID* of each patient written to.
+        studies : iterable of str
+            The *Study Instance UID* of each study written to.
+        """
+        scopes = [None]
+        scopes.extend(("patient", value) for value in patients if value)
+        scopes.extend(("study", value) for value in studies if value)
+        with self._lock:
+            self.generation += 1
+            for scope in scopes:
+                for key in list(self._scopes.get(scope, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def _remove(self, key):
+        """Remove the result for `key`, must be called with the lock held."""
+        _, scopes, _ = self._results.pop(key)
+        for scope in scopes:
+            keys = self._scopes[scope]
+            keys.discard(key)
+            if not keys:
+                del self._scopes[scope]
+
+    def clear(self):
+        """Remove all the cached results."""
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._results)
+            self._results.clear()
+            self._scopes.clear()
+
+    def info(self):
+        """Return the cache's counters and size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "size": len(self._results),
+                "maxsize": self.maxsize,
+            }
+
+
+_RESULTS = _ResultCache()
+
+
+def configure_result_cache(maxsize, ttl=30.0, max_rows=1000):
+    """Enable or resize the C-FIND result cache used by
+    :func:`iter_identifiers`.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of results to keep, ``0`` to disable the cache.
+    ttl : float, optional
+        The number of seconds a result is valid for (default ``30``).
+    max_rows : int, optional
+        The largest result to cache, in rows (default ``1000``).
+    """
+    _RESULTS.clear()
+    with _RESULTS._lock:
+        _RESULTS.maxsize = maxsize
+        _RESULTS.ttl = ttl
+        _RESULTS.max_rows = max_rows
+
+
+def result_cache_info():
+    """Return the result cache's counters.
+
+    Returns
+    -------
+    dict
+        The number of ``"hits"``, ``"misses"``, ``"evictions"`` (least
+        recently used), ``"expirations"`` (time to live) and
+        ``"invalidations"`` (writes), the ``"hit_ratio"`` and the current
+        ``"size"`` and ``"maxsize"`` of the cache.
+    """
+    return _RESULTS.info()
+
+
+def _level_statement(model, level):
+    """Return a statement selecting from the table for the search.
+
+    Parameters
+    ----------
+    model : pydicom.uid.UID
+        The Query/Retrieve Information Model.
+    level : str
+        The Query Retrieve Level, one of ``"PATIENT"``, ``"STUDY"``,
+        ``"SERIES"`` or ``"IMAGE"``.
+
+    Returns
+    -------
+    sqlalchemy.sql.Select
+        For C-FIND, a statement against the table for the `level`, joined to
+        the tables for the levels above so their attributes can be matched
+        and returned. For C-GET and C-MOVE, a statement against the instance
+        table.
+    """
+    # C-FIND searches the table for the requested level so there's one match
+    #   per patient, study or series, C-GET and C-MOVE need the Instances
+    if model not in _C_FIND:
+        return select(Instance)
+
+    if level == "PATIENT":
+        return select(Patient)
+
+    if level == "STUDY":
+        return (
+            select(Study)
+            .join(Study.patient)
+            .options(contains_eager(Study.patient))
+        )
+
+    if level == "SERIES":
+        return (
+            select(Series)
+            .join(Series.study)
+            .join(Study.patient)
+            .options(contains_eager(Series.study).contains_eager(Study.patient))
+        )
+
+    # The instance table includes the attributes for every level
+    return select(Instance)
+
+
+def _attribute(keyword, statement):
+    """Return the mapped column for `keyword` in the tables used by `statement`.
+
+    Parameters
+    ----------
+    keyword : str
+        The element keyword of a unique or required key.
+    statement : sqlalchemy.sql.Select
+        The statement the column will be used with.
+
+    Returns
+    -------
+    sqlalchemy.orm.attributes.InstrumentedAttribute
+        The column to use for matching against `keyword`.
+    """
+    entity = statement.column_descriptions[0]["entity"]
+    if entity is not Instance:
+        entity = _LEVEL_MODELS[_ATTRIBUTES[keyword][0]]
+
+    return getattr(entity, _TRANSLATION[keyword])
+
+
+def _search_range(keyword, statement, start=True, end=True, combined=False):
+    """Add range matching for DA, DT and TM elements with '-' in them.
+
+    Keys with a typed column are matched against it, so the bound values
+    must be as from :func:`_parse_date` or :func:`_parse_time`.
+
+    Parameters
+    ----------
+    keyword : str
+        The element keyword of the key to match.
+    statement : sqlalchemy.sql.Select
+        The statement within which this search should be performed.
+    start : bool, optional
+        Match against the lower bound of the range, bound to the
+        ``"{keyword}_start"`` parameter (default ``True``).
+    end : bool, optional
+        Match against the upper bound of the range, bound to the
+        ``"{keyword}_end"`` parameter (default ``True``).
+    combined : bool, optional
+        If ``True`` then match the date `keyword` and its paired time
+        against the datetime column, with values as from
+        :func:`_datetime_value` (default ``False``).
 
     Returns
     -------
-    sqlalchemy.orm.query.Query
-        The resulting query.
+    sqlalchemy.sql.Select
+        The resulting statement.
     """
     # range matching
     #   <date1> - <date2>: matches any date within the range, inclusive
@@ -531,23 +2320,28 @@ def _search_range(elem, session, query=None):
     #   <time>: if Timezone Offset From UTC included, values are in specified
     #   date: 20060705-20060707 + time: 1000-1800 matches July 5, 10 am to
     #       July 7, 6 pm.
-    start, end = elem.value.split("-")
-    attr = getattr(Instance, _TRANSLATION[elem.keyword])
-    if not query:
-        query = session.query(Instance)
+    if combined:
+        column = _level_column(keyword, _DATE_TIME_KEYS[keyword][1])
+    elif keyword in _TYPED_COLUMNS:
+        column = _level_column(keyword, _TYPED_COLUMNS[keyword])
+    else:
+        column = _attribute(keyword, statement)
+
+    criteria = []
+    if start:
+        criteria.append(column >= bindparam(f"{keyword}_start"))
 
-    if start and end:
-        return query.filter(attr >= start, attr <= end)
-    elif start and not end:
-        return query.filter(attr >= start)
-    elif not start and end:
-        return query.filter(attr <= end)
+    if end:
+        criteria.append(column <= bindparam(f"{keyword}_end"))
 
-    raise ValueError("Invalid attribute value for range matching")
+    if combined or keyword in _TYPED_COLUMNS:
+        return statement.where(_level_filter(keyword, statement, *criteria))
 
+    return statement.where(*criteria)
 
-def _search_single_value(elem, session, query=None):
-    """Perform a search using single value matching.
+
+def _search_single_value(keyword, statement):
+    """Add single value matching, bound to the ``"{keyword}"`` parameter.
 
     Single value matching shall be performed if the value of an Attribute is
     non-zero length and the VR is not SQ and:
@@ -559,146 +2353,359 @@ def _search_single_value(elem, session, query=None):
 
     Parameters
     ----------
-    elem : pydicom.dataelem.DataElement
-        The attribute to perform the search with.
-    session : sqlalchemy.orm.session.Session
-        The session we are using to query the database.
-    query : sqlalchemy.orm.query.Query, optional
-        An existing query within which this search should be performed. If
-        not used then all the Instances in the database will be searched
-        (default).
+    keyword : str
+        The element keyword of the key to match.
+    statement : sqlalchemy.sql.Select
+        The statement within which this search should be performed.
 
     Returns
     -------
-    sqlalchemy.orm.query.Query
-        The resulting query.
+    sqlalchemy.sql.Select
+        The resulting statement.
     """
-    attr = getattr(Instance, _TRANSLATION[elem.keyword])
-    if elem.VR == "PN":
-        value = str(elem.value)
-    else:
-        value = elem.value
+    attr = _attribute(keyword, statement)
+    return statement.where(attr == bindparam(keyword))
 
-    if not query:
-        query = session.query(Instance)
 
-    return query.filter(attr == value)
+def _search_uid_list(keyword, statement):
+    """Add matching against a list of UIDs, bound to the ``"{keyword}"``
+    parameter.
 
+    A match against any of the UIDs is considered a positive result.
 
-def _search_uid_list(elem, session, query=None):
-    """Search using an element containing a list of UIDs.
+    Parameters
+    ----------
+    keyword : str
+        The element keyword of the key to match.
+    statement : sqlalchemy.sql.Select
+        The statement within which this search should be performed.
 
-    A match against any of the UIDs is considered a positive result.
+    Returns
+    -------
+    sqlalchemy.sql.Select
+        The resulting statement.
+    """
+    attr = _attribute(keyword, statement)
+    return statement.where(attr.in_(bindparam(keyword, expanding=True)))
+
+
+def _search_universal(keyword, statement):
+    """Add universal matching for empty elements.
 
     Parameters
     ----------
-    elem : pydicom.dataelem.DataElement
-        The attribute to perform the search with.
-    session : sqlalchemy.orm.session.Session
-        The session we are using to query the database.
-    query : sqlalchemy.orm.query.Query, optional
-        An existing query within which this search should be performed. If
-        not used then all the Instances in the database will be searched
-        (default).
+    keyword : str
+        The element keyword of the key to match.
+    statement : sqlalchemy.sql.Select
+        The statement within which this search should be performed.
+
+    Returns
+    -------
+    sqlalchemy.sql.Select
+        The resulting statement.
+    """
+    # If the value is zero length then all entities shall match
+    return statement
+
+
+def _search_wildcard(keyword, statement, plan="wildcard"):
+    """Add wildcard matching, bound to the ``"{keyword}"`` parameter.
+
+    Parameters
+    ----------
+    keyword : str
+        The element keyword of the key to match.
+    statement : sqlalchemy.sql.Select
+        The statement within which this search should be performed.
+    plan : str, optional
+        How to find the candidates for matching, one of the plans from
+        :func:`_plan_wildcard`. ``"wildcard_prefix"`` uses the
+        ``"{keyword}_lower"`` and ``"{keyword}_upper"`` parameters,
+        ``"wildcard_name"`` and ``"wildcard_name_given"`` the parameters
+        from :func:`_name_candidates` and ``"wildcard_trigram"`` uses the
+        ``"{keyword}_trigram"`` parameter.
 
     Returns
     -------
-    sqlalchemy.orm.query.Query
-        The resulting query.
+    sqlalchemy.sql.Select
+        The resulting statement.
     """
-    if not elem.value:
-        return _search_universal(elem, session, query)
+    attr = _attribute(keyword, statement)
+    is_name = _ATTRIBUTES[keyword][2] == "PN"
+    if plan == "wildcard_prefix" and is_name:
+        column = _name_column(keyword, "norm")
+        statement = statement.where(
+            _level_filter(
+                keyword,
+                statement,
+                column >= bindparam(f"{keyword}_lower"),
+                column < bindparam(f"{keyword}_upper"),
+            )
+        )
+    elif plan == "wildcard_prefix":
+        statement = statement.where(
+            attr >= bindparam(f"{keyword}_lower"),
+            attr < bindparam(f"{keyword}_upper"),
+        )
+    elif plan.startswith("wildcard_name"):
+        statement = statement.where(
+            _name_candidates(keyword, statement, plan == "wildcard_name_given")
+        )
+    elif plan == "wildcard_trigram":
+        statement = statement.where(_trigram_candidates(keyword, statement))
+
+    if is_name:
+        return statement.where(attr.like(bindparam(keyword), escape="\\"))
+
+    return statement.where(attr.op("GLOB")(bindparam(keyword)))
+
+
+def _trigram_candidates(keyword, statement):
+    """Return a clause limiting `statement` to the trigram index candidates.
+
+    Parameters
+    ----------
+    keyword : str
+        The element keyword of the key to match.
+    statement : sqlalchemy.sql.Select
+        The statement within which this search should be performed.
 
-    attr = getattr(Instance, _TRANSLATION[elem.keyword])
-    if not query:
-        query = session.query(Instance)
+    Returns
+    -------
+    sqlalchemy.sql.ColumnElement
+        The clause to add to the statement.
+    """
+    table = _LEVEL_MODELS[_ATTRIBUTES[keyword][0]].__tablename__
+    fts = f"{table}_fts"
+    candidates = (
+        select(literal_column(f"{fts}.rowid"))
+        .select_from(text(fts))
+        .where(
+            literal_column(f"{fts}.{_TRANSLATION[keyword]}").like(
+                bindparam(f"{keyword}_trigram")
+            )
+        )
+    )
 
-    if elem.VM == 1:
-        return query.filter(attr == elem.value)
+    return _level_filter(
+        keyword, statement, literal_column(f"{table}.rowid").in_(candidates)
+    )
 
-    return query.filter(attr.in_(elem.value))
 
+def _search_name(keyword, statement):
+    """Add single value matching of a PN, bound to the ``"{keyword}"``
+    parameter.
 
-def _search_universal(elem, session, query=None):
-    """Perform a universal search for empty elements.
+    The normalized value is compared with the normalized name column, so the
+    matching is case-insensitive and ignores trailing delimiters.
 
     Parameters
     ----------
-    elem : pydicom.dataelem.DataElement
-        The attribute to perform the search with.
-    session : sqlalchemy.orm.session.Session
-        The session we are using to query the database.
-    query : sqlalchemy.orm.query.Query, optional
-        An existing query within which this search should be performed. If
-        not used then all the Instances in the database will be searched
-        (default).
+    keyword : str
+        The element keyword of the key to match.
+    statement : sqlalchemy.sql.Select
+        The statement within which this search should be performed.
 
     Returns
     -------
-    sqlalchemy.orm.query.Query
-        The resulting query.
+    sqlalchemy.sql.Select
+        The resulting statement.
     """
-    # If the value is zero length then all entities shall match
-    if not query:
-        query = session.query(Instance)
+    column = _name_column(keyword, "norm")
+    return statement.where(
+        _level_filter(keyword, statement, column == bindparam(keyword))
+    )
+
+
+def _name_candidates(keyword, statement, given=False):
+    """Return a clause limiting `statement` to the names with a family name
+    of ``"{keyword}_family"``.
 
-    return query
+    Parameters
+    ----------
+    keyword : str
+        The element keyword of the key to match.
+    statement : sqlalchemy.sql.Select
+        The statement within which this search should be performed.
+    given : bool, optional
+        If ``True`` then also limit to the given names between
+        ``"{keyword}_given_lower"`` and ``"{keyword}_given_upper"``.
+
+    Returns
+    -------
+    sqlalchemy.sql.ColumnElement
+        The clause to add to the statement.
+    """
+    criteria = [_name_column(keyword, "family") == bindparam(f"{keyword}_family")]
+    if given:
+        column = _name_column(keyword, "given")
+        criteria.append(column >= bindparam(f"{keyword}_given_lower"))
+        criteria.append(column < bindparam(f"{keyword}_given_upper"))
 
+    return _level_filter(keyword, statement, *criteria)
 
-def _search_wildcard(elem, session, query=None):
-    """Perform a wildcard search.
+
+def _name_column(keyword, part):
+    """Return the normalized name column for the PN element `keyword`.
 
     Parameters
     ----------
-    elem : pydicom.dataelem.DataElement
-        The attribute to perform the search with.
-    session : sqlalchemy.orm.session.Session
-        The session we are using to query the database.
-    query : sqlalchemy.orm.query.Query, optional
-        An existing query within which this search should be performed. If
-        not used then all the Instances in the database will be searched
-        (default).
+    keyword : str
+        The element keyword of a PN key.
+    part : str
+        One of ``"norm"``, ``"family"`` or ``"given"``.
 
     Returns
     -------
-    sqlalchemy.orm.query.Query
-        The resulting query.
+    sqlalchemy.orm.attributes.InstrumentedAttribute
+        The column from the table for the key's level.
     """
-    # Contains '*' or '?', case-sensitive if not PN
-    #   '*' shall match any sequence of characters (incl. zero length)
-    #   '?' shall match any single character
-    attr = getattr(Instance, _TRANSLATION[elem.keyword])
-    if elem.VR == "PN":
-        value = str(elem.value)
-    else:
-        value = elem.value
+    return _level_column(keyword, f"{_TRANSLATION[keyword]}_{part}")
+
+
+def _level_column(keyword, name):
+    """Return the column `name` from the table for the level of `keyword`."""
+    return getattr(_LEVEL_MODELS[_ATTRIBUTES[keyword][0]], name)
 
-    if value is None or value == "":
-        value = "*"
 
-    value = value.replace("*", "%")
-    value = value.replace("?", "_")
+def _level_filter(keyword, statement, *criteria):
+    """Return `criteria` on the table for the level of `keyword` as a clause
+    for `statement`.
 
-    if not query:
-        query = session.query(Instance)
+    Parameters
+    ----------
+    keyword : str
+        The element keyword of the key to match.
+    statement : sqlalchemy.sql.Select
+        The statement within which this search should be performed.
+    *criteria : sqlalchemy.sql.ColumnElement
+        The criteria, using the columns of the table for the key's level.
 
-    return query.filter(attr.like(value))
+    Returns
+    -------
+    sqlalchemy.sql.ColumnElement
+        The clause to add to the statement.
+    """
+    entity = statement.column_descriptions[0]["entity"]
+    if entity is not Instance:
+        # The table for the level is in the statement
+        return and_(*criteria)
+
+    # Match the instance to the records using the level's unique key
+    level = _ATTRIBUTES[keyword][0]
+    model = _LEVEL_MODELS[level]
+    unique = _TRANSLATION[_PATIENT_ROOT_ATTRIBUTES[level][0]]
+    keys = select(getattr(model, unique)).where(*criteria)
+    return getattr(Instance, unique).in_(keys)
+
+
+# The function used to add each type of matching to a statement
+_SEARCH = {
+    "universal": _search_universal,
+    "single": _search_single_value,
+    "name": _search_name,
+    "uid_list": _search_uid_list,
+    "wildcard": _search_wildcard,
+    "wildcard_prefix": partial(_search_wildcard, plan="wildcard_prefix"),
+    "wildcard_name": partial(_search_wildcard, plan="wildcard_name"),
+    "wildcard_name_given": partial(_search_wildcard, plan="wildcard_name_given"),
+    "wildcard_trigram": partial(_search_wildcard, plan="wildcard_trigram"),
+    "range": _search_range,
+    "range_single": _search_range,
+    "range_from": partial(_search_range, end=False),
+    "range_to": partial(_search_range, start=False),
+    "datetime_range": partial(_search_range, combined=True),
+    "datetime_range_from": partial(_search_range, end=False, combined=True),
+    "datetime_range_to": partial(_search_range, start=False, combined=True),
+}
 
 
 # Database table setup stuff
 Base = declarative_base()
 
 
+class _Record:
+    """Identifier construction shared by the tables for each level."""
+
+    # The Query Retrieve Level of the table
+    _level = None
+
+    @property
+    def _parent(self):
+        """Return the record for the level above, if any."""
+        return None
+
+    def _value(self, keyword):
+        """Return the value for `keyword` from the record at its level."""
+        level = _ATTRIBUTES[keyword][0]
+        record = self
+        while record is not None and record._level != level:
+            record = record._parent
+
+        if record is None:
+            return None
+
+        return getattr(record, _TRANSLATION[keyword], None)
+
+    def as_identifier(self, identifier, model):
+        """Return an Identifier dataset matching the elements from a query.
+
+        Parameters
+        ----------
+        identifier : pydicom.dataset.Dataset
+            The C-FIND, C-GET or C-MOVE request's *Identifier* dataset.
+        model : pydicom.uid.UID
+            The Query/Retrieve Information Model.
+
+        Returns
+        -------
+        pydicom.dataset.Dataset
+            The response *Identifier*.
+        """
+        ds = Dataset()
+        ds.QueryRetrieveLevel = identifier.QueryRetrieveLevel
+        for kw in _response_keywords(model, identifier):
+            setattr(ds, kw, self._value(kw))
+
+        return ds
+
+
 class Image(Base):
     __tablename__ = "image"
     # (0008,0018) SOP Instance UID | VR UI, VM 1, U
     sop_instance_uid = Column(String(64), primary_key=True)
+    # (0020,000E) Series Instance UID | VR UI, VM 1, U
+    series_instance_uid = Column(
+        String(64), ForeignKey("series.series_instance_uid"), index=True
+    )
     # (0020,0013) Instance Number | VR IS, VM 1, R
     instance_number = Column(Integer)
 
 
-class Instance(Base):
+class Instance(_Record, Base):
     __tablename__ = "instance"
+    __table_args__ = (
+        # Patient Root hierarchical search: PATIENT -> STUDY -> SERIES
+        Index(
+            "ix_instance_patient_study_series",
+            "patient_id",
+            "study_instance_uid",
+            "series_instance_uid",
+        ),
+        # Study Root hierarchical search: STUDY -> SERIES
+        Index(
+            "ix_instance_study_series",
+            "study_instance_uid",
+            "series_instance_uid",
+        ),
+        Index("ix_instance_series_instance_uid", "series_instance_uid"),
+        # Required keys
+        Index("ix_instance_patient_name", "patient_name"),
+        Index("ix_instance_study_date", "study_date", "study_time"),
+        Index("ix_instance_accession_number", "accession_number"),
+        Index("ix_instance_modality", "modality"),
+    )
+    _level = "IMAGE"
 
     # Absolute path to the stored SOP Instance
     filename = Column(String)
@@ -727,44 +2734,11 @@ class Instance(Base):
     )
     instance_number = Column(String, ForeignKey("image.instance_number"))
 
-    def as_identifier(self, identifier, model):
-        """Return an Identifier dataset matching the elements from a query.
-
-        Parameters
-        ----------
-        identifier : pydicom.dataset.Dataset
-            The C-FIND, C-GET or C-MOVE request's *Identifier* dataset.
-        model : pydicom.uid.UID
-            The Query/Retrieve Information Model.
-
-        Returns
-        -------
-        pydicom.dataset.Dataset
-            The response *Identifier*.
+    def _value(self, keyword):
+        """Return the value for `keyword`, the instance table includes the
+        attributes for every level.
         """
-        ds = Dataset()
-        ds.QueryRetrieveLevel = identifier.QueryRetrieveLevel
-
-        if model in _PATIENT_ROOT:
-            attr = _PATIENT_ROOT[model]
-        else:
-            attr = _STUDY_ROOT[model]
-
-        all_keywords = []
-        for level, keywords in attr.items():
-            all_keywords.extend(keywords)
-            if level == identifier.QueryRetrieveLevel:
-                break
-
-        for kw in [kw for kw in all_keywords if kw in identifier]:
-            try:
-                attribute = _TRANSLATION[kw]
-            except KeyError:
-                continue
-
-            setattr(ds, kw, getattr(self, attribute, None))
-
-        return ds
+        return getattr(self, _TRANSLATION[keyword], None)
 
     @property
     def context(self):
@@ -789,33 +2763,86 @@ class Instance(Base):
         return build_context(self.sop_class_uid, self.transfer_syntax_uid)
 
 
-class Patient(Base):
+class Patient(_Record, Base):
     __tablename__ = "patient"
+    __table_args__ = (
+        Index(
+            "ix_patient_patient_name_components",
+            "patient_name_family",
+            "patient_name_given",
+        ),
+    )
+    _level = "PATIENT"
+
     # (0010,0020) Patient ID | VR LO, VM 1, U
     patient_id = Column(String(64), primary_key=True)
     # (0010,0010) Patient's Name | VR PN, VM 1, R
     patient_name = Column(String(400))
+    # The upper case name without trailing delimiters, used for matching
+    patient_name_norm = Column(String(400), index=True)
+    # The normalized family and given names from the alphabetic group
+    patient_name_family = Column(String(64))
+    patient_name_given = Column(String(64))
 
 
-class Series(Base):
+class Series(_Record, Base):
     __tablename__ = "series"
+    _level = "SERIES"
+
     # (0020,000E) Series Instance UID | VR UI, VM 1, U
     series_instance_uid = Column(String(64), primary_key=True)
+    # (0020,000D) Study Instance UID | VR UI, VM 1, U
+    study_instance_uid = Column(
+        String(64), ForeignKey("study.study_instance_uid"), index=True
+    )
     # (0008,0060) Modality | VR CS, VM 1, R
-    modality = Column(String(16))
+    modality = Column(String(16), index=True)
     # (0020,0011) Series Number | VR IS, VM 1, R
     series_number = Column(Integer)
 
+    study = relationship("Study")
 
-class Study(Base):
+    @property
+    def _parent(self):
+        return self.study
+
+
+class Study(_Record, Base):
     __tablename__ = "study"
+    __table_args__ = (
+        Index("ix_study_study_date_value", "study_date_value", "study_time_value"),
+    )
+    _level = "STUDY"
+
     # (0020,000D) Study Instance UID | VR UI, VM 1, U
     study_instance_uid = Column(String(64), primary_key=True)
+    # (0010,0020) Patient ID | VR LO, VM 1, U
+    patient_id = Column(String(64), ForeignKey("patient.patient_id"), index=True)
     # (0008,0020) Study Date | VR DA, VM 1, R
     study_date = Column(String(8))
     # (0008,0030) Study Time | VR TM, VM 1, R
     study_time = Column(String(14))
+    # The date as YYYYMMDD, time as microseconds since midnight and combined
+    #   datetime as microseconds since 0001-01-01, used for range matching
+    study_date_value = Column(Integer)
+    study_time_value = Column(Integer)
+    study_datetime_value = Column(Integer, index=True)
     # (0008,0050) Accession Number | VR SH, VM 1, R
-    accession_number = Column(String(16))
+    accession_number = Column(String(16), index=True)
     # (0020,0010) Study ID | VR SH, VM 1, R
-    study_id = Column(String(16))
+    study_id = Column(String(16), index=True)
+
+    patient = relationship("Patient")
+
+    @property
+    def _parent(self):
+        return self.patient
+
+
+# The table searched for each C-FIND Query Retrieve Level
+_LEVEL_MODELS = {
+    "PATIENT": Patient,
+    "STUDY": Study,
+    "SERIES": Series,
+    "IMAGE": Instance,
+}
@@ -1,12 +1,13 @@
+from functools import partial
 import os
 from pydicom import dcmread
 from pydicom.dataset import Dataset
 from pynetdicom.sop_class import ModalityPerformedProcedureStep
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
-
-from db import add_instance, search, InvalidIdentifier, Instance
+from db import add_instance, InvalidIdentifier, Instance
+from registry import Cancellation
+import tracing
+import worklist
 
 managed_instances = {}
 
@@ -39,64 +40,76 @@ def handle_echo(event):
 
 
 def handle_create(event):
-    # MPPS' N-CREATE request must have an *Affected SOP Instance UID*
-    req = event.request
-    if req.AffectedSOPInstanceUID is None:
-        # Failed - invalid attribute value
-        return 0x0106, None
-
-    # Can't create a duplicate SOP Instance
-    if req.AffectedSOPInstanceUID in managed_instances:
-        # Failed - duplicate SOP Instance
-        return 0x0111, None
-
-    # The N-CREATE request's *Attribute List* dataset
-    attr_list = event.attribute_list
-
-    # Performed Procedure Step Status must be 'IN PROGRESS'
-    if "PerformedProcedureStepStatus" not in attr_list:
-        # Failed - missing attribute
-        return 0x0120, None
-    if attr_list.PerformedProcedureStepStatus.upper() != 'IN PROGRESS':
-        return 0x0106, None
-
-    # Skip other tests...
-
-    # Create a Modality Performed Procedure Step SOP Class Instance
-    #   DICOM Standard, Part 3, Annex B.17
-    ds = Dataset()
-
-    # Add the SOP Common module elements (Annex C.12.1)
-    ds.SOPClassUID = ModalityPerformedProcedureStep
-    ds.SOPInstanceUID = req.AffectedSOPInstanceUID
-
-    # Update with the requested attributes
-    ds.update(attr_list)
-
-    # Add the dataset to the managed SOP Instances
-    managed_instances[ds.SOPInstanceUID] = ds
-
-    # Return status, dataset
-    return 0x0000, ds
+    trace = tracing.TRACER.start(ModalityPerformedProcedureStep)
+    try:
+        # MPPS' N-CREATE request must have an *Affected SOP Instance UID*
+        req = event.request
+        if req.AffectedSOPInstanceUID is None:
+            # Failed - invalid attribute value
+            return 0x0106, None
+
+        # Can't create a duplicate SOP Instance
+        if req.AffectedSOPInstanceUID in managed_instances:
+            # Failed - duplicate SOP Instance
+            return 0x0111, None
+
+        # The N-CREATE request's *Attribute List* dataset
+        attr_list = event.attribute_list
+
+        # Performed Procedure Step Status must be 'IN PROGRESS'
+        if "PerformedProcedureStepStatus" not in attr_list:
+            # Failed - missing attribute
+            return 0x0120, None
+        if attr_list.PerformedProcedureStepStatus.upper() != 'IN PROGRESS':
+            return 0x0106, None
+
+        # Skip other tests...
+        trace.mark("validate")
+
+        # Create a Modality Performed Procedure Step SOP Class Instance
+        #   DICOM Standard, Part 3, Annex B.17
+        ds = Dataset()
+
+        # Add the SOP Common module elements (Annex C.12.1)
+        ds.SOPClassUID = ModalityPerformedProcedureStep
+        ds.SOPInstanceUID = req.AffectedSOPInstanceUID
+
+        # Update with the requested attributes
+        ds.update(attr_list)
+
+        # Add the dataset to the managed SOP Instances
+        managed_instances[ds.SOPInstanceUID] = ds
+        trace.mark("store")
+
+        # Return status, dataset
+        return 0x0000, ds
+    finally:
+        trace.finish()
     
 # Implement the evt.EVT_N_SET handler
 def handle_set(event):
-    req = event.request
-    if req.RequestedSOPInstanceUID not in managed_instances:
-        # Failure - SOP Instance not recognised
-        return 0x0112, None
+    trace = tracing.TRACER.start(ModalityPerformedProcedureStep)
+    try:
+        req = event.request
+        if req.RequestedSOPInstanceUID not in managed_instances:
+            # Failure - SOP Instance not recognised
+            return 0x0112, None
 
-    ds = managed_instances[req.RequestedSOPInstanceUID]
+        ds = managed_instances[req.RequestedSOPInstanceUID]
 
-    # The N-SET request's *Modification List* dataset
-    mod_list = event.attribute_list
+        # The N-SET request's *Modification List* dataset
+        mod_list = event.attribute_list
 
-    # Skip other tests...
+        # Skip other tests...
+        trace.mark("validate")
 
-    ds.update(mod_list)
+        ds.update(mod_list)
+        trace.mark("store")
 
-    # Return status, dataset
-    return 0x0000, ds
+        # Return status, dataset
+        return 0x0000, ds
+    finally:
+        trace.finish()
 
 # def handle_create(event, db_path, cli_config):
 #     # MPPS' N-CREATE request must have an *Affected SOP Instance UID*
@@ -167,15 +180,15 @@ def handle_set(event):
         
 #         return 0x0000, ds
             
-def handle_find(event, db_path, cli_config):
+def handle_find(event, registry, cli_config):
     """Handler for evt.EVT_C_FIND.
 
     Parameters
     ----------
     event : pynetdicom.events.Event
         The C-FIND request :class:`~pynetdicom.events.Event`.
-    db_path : str
-        The database path to use with create_engine().
+    registry : registry.SessionRegistry
+        The process-wide registry to check database sessions out of.
     cli_config : dict
         A :class:`dict` containing configuration settings passed via CLI.
     logger : logging.Logger
@@ -196,56 +209,81 @@ def handle_find(event, db_path, cli_config):
     model = event.request.AffectedSOPClassUID
     print(model)
 
-    if model.keyword in (
-        "UnifiedProcedureStepPull",
-        "ModalityWorklistInformationModelFind",
-    ):
+    if model.keyword == "UnifiedProcedureStepPull":
         yield 0x0000, None
     else:
-        engine = create_engine(db_path)
-        with engine.connect() as conn:  # noqa: F841
-            Session = sessionmaker(bind=engine)
-            session = Session()
-            # Search database using Identifier as the query
-            try:
-                matches = search(model, event.identifier, session)
-
-            except InvalidIdentifier as exc:
-                session.rollback()
-                # logger.error("Invalid C-FIND Identifier received")
-                # logger.error(str(exc))
-                print("Invalid C-FIND Identifier received")
-                print(str(exc))
-                yield 0xA900, None
-                return
-            except Exception as exc:
-                session.rollback()
-                # logger.error("Exception occurred while querying database")
-                # logger.exception(exc)
-                print("Exception occurred while querying database")
-                print(exc)
-                yield 0xC320, None
-                return
-            finally:
-                session.close()
-
-        # Yield results
-        for match in matches:
-            if event.is_cancelled:
-                yield 0xFE00, None
-                return
-
-            try:
-                response = match.as_identifier(event.identifier, model)
-                response.RetrieveAETitle = event.assoc.ae.ae_title
-            except Exception as exc:
-                # logger.error("Error creating response Identifier")
-                # logger.exception(exc)
-                print("Error creating response Identifier")
-                print(exc)
-                yield 0xC322, None
-
-            yield 0xFF00, response
-
-
-
+        if model.keyword == "ModalityWorklistInformationModelFind":
+            # The worklist is always searched in the database
+            find = worklist.iter_identifiers
+        else:
+            find = partial(
+                registry.backend.iter_identifiers,
+                model,
+                RetrieveAETitle=event.assoc.ae.ae_title,
+            )
+
+        # Interrupt the query if the C-FIND is cancelled or the association
+        #   aborted while it's running
+        cancellation = Cancellation(
+            lambda: event.is_cancelled or event.assoc.acse.is_aborted()
+        )
+        trace = tracing.TRACER.start(model)
+        try:
+            # The session stays open while the matches are streamed to the peer
+            with registry.session(cancellation) as session:
+                trace.mark("session")
+                # Search database using Identifier as the query
+                try:
+                    # Executes the query, rows are then fetched in batches
+                    responses = iter(find(event.identifier, session, trace=trace))
+
+                except InvalidIdentifier as exc:
+                    session.rollback()
+                    # logger.error("Invalid C-FIND Identifier received")
+                    # logger.error(str(exc))
+                    print("Invalid C-FIND Identifier received")
+                    print(str(exc))
+                    yield 0xA900, None
+                    return
+                except Exception as exc:
+                    session.rollback()
+                    if cancellation.triggered:
+                        print(f"C-FIND from {addr}:{port} cancelled, query aborted")
+                        yield 0xFE00, None
+                        return
+
+                    # logger.error("Exception occurred while querying database")
+                    # logger.exception(exc)
+                    print("Exception occurred while querying database")
+                    print(exc)
+                    yield 0xC320, None
+                    return
+
+                # Yield results
+                while True:
+                    if event.is_cancelled:
+                        yield 0xFE00, None
+                        return
+
+                    try:
+                        response = next(responses, None)
+                    except Exception as exc:
+                        if cancellation.triggered:
+                            print(f"C-FIND from {addr}:{port} cancelled, query aborted")
+                            yield 0xFE00, None
+                            return
+
+                        # logger.error("Error creating response Identifier")
+                        # logger.exception(exc)
+                        print("Error creating response Identifier")
+                        print(exc)
+                        yield 0xC322, None
+                        return
+
+                    if response is None:
+                        return
+
+                    yield 0xFF00, response
+                    trace.mark("yield")
+        finally:
+            trace.finish()
@@ -0,0 +1,313 @@
+"""Index a directory tree of DICOM files into the qrscp database.
+
+The file headers are parsed in a process pool and the results are passed
+through a bounded queue to a single writer thread, which adds them to the
+database in chunked transactions using ``db.add_instances()``::
+
+    python app/indexer.py /path/to/archive --database-location data.sqlite
+"""
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+import queue
+import threading
+import time
+
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+
+import db
+from registry import SessionRegistry
+
+
+# The elements needed by db.add_instances()
+_KEYWORDS = [keyword for _, keyword, _, _ in db._REQUIRED] + ["SOPClassUID"]
+
+
+def _setup_argparser():
+    parser = argparse.ArgumentParser(
+        description="Index a directory tree of DICOM files into the database"
+    )
+    parser.add_argument(
+        "directory", help="the directory to search for DICOM files", type=str
+    )
+    parser.add_argument(
+        "--database-location",
+        metavar="[f]ile",
+        help="the location of the database (default: data.sqlite)",
+        type=str,
+        default="data.sqlite",
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="[n]umber",
+        help="number of header parsing processes (default: number of CPUs)",
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "--batch-size",
+        metavar="[n]umber",
+        help="number of files parsed per worker task (default: 256)",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        metavar="[n]umber",
+        help="number of instances written per transaction (default: 5000)",
+        type=int,
+        default=5000,
+    )
+    parser.add_argument(
+        "--queue-size",
+        metavar="[n]umber",
+        help="maximum number of parsed batches waiting to be written (default: 64)",
+        type=int,
+        default=64,
+    )
+    parser.add_argument(
+        "--database-profile",
+        help="the SQLite performance profile (default: default)",
+        choices=list(db.SQLITE_PROFILES),
+        default="default",
+    )
+
+    return parser.parse_args()
+
+
+def _walk(directory):
+    """Yield the paths to every file under `directory`."""
+    for root, _, files in os.walk(directory):
+        for fname in files:
+            yield os.path.abspath(os.path.join(root, fname))
+
+
+def _batches(paths, size):
+    """Yield lists of up to `size` items from `paths`."""
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def _read_headers(paths):
+    """Return the indexed elements for each DICOM file in `paths`.
+
+    Runs in the worker processes, so only the elements needed for the
+    database are kept to minimise the pickling between processes.
+
+    Parameters
+    ----------
+    paths : list of str
+        The files to read.
+
+    Returns
+    -------
+    list of (pydicom.dataset.Dataset, str)
+        The parsed datasets and their paths, files that aren't DICOM or
+        can't be read are skipped.
+    """
+    results = []
+    for path in paths:
+        try:
+            ds = dcmread(path, stop_before_pixels=True, specific_tags=_KEYWORDS)
+        except (InvalidDicomError, OSError, ValueError, EOFError):
+            continue
+
+        slim = Dataset()
+        for keyword in _KEYWORDS:
+            if keyword in ds:
+                slim[keyword] = ds[keyword]
+
+        slim.file_meta = ds.file_meta
+        results.append((slim, path))
+
+    return results
+
+
+class _Progress:
+    """Track and print the number of files parsed and written."""
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.start = time.perf_counter()
+        self._last = self.start
+        self.parsed = 0
+        # Files that aren't DICOM or can't be read, counted by the main thread
+        self.unreadable = 0
+        # Datasets without a unique key or with invalid values, counted by
+        #   the writer
+        self.invalid = 0
+        self.written = 0
+
+    @property
+    def skipped(self):
+        return self.unreadable + self.invalid
+
+    def update(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self._last < self.interval:
+            return
+
+        self._last = now
+        elapsed = now - self.start
+        rate = self.parsed / elapsed if elapsed else 0.0
+        print(
+            f"{self.parsed} files parsed, {self.written} instances written, "
+            f"{self.skipped} skipped, {rate:.0f} files/s"
+        )
+
+
+def _writer(registry, results, chunk_size, progress, errors):
+    """Add the parsed datasets from the `results` queue to the database.
+
+    If writing fails the exception is added to `errors` and the rest of the
+    queue is discarded, so the parsing never blocks on a full queue.
+    """
+    batch = []
+    try:
+        with registry.session() as session:
+            chunk = []
+            while batch is not None:
+                batch = results.get()
+                if batch is not None:
+                    chunk.extend(batch)
+                    if len(chunk) < chunk_size:
+                        continue
+
+                written = db.add_instances(chunk, session, chunk_size)
+                progress.written += written
+                progress.invalid += len(chunk) - written
+                chunk = []
+    except Exception as exc:
+        errors.append(exc)
+        while batch is not None:
+            batch = results.get()
+
+
+def index_directory(
+    directory,
+    registry,
+    workers=None,
+    batch_size=256,
+    chunk_size=5000,
+    queue_size=64,
+):
+    """Add every DICOM file under `directory` to the database.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to search for DICOM files.
+    registry : registry.SessionRegistry
+        The registry for the database to add the instances to.
+    workers : int, optional
+        The number of header parsing processes, defaults to the number of
+        CPUs.
+    batch_size : int, optional
+        The number of files parsed per worker task (default ``256``).
+    chunk_size : int, optional
+        The number of instances written per transaction (default ``5000``).
+    queue_size : int, optional
+        The maximum number of parsed batches waiting to be written (default
+        ``64``). When the writer falls behind the parsing is paused.
+
+    Returns
+    -------
+    _Progress
+        The number of files parsed, skipped and written.
+
+    Raises
+    ------
+    Exception
+        The exception raised by the writer if the instances can't be added,
+        such as a :class:`sqlalchemy.exc.OperationalError` if the database
+        is locked. The parsing is stopped and the transactions already
+        committed are kept.
+    """
+    workers = workers or os.cpu_count()
+    progress = _Progress()
+    results = queue.Queue(maxsize=queue_size)
+    # The writer's exception, if it fails
+    errors = []
+    writer = threading.Thread(
+        target=_writer, args=(registry, results, chunk_size, progress, errors)
+    )
+    writer.start()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # The number of files for each task in flight
+            pending = {}
+            for batch in _batches(_walk(directory), batch_size):
+                # Keep at most two tasks per worker in flight
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    _collect(done, pending, results, progress, errors)
+
+                pending[executor.submit(_read_headers, batch)] = len(batch)
+
+            _collect(list(pending), pending, results, progress, errors)
+    finally:
+        results.put(None)
+        writer.join()
+
+    if errors:
+        # The last chunk is written after the parsing has finished
+        raise errors[0]
+
+    progress.update(force=True)
+
+    return progress
+
+
+def _collect(futures, pending, results, progress, errors):
+    """Pass the parsed datasets from completed `futures` to the writer."""
+    for future in futures:
+        if errors:
+            # Stop parsing if the writer has failed
+            for other in pending:
+                other.cancel()
+
+            raise errors[0]
+
+        nr_files = pending.pop(future)
+        batch = future.result()
+        progress.parsed += nr_files
+        progress.unreadable += nr_files - len(batch)
+        # Blocks when the writer is behind
+        results.put(batch)
+        progress.update()
+
+
+def main():
+    args = _setup_argparser()
+
+    db_path = os.path.abspath(args.database_location)
+    registry = SessionRegistry(
+        f"sqlite:///{db_path}", profile=args.database_profile
+    )
+    progress = index_directory(
+        args.directory,
+        registry,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        chunk_size=args.chunk_size,
+        queue_size=args.queue_size,
+    )
+    registry.dispose()
+
+    elapsed = time.perf_counter() - progress.start
+    print(f"Indexed {progress.written} instances in {elapsed:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,703 @@
+"""An in-memory columnar index for the qrscp database.
+
+:class:`ColumnarIndex` keeps a copy of the patient, study, series and
+instance tables in memory and answers Query/Retrieve searches without
+querying the database. It has the same interface as the ``db`` module's
+``search()``, ``iter_search()``, ``iter_identifiers()``, ``add_instance()``,
+``add_instances()`` and ``remove_instance()``, so either can be used as the
+search backend of a :class:`registry.SessionRegistry`.
+
+Each table column is dictionary-encoded, with the distinct values stored
+once and each row holding an integer code in an ``array``. The matching for
+a key is evaluated once per distinct value to give the set of matching
+codes, which is then used to select the rows, so a wildcard or range key
+only has to be tested against each value once no matter how many rows
+share it.
+"""
+
+from array import array
+from collections import Counter, defaultdict
+from itertools import compress
+import re
+import threading
+
+from sqlalchemy import Integer, select
+
+import db
+from tracing import NULL_TRACE
+
+
+# The tables for each level, in hierarchy order
+_MODELS = {
+    "PATIENT": db.Patient,
+    "STUDY": db.Study,
+    "SERIES": db.Series,
+    "IMAGE": db.Instance,
+}
+
+# The column with the unique key of the parent record for each level
+_PARENT = {"STUDY": "patient_id", "SERIES": "study_instance_uid"}
+
+
+class _Column:
+    """A dictionary-encoded column.
+
+    The code for ``None`` is always ``0``.
+    """
+
+    def __init__(self, integer=False):
+        # Whether the database column is an INTEGER
+        self.integer = integer
+        self.codes = array("l")
+        self.values = [None]
+        self._lookup = {None: 0}
+
+    def encode(self, value):
+        """Return the code for `value`, adding it to the dictionary if new."""
+        code = self._lookup.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self._lookup[value] = code
+
+        return code
+
+    def stored(self, value):
+        """Return `value` as it would be stored in the database column."""
+        if value is None:
+            return None
+
+        # IS and DS values are int and float subclasses
+        if isinstance(value, int):
+            value = int(value)
+
+        return int(value) if self.integer else str(value)
+
+    def matching_codes(self, kind, arg):
+        """Return the codes of the values that match a criterion.
+
+        Parameters
+        ----------
+        kind : str
+            ``"in"`` if `arg` is a collection of the values to match or
+            ``"match"`` if `arg` is a callable that returns ``True`` for the
+            values to match. ``None`` is never matched.
+        arg : collection or callable
+            The values or test to match against.
+
+        Returns
+        -------
+        set of int
+            The matching codes.
+        """
+        if kind == "in":
+            codes = (self._lookup.get(self.stored(value)) for value in arg)
+            return {code for code in codes if code}
+
+        return {
+            code
+            for code, value in enumerate(self.values)
+            if value is not None and arg(value)
+        }
+
+    def filter(self, codes, rows=None):
+        """Return the `rows` whose code is in `codes`.
+
+        Parameters
+        ----------
+        codes : set of int
+            The codes to keep.
+        rows : list of int, optional
+            The rows to filter, if not used then every row is filtered.
+
+        Returns
+        -------
+        list of int
+            The rows with a matching code, in row order.
+        """
+        column = self.codes
+        if rows is not None:
+            return [row for row in rows if column[row] in codes]
+
+        if len(codes) == 1:
+            test = next(iter(codes)).__eq__
+        else:
+            test = codes.__contains__
+
+        return list(compress(range(len(column)), map(test, column)))
+
+
+class _Table:
+    """The columns for one of the database tables.
+
+    Rows are removed by moving the last row into their place, so the row
+    numbers aren't stable across removals.
+
+    Parameters
+    ----------
+    model : type
+        The table class, such as :class:`db.Patient`.
+    """
+
+    def __init__(self, model):
+        self.key = model.__mapper__.primary_key[0].key
+        self.columns = {
+            attr.key: _Column(isinstance(attr.columns[0].type, Integer))
+            for attr in model.__mapper__.column_attrs
+        }
+        # The row for each primary key value
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, row, name):
+        """Return the value of column `name` in `row`."""
+        column = self.columns[name]
+        return column.values[column.codes[row]]
+
+    def record(self, row):
+        """Return the values of `row` as ``{column name: value}``."""
+        return {name: self.get(row, name) for name in self.columns}
+
+    def upsert(self, values, stored=False):
+        """Add or update the row for a record.
+
+        Parameters
+        ----------
+        values : dict
+            The values of the record as ``{column name: value}``, which
+            must include the primary key. Missing columns are ``None`` for a
+            new row and unchanged otherwise.
+        stored : bool, optional
+            If ``True`` then the values are already as stored in the
+            database (default ``False``).
+        """
+        key = values[self.key]
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = len(self.rows)
+            for column in self.columns.values():
+                column.codes.append(0)
+
+        for name, value in values.items():
+            column = self.columns[name]
+            if not stored:
+                value = column.stored(value)
+
+            column.codes[row] = column.encode(value)
+
+    def remove(self, key):
+        """Remove the row with primary key `key`, if there is one."""
+        row = self.rows.pop(key, None)
+        if row is None:
+            return
+
+        last = len(self.rows)
+        for column in self.columns.values():
+            column.codes[row] = column.codes[last]
+            column.codes.pop()
+
+        if row != last:
+            self.rows[self.get(row, self.key)] = row
+
+    def select(self, criteria):
+        """Return the rows matching all of the `criteria`.
+
+        Parameters
+        ----------
+        criteria : list of (str, str, object)
+            The (column name, kind, arg) for each criterion, with the `kind`
+            and `arg` as used with :meth:`_Column.matching_codes`.
+
+        Returns
+        -------
+        list of int
+            The matching rows, in row order.
+        """
+        if not criteria:
+            return list(range(len(self.rows)))
+
+        matching = []
+        for name, kind, arg in criteria:
+            codes = self.columns[name].matching_codes(kind, arg)
+            if not codes:
+                return []
+
+            matching.append((len(codes), name, codes))
+
+        # Start with the criteria with the fewest distinct matching values
+        rows = None
+        for _, name, codes in sorted(matching, key=lambda item: item[0]):
+            rows = self.columns[name].filter(codes, rows)
+            if not rows:
+                return []
+
+        return rows
+
+    def keys(self, rows):
+        """Return the primary keys of `rows` as a :class:`set`."""
+        return {self.get(row, self.key) for row in rows}
+
+
+class ColumnarIndex:
+    """An in-memory index of the database that can be searched.
+
+    Searches give the same matches as the database, as each table is kept
+    in memory and the matching for each type of key follows the SQL used by
+    ``db.build_query()``.
+
+    The index isn't persistent, it's loaded from the database with
+    :meth:`load` and when a session is passed to :meth:`add_instance` or
+    :meth:`remove_instance` the database is updated as well.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self, session=None):
+        """Remove everything from the index.
+
+        Parameters
+        ----------
+        session : sqlalchemy.orm.session.Session, optional
+            If used then the database is also cleared.
+        """
+        with self._lock:
+            if session is not None:
+                db.clear(session)
+
+            self._tables = {level: _Table(model) for level, model in _MODELS.items()}
+            # The number of instances for each patient, study and series
+            self._counts = {
+                level: Counter() for level in ("PATIENT", "STUDY", "SERIES")
+            }
+
+    def load(self, session):
+        """Replace the contents of the index with those of the database.
+
+        Parameters
+        ----------
+        session : sqlalchemy.orm.session.Session
+            The session to use to read the database.
+        """
+        with self._lock:
+            self.clear()
+            for level, model in _MODELS.items():
+                table = self._tables[level]
+                names = list(table.columns)
+                columns = [getattr(model, name) for name in names]
+                for row in session.execute(select(*columns)):
+                    table.upsert(dict(zip(names, row)), stored=True)
+
+            instances = self._tables["IMAGE"]
+            for row in range(len(instances)):
+                self._count(instances.record(row), 1)
+
+    def _count(self, values, change):
+        """Update the number of instances for the hierarchy of an instance."""
+        for level, counts in self._counts.items():
+            key = values[self._tables[level].key]
+            counts[key] += change
+            if counts[key] <= 0:
+                del counts[key]
+
+    def add_instance(self, ds, session=None, fpath=None):
+        """Add a SOP Instance to the index or update an existing instance.
+
+        Parameters
+        ----------
+        ds : pydicom.dataset.Dataset
+            The SOP Instance to be added.
+        session : sqlalchemy.orm.session.Session, optional
+            If used then the instance is also added to the database.
+        fpath : str, optional
+            The path to where the SOP Instance is stored.
+        """
+        if session is not None:
+            db.add_instance(ds, session, fpath)
+
+        with self._lock:
+            self._add(db._instance_values(ds, fpath))
+
+    def add_instances(self, datasets, session=None, chunk_size=1000):
+        """Add SOP Instances to the index or update existing instances.
+
+        Parameters
+        ----------
+        datasets : iterable of pydicom.dataset.Dataset or (Dataset, str)
+            The SOP Instances to be added, optionally paired with the path to
+            where the SOP Instance is stored.
+        session : sqlalchemy.orm.session.Session, optional
+            If used then the instances are also added to the database.
+        chunk_size : int, optional
+            The number of instances to write per transaction (default
+            ``1000``).
+
+        Returns
+        -------
+        int
+            The number of instances added or updated. Datasets that are
+            missing a unique key or have invalid values are skipped.
+        """
+        items = []
+        for item in datasets:
+            ds, fpath = item if isinstance(item, tuple) else (item, None)
+            try:
+                items.append(((ds, fpath), db._instance_values(ds, fpath)))
+            except (AssertionError, AttributeError, KeyError, TypeError):
+                continue
+
+        if session is not None:
+            db.add_instances([item for item, _ in items], session, chunk_size)
+
+        with self._lock:
+            for _, values in items:
+                self._add(values)
+
+        return len(items)
+
+    def _add(self, values):
+        """Add or update an instance and its hierarchy, the same as
+        ``db._update_hierarchy()``.
+        """
+        instances = self._tables["IMAGE"]
+        row = instances.rows.get(values["sop_instance_uid"])
+        if row is not None:
+            self._count(instances.record(row), -1)
+
+        instances.upsert(values)
+        self._count(values, 1)
+
+        patient = {
+            "patient_id": values["patient_id"],
+            "patient_name": values["patient_name"],
+        }
+        patient.update(db._name_values(values["patient_name"]))
+        self._tables["PATIENT"].upsert(patient)
+
+        study = {
+            name: values[name]
+            for name in (
+                "study_instance_uid",
+                "patient_id",
+                "study_date",
+                "study_time",
+                "accession_number",
+                "study_id",
+            )
+        }
+        study.update(db._date_time_values(values["study_date"], values["study_time"]))
+        self._tables["STUDY"].upsert(study)
+
+        series = {
+            name: values[name]
+            for name in (
+                "series_instance_uid",
+                "study_instance_uid",
+                "modality",
+                "series_number",
+            )
+        }
+        self._tables["SERIES"].upsert(series)
+
+    def remove_instance(self, instance_uid, session=None):
+        """Remove a SOP Instance from the index.
+
+        The series, study and patient are also removed if they no longer
+        contain any instances.
+
+        Parameters
+        ----------
+        instance_uid : pydicom.uid.UID
+            The (0008,0018) *SOP Instance UID* of the SOP Instance to be
+            removed.
+        session : sqlalchemy.orm.session.Session, optional
+            If used then the instance is also removed from the database.
+        """
+        if session is not None:
+            db.remove_instance(instance_uid, session)
+
+        with self._lock:
+            instances = self._tables["IMAGE"]
+            row = instances.rows.get(str(instance_uid))
+            if row is None:
+                return
+
+            values = instances.record(row)
+            instances.remove(values["sop_instance_uid"])
+            self._count(values, -1)
+            for level in ("SERIES", "STUDY", "PATIENT"):
+                key = values[self._tables[level].key]
+                if key in self._counts[level]:
+                    return
+
+                self._tables[level].remove(key)
+
+    def search(self, model, identifier, session=None):
+        """Search the index.
+
+        Parameters
+        ----------
+        model : pydicom.uid.UID
+            The Query/Retrieve Information Model, as used with
+            ``db.search()``.
+        identifier : pydicom.dataset.Dataset
+            The Query/Retrieve request's *Identifier* dataset.
+        session : sqlalchemy.orm.session.Session, optional
+            Not used, for compatibility with ``db.search()``.
+
+        Returns
+        -------
+        list of db.Patient, db.Study, db.Series or db.Instance
+            For C-FIND, the records at the requested Query Retrieve Level
+            that match the query. For C-GET and C-MOVE the matching
+            Instances. The records aren't attached to a session.
+
+        Raises
+        ------
+        ValueError
+            If the `identifier` is invalid.
+        """
+        db._prepare_identifier(model, identifier)
+        with self._lock:
+            level, rows = self._select(model, identifier)
+            return [self._record(level, row) for row in rows]
+
+    def iter_search(self, model, identifier, session=None, batch_size=500):
+        """Search the index, as with ``db.iter_search()``."""
+        return iter(self.search(model, identifier, session))
+
+    def iter_identifiers(
+        self,
+        model,
+        identifier,
+        session=None,
+        batch_size=500,
+        trace=NULL_TRACE,
+        **extra,
+    ):
+        """Search the index, returning the response *Identifier* for each match.
+
+        Parameters
+        ----------
+        model : pydicom.uid.UID
+            The Query/Retrieve Information Model, as used with
+            ``db.search()``.
+        identifier : pydicom.dataset.Dataset
+            The Query/Retrieve request's *Identifier* dataset.
+        session : sqlalchemy.orm.session.Session, optional
+            Not used, for compatibility with ``db.iter_identifiers()``.
+        batch_size : int, optional
+            Not used, for compatibility with ``db.iter_identifiers()``.
+        trace : tracing.Trace, optional
+            If used then the phases of the search are marked, as with
+            ``db.iter_identifiers()``.
+        **extra
+            Any elements to add to every response as ``keyword=value``.
+
+        Returns
+        -------
+        iterable of pydicom.dataset.Dataset
+            The response *Identifier* for each match, the same as from
+            ``db.iter_identifiers()``.
+
+        Raises
+        ------
+        ValueError
+            If the `identifier` is invalid.
+        """
+        db._prepare_identifier(model, identifier)
+        template = db._ResponseTemplate(model, identifier, extra)
+        with self._lock:
+            level, rows = self._select(model, identifier, trace)
+            values = [
+                [self._value(level, row, kw) for kw in template.keywords]
+                for row in rows
+            ]
+
+        trace.mark("execute")
+
+        return db.trace_responses(values, template, trace)
+
+    def _select(self, model, identifier, trace=NULL_TRACE):
+        """Return the level of the table searched and the matching rows.
+
+        Parameters
+        ----------
+        model : pydicom.uid.UID
+            The Query/Retrieve Information Model.
+        identifier : pydicom.dataset.Dataset
+            The request's *Identifier* dataset.
+        trace : tracing.Trace, optional
+            If used then the ``"validate"`` and ``"build"`` phases are
+            marked.
+
+        Returns
+        -------
+        str, list of int
+            The level of the table searched and its matching rows.
+        """
+        query_level, shape, params = db._query_shape(model, identifier, trace)
+        # The same tables as db._level_statement()
+        target = query_level if model in db._C_FIND else "IMAGE"
+
+        criteria = defaultdict(list)
+        for keyword, matching in shape:
+            if matching == "universal":
+                continue
+
+            name, kind, arg = _criterion(keyword, matching, params)
+            # Only the typed and normalized columns aren't in the instance
+            #   table, the same as db._level_filter()
+            level = db._ATTRIBUTES[keyword][0]
+            if target == "IMAGE" and name == db._TRANSLATION[keyword]:
+                level = "IMAGE"
+
+            criteria[level].append((name, kind, arg))
+
+        trace.mark("build")
+
+        if target == "IMAGE":
+            instance_criteria = criteria.pop("IMAGE", [])
+            for level, level_criteria in criteria.items():
+                table = self._tables[level]
+                keys = table.keys(table.select(level_criteria))
+                instance_criteria.append((table.key, "in", keys))
+
+            return target, self._tables["IMAGE"].select(instance_criteria)
+
+        # Join each level to the matches from the level above
+        keys = None
+        for level, table in self._tables.items():
+            level_criteria = criteria.get(level, [])
+            if keys is not None:
+                level_criteria.append((_PARENT[level], "in", keys))
+
+            if level == target:
+                return target, table.select(level_criteria)
+
+            keys = None
+            if level_criteria:
+                keys = table.keys(table.select(level_criteria))
+
+    def _parent_row(self, level, row):
+        """Return the level and row of the parent record of `row`."""
+        key = self._tables[level].get(row, _PARENT[level])
+        parent = "PATIENT" if level == "STUDY" else "STUDY"
+
+        return parent, self._tables[parent].rows[key]
+
+    def _value(self, level, row, keyword):
+        """Return the value for `keyword` from the record for `row` or its
+        parents.
+        """
+        if level != "IMAGE":
+            keyword_level = db._ATTRIBUTES[keyword][0]
+            while level != keyword_level:
+                level, row = self._parent_row(level, row)
+
+        return self._tables[level].get(row, db._TRANSLATION[keyword])
+
+    def _record(self, level, row):
+        """Return a detached record for `row`, with its parents."""
+        record = _MODELS[level](**self._tables[level].record(row))
+        if level == "STUDY":
+            record.patient = self._record(*self._parent_row(level, row))
+        elif level == "SERIES":
+            record.study = self._record(*self._parent_row(level, row))
+
+        return record
+
+
+def _criterion(keyword, matching, params):
+    """Return the criterion for a key, the equivalent of ``db._SEARCH``.
+
+    Parameters
+    ----------
+    keyword : str
+        The element keyword of the key.
+    matching : str
+        The type of matching, as from ``db._query_shape()``.
+    params : dict
+        The bound parameter values for the query.
+
+    Returns
+    -------
+    str, str, object
+        The column name and the `kind` and `arg` for
+        :meth:`_Column.matching_codes`.
+    """
+    name = db._TRANSLATION[keyword]
+    if matching == "single":
+        return name, "in", [params[keyword]]
+
+    if matching == "name":
+        return f"{name}_norm", "in", [params[keyword]]
+
+    if matching == "uid_list":
+        return name, "in", params[keyword]
+
+    if matching.startswith("wildcard"):
+        # The candidate plans only narrow the search, the pattern decides
+        if db._ATTRIBUTES[keyword][2] == "PN":
+            pattern = _like_regex(params[keyword])
+        else:
+            pattern = _glob_regex(params[keyword])
+
+        return name, "match", pattern.fullmatch
+
+    if matching.startswith("datetime_"):
+        name = db._DATE_TIME_KEYS[keyword][1]
+    elif keyword in db._TYPED_COLUMNS:
+        name = db._TYPED_COLUMNS[keyword]
+
+    start = params.get(f"{keyword}_start")
+    end = params.get(f"{keyword}_end")
+
+    def in_range(value):
+        if start is not None and value < start:
+            return False
+
+        return end is None or value <= end
+
+    return name, "match", in_range
+
+
+def _like_regex(pattern):
+    """Return a regex equivalent to a SQLite ``LIKE`` `pattern` using ``\\``
+    as the escape character, which is case-insensitive for ASCII only.
+    """
+    parts = []
+    chars = iter(pattern)
+    for char in chars:
+        if char == "\\":
+            parts.append(re.escape(next(chars, "\\")))
+        elif char == "%":
+            parts.append(".*")
+        elif char == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(char))
+
+    return re.compile("".join(parts), re.ASCII | re.IGNORECASE | re.DOTALL)
+
+
+def _glob_regex(pattern):
+    """Return a regex equivalent to a SQLite ``GLOB`` `pattern` from
+    ``db._wildcard_pattern()``, which is case-sensitive.
+    """
+    # The only character class is the escaped '[' as '[[]'
+    parts = []
+    for part in re.split(r"(\[\[\]|\*|\?)", pattern):
+        if part == "*":
+            parts.append(".*")
+        elif part == "?":
+            parts.append(".")
+        elif part == "[[]":
+            parts.append(re.escape("["))
+        else:
+            parts.append(re.escape(part))
+
+    return re.compile("".join(parts), re.DOTALL)
@@ -0,0 +1,255 @@
+"""Process-wide engine and session registry for the qrscp application.
+
+A single :class:`SessionRegistry` is created when the application starts and
+is shared by every event handler, so each request only has to check a
+connection out of the pool instead of creating a new engine, connection and
+session factory.
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+import db
+from memindex import ColumnarIndex
+# Adds the worklist table to those created by db.create()
+import worklist
+
+
+class PoolStats:
+    """Pool checkout and wait timings, used to size the connection pool.
+
+    *Wait* is the time a request spends waiting for a connection to be checked
+    out of the pool (including the pre-ping), *held* is the time between a
+    connection being checked out and returned to the pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cancelled = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.held_total = 0.0
+        self.held_max = 0.0
+
+    def record_wait(self, elapsed):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += elapsed
+            self.wait_max = max(self.wait_max, elapsed)
+
+    def record_held(self, elapsed):
+        with self._lock:
+            self.checkins += 1
+            self.held_total += elapsed
+            self.held_max = max(self.held_max, elapsed)
+
+    def record_cancelled(self):
+        with self._lock:
+            self.cancelled += 1
+
+    def as_dict(self):
+        """Return the current timings as a :class:`dict`, times in seconds."""
+        with self._lock:
+            return {
+                "queries_cancelled": self.cancelled,
+                "checkouts": self.checkouts,
+                "checked_out": self.checkouts - self.checkins,
+                "wait_total": self.wait_total,
+                "wait_mean": self.wait_total / self.checkouts if self.checkouts else 0.0,
+                "wait_max": self.wait_max,
+                "held_total": self.held_total,
+                "held_mean": self.held_total / self.checkins if self.checkins else 0.0,
+                "held_max": self.held_max,
+            }
+
+
+class Cancellation:
+    """Abort the SQL statement running on a connection when its request is
+    cancelled.
+
+    Used with :meth:`SessionRegistry.session`, which installs a SQLite
+    progress handler that calls `is_cancelled` every `interval` virtual
+    machine instructions while a statement is running. If it returns
+    ``True`` the statement is interrupted and raises an ``OperationalError``,
+    so a long scan stops within milliseconds rather than running to
+    completion.
+
+    Parameters
+    ----------
+    is_cancelled : callable
+        Returns ``True`` if the request has been cancelled.
+    interval : int, optional
+        The number of SQLite virtual machine instructions between checks
+        (default ``10000``).
+
+    Attributes
+    ----------
+    triggered : bool
+        ``True`` if a statement has been interrupted.
+    """
+
+    def __init__(self, is_cancelled, interval=10000):
+        self.is_cancelled = is_cancelled
+        self.interval = interval
+        self.triggered = False
+
+    def _progress(self):
+        """SQLite progress handler, a non-zero return aborts the statement."""
+        if self.is_cancelled():
+            self.triggered = True
+            return 1
+
+        return 0
+
+
+class SessionRegistry:
+    """A pooled engine and session factory shared across requests.
+
+    Parameters
+    ----------
+    db_location : str
+        The location of the database, as used with ``create_engine()``.
+    pool_size : int, optional
+        The number of connections to keep open in the pool (default ``5``).
+    max_overflow : int, optional
+        The number of connections that may be opened above `pool_size` when
+        the pool is exhausted (default ``10``).
+    pool_timeout : float, optional
+        The number of seconds to wait for a connection before giving up
+        (default ``30``).
+    pre_ping : bool, optional
+        Test each connection for liveness when it's checked out of the pool
+        (default ``True``).
+    profile : str, optional
+        The SQLite performance profile from ``db.SQLITE_PROFILES`` to apply
+        to every connection (default ``"default"``).
+    pragmas : dict, optional
+        Any SQLite PRAGMAs to apply in addition to, or to override, those
+        from the `profile`, as ``{name: value}``.
+    backend : str, optional
+        The backend used for searches, ``"sqlite"`` (default) to query the
+        database or ``"memory"`` to load the database into a
+        :class:`memindex.ColumnarIndex` and search that instead.
+    echo : bool, optional
+        Turn the sqlalchemy logging on (default ``False``).
+
+    Attributes
+    ----------
+    backend : module or memindex.ColumnarIndex
+        Either the ``db`` module or the in-memory index, both have the same
+        ``search()``, ``iter_identifiers()``, ``add_instance()`` and
+        ``remove_instance()`` functions.
+    """
+
+    def __init__(
+        self,
+        db_location,
+        pool_size=5,
+        max_overflow=10,
+        pool_timeout=30,
+        pre_ping=True,
+        profile="default",
+        pragmas=None,
+        backend="sqlite",
+        echo=False,
+    ):
+        self.pragmas = dict(db.SQLITE_PROFILES[profile])
+        self.pragmas.update(pragmas or {})
+        self.engine = db.create(
+            db_location,
+            echo=echo,
+            pragmas=self.pragmas,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+            pool_pre_ping=pre_ping,
+        )
+        self.session_factory = sessionmaker(bind=self.engine)
+        self.pool_stats = PoolStats()
+
+        event.listen(self.engine, "checkout", self._on_checkout)
+        event.listen(self.engine, "checkin", self._on_checkin)
+
+        self.backend = db
+        if backend == "memory":
+            self.backend = ColumnarIndex()
+            with self.session() as session:
+                self.backend.load(session)
+
+    def _on_checkout(self, dbapi_connection, connection_record, proxy):
+        connection_record.info["checkout_time"] = time.perf_counter()
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        start = connection_record.info.pop("checkout_time", None)
+        if start is not None:
+            self.pool_stats.record_held(time.perf_counter() - start)
+
+    @contextmanager
+    def session(self, cancellation=None):
+        """Yield a session bound to a connection checked out of the pool.
+
+        The connection is returned to the pool when the context exits.
+
+        Parameters
+        ----------
+        cancellation : registry.Cancellation, optional
+            If used then the statements run by the session are interrupted
+            when the request is cancelled. Only supported with SQLite.
+
+        Yields
+        ------
+        sqlalchemy.orm.session.Session
+            The session to use for the request.
+        """
+        start = time.perf_counter()
+        conn = self.engine.connect()
+        self.pool_stats.record_wait(time.perf_counter() - start)
+        dbapi_conn = conn.connection.dbapi_connection
+        if cancellation is not None and hasattr(dbapi_conn, "set_progress_handler"):
+            dbapi_conn.set_progress_handler(
+                cancellation._progress, cancellation.interval
+            )
+        else:
+            dbapi_conn = None
+
+        session = self.session_factory(bind=conn)
+        try:
+            yield session
+        finally:
+            session.close()
+            if dbapi_conn is not None:
+                # The connection is returned to the pool for other requests
+                dbapi_conn.set_progress_handler(None, 0)
+                if cancellation.triggered:
+                    self.pool_stats.record_cancelled()
+
+            conn.close()
+
+    def stats(self):
+        """Return the pool status and the checkout and wait timings.
+
+        Returns
+        -------
+        dict
+            The pool's configured size, number of checked out and overflow
+            connections, and the timings from :class:`PoolStats`.
+        """
+        pool = self.engine.pool
+        stats = {
+            "pool_size": pool.size(),
+            "checked_out_connections": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+        stats.update(self.pool_stats.as_dict())
+
+        return stats
+
+    def dispose(self):
+        """Close all pooled connections."""
+        self.engine.dispose()
@@ -0,0 +1,191 @@
+"""The slow query log for the C-FIND searches.
+
+When a search's database time is over the threshold the query is recorded
+with its *Identifier*, the generated SQL, the bound parameters, the number
+of rows and the SQLite ``EXPLAIN QUERY PLAN`` output, so the *Identifier*
+shapes that don't use an index can be found. The most recent entries are
+kept in a ring buffer, which can be served as JSON over HTTP, and each entry
+can also be written to a rotating log file as a line of JSON::
+
+    python app/app.py --slow-query-threshold 100 \\
+        --slow-query-log slow_queries.log --slow-query-port 8081
+    curl http://localhost:8081/slow-queries
+
+The log is disabled until :func:`configure` is called with a threshold.
+"""
+
+from collections import deque
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import threading
+
+
+class SlowQueryLog:
+    """A ring buffer of the most recent slow queries.
+
+    Parameters
+    ----------
+    threshold : float or None, optional
+        The database time in seconds above which a query is recorded,
+        ``None`` (default) to disable the log.
+    capacity : int, optional
+        The number of entries to keep (default ``100``).
+    """
+
+    def __init__(self, threshold=None, capacity=100):
+        self.threshold = threshold
+        self.total = 0
+        self._entries = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        # Writes each entry to the log file, if one is configured
+        self._logger = None
+
+    @property
+    def enabled(self):
+        """Return ``True`` if slow queries are being recorded."""
+        return self.threshold is not None
+
+    @property
+    def capacity(self):
+        """Return the number of entries kept."""
+        return self._entries.maxlen
+
+    def is_slow(self, elapsed):
+        """Return ``True`` if a query taking `elapsed` seconds is slow."""
+        return self.threshold is not None and elapsed >= self.threshold
+
+    def record(self, entry):
+        """Add a slow query to the log.
+
+        Parameters
+        ----------
+        entry : dict
+            The query's details, must be serializable as JSON. The current
+            time is added as ``"timestamp"``.
+        """
+        entry = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            **entry,
+        }
+        with self._lock:
+            self._entries.append(entry)
+            self.total += 1
+            logger = self._logger
+
+        if logger is not None:
+            logger.info(json.dumps(entry, default=str))
+
+    def entries(self):
+        """Return the recorded entries, the most recent last."""
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        """Remove all the recorded entries."""
+        with self._lock:
+            self._entries.clear()
+            self.total = 0
+
+    def info(self):
+        """Return the log's settings and the number of slow queries."""
+        with self._lock:
+            return {
+                "threshold_ms": (
+                    None if self.threshold is None else self.threshold * 1000
+                ),
+                "capacity": self.capacity,
+                "size": len(self._entries),
+                "total": self.total,
+            }
+
+
+# The process-wide slow query log used by ``db``
+SLOW_QUERIES = SlowQueryLog()
+
+
+def configure(threshold, capacity=100, filename=None, max_bytes=10**7, backups=5):
+    """Enable or disable the slow query log.
+
+    Parameters
+    ----------
+    threshold : float or None
+        The database time in seconds above which a query is recorded,
+        ``None`` to disable the log.
+    capacity : int, optional
+        The number of entries to keep in memory (default ``100``).
+    filename : str, optional
+        If used then each entry is also written to this file, which is
+        rotated when it reaches `max_bytes`.
+    max_bytes : int, optional
+        The size at which the file is rotated (default 10 MB).
+    backups : int, optional
+        The number of rotated files to keep (default ``5``).
+    """
+    logger = None
+    if filename:
+        logger = logging.getLogger("qrscp.slow_queries")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
+        handler = RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backups
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+
+    with SLOW_QUERIES._lock:
+        SLOW_QUERIES.threshold = threshold
+        SLOW_QUERIES._entries = deque(SLOW_QUERIES._entries, maxlen=capacity)
+        SLOW_QUERIES._logger = logger
+
+
+class _Handler(BaseHTTPRequestHandler):
+    log = SLOW_QUERIES
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/slow-queries":
+            self.send_error(404)
+            return
+
+        body = json.dumps(
+            {"log": self.log.info(), "entries": self.log.entries()},
+            indent=2,
+            default=str,
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't print every request
+        pass
+
+
+def serve(address, port):
+    """Serve the log as JSON at ``/slow-queries`` from a daemon thread.
+
+    Parameters
+    ----------
+    address : str
+        The address to listen on.
+    port : int
+        The port to listen on.
+
+    Returns
+    -------
+    http.server.ThreadingHTTPServer
+        The server.
+    """
+    server = ThreadingHTTPServer((address, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
@@ -0,0 +1,240 @@
+"""Generate a synthetic archive database for benchmarking the query engine.
+
+The archive has a realistic, skewed shape: most patients have a single
+study but some have dozens, the number of series per study depends on the
+modality, and CT and MR series have hundreds of instances while CR and DX
+series usually have one. Names, dates and accession numbers are drawn so
+that wildcard and range queries match a useful number of records. The same
+`seed` always gives the same archive::
+
+    python app/synthetic.py --size 1m --database-location synthetic.sqlite
+"""
+
+import argparse
+import datetime
+import os
+import random
+import time
+
+import db
+
+
+# The preset archive sizes, as the number of instances
+SIZES = {
+    "10k": 10_000,
+    "100k": 100_000,
+    "1m": 1_000_000,
+    "10m": 10_000_000,
+}
+
+# (modality, relative frequency, mean instances per series, mean series
+#   per study)
+_MODALITIES = [
+    ("CT", 30, 120, 3),
+    ("MR", 20, 30, 6),
+    ("CR", 25, 1, 2),
+    ("DX", 10, 1, 2),
+    ("US", 10, 20, 1),
+    ("MG", 5, 4, 1),
+]
+
+_FAMILY_NAMES = [
+    "SMITH", "JOHNSON", "WILLIAMS", "BROWN", "JONES", "GARCIA", "MILLER",
+    "DAVIS", "RODRIGUEZ", "MARTINEZ", "HERNANDEZ", "LOPEZ", "GONZALEZ",
+    "WILSON", "ANDERSON", "THOMAS", "TAYLOR", "MOORE", "JACKSON", "MARTIN",
+    "LEE", "PEREZ", "THOMPSON", "WHITE", "HARRIS", "SANCHEZ", "CLARK",
+    "RAMIREZ", "LEWIS", "ROBINSON", "WALKER", "YOUNG", "ALLEN", "KING",
+    "WRIGHT", "SCOTT", "TORRES", "NGUYEN", "HILL", "FLORES",
+]
+
+_GIVEN_NAMES = [
+    "JAMES", "MARY", "ROBERT", "PATRICIA", "JOHN", "JENNIFER", "MICHAEL",
+    "LINDA", "DAVID", "ELIZABETH", "WILLIAM", "BARBARA", "RICHARD", "SUSAN",
+    "JOSEPH", "JESSICA", "THOMAS", "SARAH", "CHARLES", "KAREN",
+]
+
+# The root of the generated UIDs
+_UID_ROOT = "1.2.826.0.1.3680043.10.1"
+
+# The first study date
+_EPOCH = datetime.date(2014, 1, 1).toordinal()
+
+
+def _setup_argparser():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic archive database"
+    )
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument(
+        "--size",
+        help="the preset number of instances (default: 100k)",
+        choices=list(SIZES),
+        default="100k",
+    )
+    size.add_argument(
+        "--instances",
+        metavar="[n]umber",
+        help="the number of instances, instead of a preset size",
+        type=int,
+    )
+    parser.add_argument(
+        "--database-location",
+        metavar="[f]ile",
+        help="the location of the database (default: synthetic.sqlite)",
+        type=str,
+        default="synthetic.sqlite",
+    )
+    parser.add_argument(
+        "--seed",
+        metavar="[n]umber",
+        help="the random seed (default: 0)",
+        type=int,
+        default=0,
+    )
+
+    return parser.parse_args()
+
+
+def _zipf(rng, values, skew=1.1):
+    """Return one of `values`, with the earlier values more likely."""
+    # Inverse transform of a truncated power law over the indices
+    u = rng.random()
+    index = int(len(values) ** (u**skew)) - 1
+
+    return values[min(index, len(values) - 1)]
+
+
+def _count(rng, mean, limit):
+    """Return a skewed count of at least 1 with roughly the given `mean`."""
+    if mean <= 1:
+        return 1 if rng.random() < 0.9 else 2
+
+    return min(max(1, int(rng.expovariate(1 / mean))), limit)
+
+
+def rows(nr_instances, seed=0):
+    """Yield the synthetic instance rows for an archive.
+
+    Parameters
+    ----------
+    nr_instances : int
+        The number of instances in the archive.
+    seed : int, optional
+        The random seed (default ``0``).
+
+    Yields
+    ------
+    dict
+        The ``db.Instance`` column values for each instance, grouped by
+        patient, study and series.
+    """
+    rng = random.Random(seed)
+    modalities = [modality for modality, *_ in _MODALITIES]
+    weights = [weight for _, weight, _, _ in _MODALITIES]
+    shape = {modality: (series, study) for modality, _, series, study in _MODALITIES}
+
+    remaining = nr_instances
+    patient = study = series = instance = 0
+    while remaining > 0:
+        patient_values = {
+            "patient_id": f"PID{patient:08d}",
+            "patient_name": (
+                f"{_zipf(rng, _FAMILY_NAMES)}^{_zipf(rng, _GIVEN_NAMES)}"
+                f"^{rng.choice('ABCDEFGHJKLMNPRSTW')}"
+            ),
+        }
+        patient += 1
+
+        # Most patients have a single study, a few have dozens
+        for _ in range(min(int(rng.paretovariate(1.6)), 60)):
+            modality = rng.choices(modalities, weights)[0]
+            per_series, per_study = shape[modality]
+            date = datetime.date.fromordinal(_EPOCH + rng.randrange(3650))
+            study_values = {
+                "study_instance_uid": f"{_UID_ROOT}.1.{study}",
+                "study_date": date.strftime("%Y%m%d"),
+                "study_time": (
+                    f"{rng.randrange(7, 20):02d}{rng.randrange(60):02d}"
+                    f"{rng.randrange(60):02d}"
+                ),
+                "accession_number": f"A{rng.randrange(10**9):09d}",
+                "study_id": str(rng.randrange(1, 10000)),
+            }
+            study += 1
+
+            for series_number in range(1, _count(rng, per_study, 40) + 1):
+                series_values = {
+                    "series_instance_uid": f"{_UID_ROOT}.2.{series}",
+                    "modality": modality,
+                    "series_number": series_number,
+                }
+                series += 1
+
+                nr_series_instances = _count(rng, per_series, 2000)
+                for instance_number in range(1, nr_series_instances + 1):
+                    yield {
+                        **patient_values,
+                        **study_values,
+                        **series_values,
+                        "sop_instance_uid": f"{_UID_ROOT}.3.{instance}",
+                        "instance_number": instance_number,
+                        "sop_class_uid": "1.2.840.10008.5.1.4.1.1.2",
+                        "transfer_syntax_uid": "1.2.840.10008.1.2.1",
+                    }
+                    instance += 1
+                    remaining -= 1
+                    if remaining == 0:
+                        return
+
+
+def populate(engine, nr_instances, seed=0, chunk_size=50_000):
+    """Add a synthetic archive to the database for `engine`.
+
+    The instances are inserted directly into the instance table and the
+    patient, study and series tables are then built from them with
+    ``db.populate_hierarchy()``.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine for the database, as from ``db.create()``.
+    nr_instances : int
+        The number of instances in the archive.
+    seed : int, optional
+        The random seed (default ``0``).
+    chunk_size : int, optional
+        The number of instances inserted per statement (default ``50000``).
+    """
+    table = db.Instance.__table__
+    instances = rows(nr_instances, seed)
+    with engine.begin() as conn:
+        while True:
+            chunk = [row for _, row in zip(range(chunk_size), instances)]
+            if not chunk:
+                break
+
+            conn.execute(table.insert(), chunk)
+
+    db.populate_hierarchy(engine)
+
+
+def main():
+    args = _setup_argparser()
+
+    nr_instances = args.instances or SIZES[args.size]
+    db_path = os.path.abspath(args.database_location)
+    if os.path.exists(db_path):
+        print(f"The database '{db_path}' already exists")
+        return
+
+    start = time.perf_counter()
+    engine = db.create(f"sqlite:///{db_path}")
+    populate(engine, nr_instances, args.seed)
+    engine.dispose()
+
+    elapsed = time.perf_counter() - start
+    print(f"Generated {nr_instances} instances in {db_path} in {elapsed:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
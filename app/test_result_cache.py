@@ -0,0 +1,76 @@
+"""Tests for the C-FIND result cache in db.py.
+
+Run from the app directory::
+
+    python -m pytest test_result_cache.py
+"""
+
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.uid import generate_uid
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+import db
+
+
+DATA = "data/CT_small.dcm"
+
+
+@pytest.fixture
+def session(tmp_path):
+    engine = db.create(f"sqlite:///{tmp_path / 'test.sqlite'}")
+    db.configure_result_cache(64)
+    with sessionmaker(bind=engine)() as session:
+        yield session
+
+    db.configure_result_cache(0)
+    engine.dispose()
+
+
+def _instance(patient_name, study_uid):
+    ds = dcmread(DATA)
+    ds.PatientID = "TEST-1"
+    ds.PatientName = patient_name
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SOPInstanceUID = generate_uid()
+
+    return ds
+
+
+def _find(study_uid, session):
+    identifier = Dataset()
+    identifier.QueryRetrieveLevel = "STUDY"
+    identifier.StudyInstanceUID = study_uid
+    identifier.PatientName = ""
+    responses = db.iter_identifiers(
+        StudyRootQueryRetrieveInformationModelFind, identifier, session
+    )
+
+    return [str(ds.PatientName) for ds in responses]
+
+
+def test_study_result_invalidated_by_write_to_other_study(session):
+    """A result cached for a study is invalidated when another study of the
+    same patient changes the patient's values.
+    """
+    study_uid = generate_uid()
+    db.add_instance(_instance("DOE^JOHN", study_uid), session)
+    assert _find(study_uid, session) == ["DOE^JOHN"]
+    assert _find(study_uid, session) == ["DOE^JOHN"]
+    assert db.result_cache_info()["hits"] == 1
+
+    # Updates the patient shared by both studies
+    db.add_instance(_instance("DOE^JANE", generate_uid()), session)
+    assert _find(study_uid, session) == ["DOE^JANE"]
+
+
+def test_study_result_invalidated_by_write_to_study(session):
+    """A result cached for a study is invalidated by a write to the study."""
+    study_uid = generate_uid()
+    assert _find(study_uid, session) == []
+
+    db.add_instance(_instance("DOE^JOHN", study_uid), session)
+    assert _find(study_uid, session) == ["DOE^JOHN"]
@@ -0,0 +1,296 @@
+"""Per-request phase timing for the DIMSE service handlers.
+
+Each request handled while tracing is enabled gets a :class:`Trace`, which
+times the phases of the request by marking the end of each one, so a phase
+only costs a single ``perf_counter()`` call. When the request is finished
+the timings are added to latency histograms for the request's SOP Class.
+When tracing is disabled requests get :data:`NULL_TRACE`, whose methods do
+nothing.
+
+The phases are:
+
+* ``"session"``: checking a connection out of the pool
+* ``"validate"``: checking the *Identifier* or attribute list
+* ``"build"``: building the query for the *Identifier*
+* ``"execute"``: running the query and fetching the rows
+* ``"response"``: building the response datasets
+* ``"yield"``: each pending response, while it's sent to the peer
+* ``"store"``: updating the managed SOP Instances
+* ``"total"``: the whole request
+
+The ``"yield"`` histogram has an entry for every pending response, the
+other phases have one entry per request with the total time in the phase.
+"""
+
+from bisect import bisect_left
+import threading
+import time
+
+
+# The upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    """A latency histogram with fixed buckets.
+
+    Parameters
+    ----------
+    buckets : sequence of float
+        The upper bounds of the buckets in seconds, in increasing order.
+        Values above the last bound are counted in an overflow bucket.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """Add a `value` in seconds to the histogram."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Return an estimate of the `q` quantile, in seconds.
+
+        The estimate is the upper bound of the bucket containing the
+        quantile, or the maximum value if that's in the overflow bucket.
+        """
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def as_dict(self):
+        """Return the histogram as a :class:`dict`, times in seconds."""
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip([*self.buckets, float("inf")], self.counts)),
+        }
+
+
+class Trace:
+    """The phase timings for a single request.
+
+    Parameters
+    ----------
+    tracer : tracing.Tracer
+        The tracer to add the timings to when the request is finished.
+    sop_class : str
+        The name of the request's SOP Class.
+    """
+
+    enabled = True
+
+    def __init__(self, tracer, sop_class):
+        self._tracer = tracer
+        self.sop_class = sop_class
+        self.start = self._last = time.perf_counter()
+        # The total time in each phase
+        self.phases = {}
+        # The time of each pending response
+        self.yields = []
+
+    def mark(self, phase):
+        """Mark the end of a `phase`, which started at the previous mark."""
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self._last = now
+        if phase == "yield":
+            self.yields.append(elapsed)
+        else:
+            self.phases[phase] = self.phases.get(phase, 0.0) + elapsed
+
+    def finish(self):
+        """Finish the request and add its timings to the tracer."""
+        self.phases["total"] = time.perf_counter() - self.start
+        self._tracer.record(self)
+
+
+class _NullTrace:
+    """A trace that does nothing, used when tracing is disabled."""
+
+    enabled = False
+
+    def mark(self, phase):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+class Tracer:
+    """The latency histograms for the traced requests, by SOP Class.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        If ``False`` (default) then requests aren't traced.
+    buckets : sequence of float, optional
+        The histogram bucket upper bounds, in seconds.
+    """
+
+    def __init__(self, enabled=False, buckets=BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # {SOP Class name: {phase: Histogram}}
+        self._histograms = {}
+
+    def start(self, sop_class):
+        """Return the trace for a new request.
+
+        Parameters
+        ----------
+        sop_class : pydicom.uid.UID or str
+            The request's SOP Class UID or name.
+
+        Returns
+        -------
+        tracing.Trace or NULL_TRACE
+            The trace to mark the request's phases with.
+        """
+        if not self.enabled:
+            return NULL_TRACE
+
+        return Trace(self, getattr(sop_class, "keyword", None) or str(sop_class))
+
+    def record(self, trace):
+        """Add the timings from a finished `trace` to the histograms."""
+        with self._lock:
+            histograms = self._histograms.setdefault(trace.sop_class, {})
+            for phase, elapsed in trace.phases.items():
+                self._histogram(histograms, phase).observe(elapsed)
+
+            if trace.yields:
+                histogram = self._histogram(histograms, "yield")
+                for elapsed in trace.yields:
+                    histogram.observe(elapsed)
+
+    def _histogram(self, histograms, phase):
+        histogram = histograms.get(phase)
+        if histogram is None:
+            histogram = histograms[phase] = Histogram(self.buckets)
+
+        return histogram
+
+    def snapshot(self):
+        """Return the current histograms.
+
+        Returns
+        -------
+        dict
+            ``{SOP Class name: {phase: histogram}}``, with each histogram as
+            from :meth:`Histogram.as_dict`.
+        """
+        with self._lock:
+            return {
+                sop_class: {
+                    phase: histogram.as_dict()
+                    for phase, histogram in histograms.items()
+                }
+                for sop_class, histograms in self._histograms.items()
+            }
+
+    def reset(self):
+        """Remove all the recorded timings."""
+        with self._lock:
+            self._histograms = {}
+
+    def report(self):
+        """Return the histograms as a table of quantiles, times in ms."""
+        lines = [
+            f"{'SOP Class / phase':<55} {'count':>8} {'p50':>9} {'p90':>9} "
+            f"{'p99':>9} {'max':>9}"
+        ]
+        for sop_class, histograms in sorted(self.snapshot().items()):
+            lines.append(sop_class)
+            for phase, values in histograms.items():
+                lines.append(
+                    f"  {phase:<53} {values['count']:>8} "
+                    f"{values['p50'] * 1000:>9.2f} {values['p90'] * 1000:>9.2f} "
+                    f"{values['p99'] * 1000:>9.2f} {values['max'] * 1000:>9.2f}"
+                )
+
+        return "\n".join(lines)
+
+
+# The process-wide tracer used by the handlers
+TRACER = Tracer()
+
+
+def configure(enabled):
+    """Enable or disable tracing of the requests.
+
+    Parameters
+    ----------
+    enabled : bool
+        If ``True`` then each request's phases are timed and added to the
+        histograms of :data:`TRACER`.
+    """
+    TRACER.enabled = enabled
+
+
+def start_reporter(interval, tracer=TRACER):
+    """Print the tracer's report every `interval` seconds.
+
+    Parameters
+    ----------
+    interval : float
+        The number of seconds between reports.
+    tracer : tracing.Tracer, optional
+        The tracer to report on, defaults to :data:`TRACER`.
+
+    Returns
+    -------
+    threading.Thread
+        The daemon thread printing the reports.
+    """
+
+    def report():
+        while True:
+            time.sleep(interval)
+            print(tracer.report())
+
+    thread = threading.Thread(target=report, daemon=True)
+    thread.start()
+
+    return thread
@@ -0,0 +1,553 @@
+"""Modality Worklist Information Model - FIND for the qrscp application.
+
+Each Scheduled Procedure Step is a row of the ``worklist_item`` table with
+the attributes of its worklist item, so a worklist item with several steps
+has a row for each step, and a C-FIND has a match for each step that
+matches (Part 4, K.6.1.2.2). The keys in the request's *Scheduled Procedure
+Step Sequence* item are matched against each step's columns, which is
+sequence matching (Part 4, C.2.2.2.6) done by the database.
+
+The type of matching for each key and its bound values are the same as for
+the Query/Retrieve searches in ``db``, and only the columns for the return
+keys in the *Identifier* are selected, as with ``db.iter_identifiers()``.
+
+The table is added to the ``db`` tables, so is created by ``db.create()``.
+"""
+
+from sqlalchemy import and_, bindparam, select, Column, Index, Integer, String
+from sqlalchemy.dialects.sqlite import insert
+
+from pydicom import config
+from pydicom.datadict import dictionary_VR
+from pydicom.dataelem import DataElement
+from pydicom.dataset import Dataset
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+
+import db
+from db import InvalidIdentifier
+from tracing import NULL_TRACE
+
+
+# Translate from the element keyword to the column for the keys at the top
+#   level of the worklist item
+_ITEM_KEYS = {
+    "PatientName": "patient_name",  # PN
+    "PatientID": "patient_id",  # LO
+    "PatientBirthDate": "patient_birth_date",  # DA
+    "PatientSex": "patient_sex",  # CS
+    "AccessionNumber": "accession_number",  # SH
+    "ReferringPhysicianName": "referring_physician_name",  # PN
+    "StudyInstanceUID": "study_instance_uid",  # UI
+    "RequestedProcedureID": "requested_procedure_id",  # SH
+    "RequestedProcedureDescription": "requested_procedure_description",  # LO
+}
+
+# ... and for the keys in the Scheduled Procedure Step Sequence item
+_STEP_KEYS = {
+    "ScheduledStationAETitle": "scheduled_station_ae_title",  # AE
+    "ScheduledProcedureStepStartDate": "start_date",  # DA
+    "ScheduledProcedureStepStartTime": "start_time",  # TM
+    "Modality": "modality",  # CS
+    "ScheduledPerformingPhysicianName": "performing_physician_name",  # PN
+    "ScheduledProcedureStepDescription": "step_description",  # LO
+    "ScheduledStationName": "scheduled_station_name",  # SH
+    "ScheduledProcedureStepLocation": "step_location",  # SH
+    "PreMedication": "pre_medication",  # LO
+    "ScheduledProcedureStepID": "step_id",  # SH
+    "ScheduledProcedureStepStatus": "step_status",  # CS
+}
+
+# TM keys matched against a typed column, as {keyword: column}
+_TIME_COLUMNS = {"ScheduledProcedureStepStartTime": "start_time_value"}
+
+_SEQUENCE = "ScheduledProcedureStepSequence"
+
+
+class WorklistItem(db.Base):
+    __tablename__ = "worklist_item"
+    __table_args__ = (
+        # Sending an order again replaces its steps
+        Index(
+            "ix_worklist_item_key",
+            "accession_number",
+            "requested_procedure_id",
+            "step_id",
+            unique=True,
+        ),
+        # A modality polling for its own steps for the day
+        Index(
+            "ix_worklist_item_station_date", "scheduled_station_ae_title", "start_date"
+        ),
+        Index("ix_worklist_item_start_date", "start_date", "start_time_value"),
+        Index("ix_worklist_item_modality", "modality", "start_date"),
+        Index("ix_worklist_item_patient_id", "patient_id"),
+        Index("ix_worklist_item_patient_name_norm", "patient_name_norm"),
+    )
+
+    id = Column(Integer, primary_key=True)
+
+    # Worklist item
+    # (0010,0010) Patient's Name | VR PN, VM 1
+    patient_name = Column(String)
+    patient_name_norm = Column(String)
+    # (0010,0020) Patient ID | VR LO, VM 1
+    patient_id = Column(String(64))
+    # (0010,0030) Patient's Birth Date | VR DA, VM 1
+    patient_birth_date = Column(String(8))
+    # (0010,0040) Patient's Sex | VR CS, VM 1
+    patient_sex = Column(String(16))
+    # (0008,0050) Accession Number | VR SH, VM 1
+    accession_number = Column(String(16), nullable=False)
+    # (0008,0090) Referring Physician's Name | VR PN, VM 1
+    referring_physician_name = Column(String)
+    referring_physician_name_norm = Column(String)
+    # (0020,000D) Study Instance UID | VR UI, VM 1
+    study_instance_uid = Column(String(64))
+    # (0040,1001) Requested Procedure ID | VR SH, VM 1
+    requested_procedure_id = Column(String(16), nullable=False)
+    # (0032,1060) Requested Procedure Description | VR LO, VM 1
+    requested_procedure_description = Column(String(64))
+
+    # Scheduled Procedure Step Sequence item
+    # (0040,0001) Scheduled Station AE Title | VR AE, VM 1-n
+    scheduled_station_ae_title = Column(String(16))
+    # (0040,0002) Scheduled Procedure Step Start Date | VR DA, VM 1
+    start_date = Column(String(8))
+    # (0040,0003) Scheduled Procedure Step Start Time | VR TM, VM 1
+    start_time = Column(String(14))
+    start_time_value = Column(Integer)
+    # (0008,0060) Modality | VR CS, VM 1
+    modality = Column(String(16))
+    # (0040,0006) Scheduled Performing Physician's Name | VR PN, VM 1
+    performing_physician_name = Column(String)
+    performing_physician_name_norm = Column(String)
+    # (0040,0007) Scheduled Procedure Step Description | VR LO, VM 1
+    step_description = Column(String(64))
+    # (0040,0010) Scheduled Station Name | VR SH, VM 1-n
+    scheduled_station_name = Column(String(16))
+    # (0040,0011) Scheduled Procedure Step Location | VR SH, VM 1
+    step_location = Column(String(16))
+    # (0040,0012) Pre-Medication | VR LO, VM 1
+    pre_medication = Column(String(64))
+    # (0040,0009) Scheduled Procedure Step ID | VR SH, VM 1
+    step_id = Column(String(16), nullable=False)
+    # (0040,0020) Scheduled Procedure Step Status | VR CS, VM 1
+    step_status = Column(String(16))
+
+
+def _value(ds, keyword):
+    """Return the value of `keyword` in `ds` as a :class:`str` or ``None``."""
+    value = ds.get(keyword)
+    # AE and SH keys may be multi-valued, only the first value is matched
+    if isinstance(value, MultiValue):
+        value = value[0] if value else None
+
+    if value is None or value == "":
+        return None
+
+    return str(value)
+
+
+def _rows(ds):
+    """Return the ``worklist_item`` rows for the worklist item `ds`.
+
+    Parameters
+    ----------
+    ds : pydicom.dataset.Dataset
+        The worklist item.
+
+    Returns
+    -------
+    list of dict
+        The column values for each Scheduled Procedure Step in the item.
+    """
+    item = {column: _value(ds, kw) for kw, column in _ITEM_KEYS.items()}
+    item["accession_number"] = item["accession_number"] or ""
+    item["requested_procedure_id"] = item["requested_procedure_id"] or ""
+
+    rows = []
+    for index, step in enumerate(ds.get(_SEQUENCE) or [Dataset()], start=1):
+        row = dict(item)
+        row.update({column: _value(step, kw) for kw, column in _STEP_KEYS.items()})
+        # Steps without an ID are keyed on their position in the sequence
+        row["step_id"] = row["step_id"] or str(index)
+        for column in (
+            "patient_name",
+            "referring_physician_name",
+            "performing_physician_name",
+        ):
+            value = row[column]
+            row[f"{column}_norm"] = db._normalize_name(value) if value else None
+
+        start_time = row["start_time"]
+        # An invalid time is stored as it is, but can't be range matched
+        try:
+            row["start_time_value"] = db._parse_time(start_time) if start_time else None
+        except ValueError:
+            row["start_time_value"] = None
+
+        rows.append(row)
+
+    return rows
+
+
+def add_item(ds, session):
+    """Add a worklist item, replacing the steps with the same key.
+
+    Parameters
+    ----------
+    ds : pydicom.dataset.Dataset
+        The worklist item, with its *Scheduled Procedure Step Sequence*.
+    session : sqlalchemy.orm.session.Session
+        The session we are using to query the database.
+
+    Returns
+    -------
+    int
+        The number of Scheduled Procedure Steps added or updated.
+    """
+    return add_items([ds], session)
+
+
+def add_items(datasets, session, chunk_size=1000):
+    """Add worklist items, replacing the steps with the same key.
+
+    Parameters
+    ----------
+    datasets : iterable of pydicom.dataset.Dataset
+        The worklist items.
+    session : sqlalchemy.orm.session.Session
+        The session we are using to query the database.
+    chunk_size : int, optional
+        The number of steps inserted per statement (default ``1000``).
+
+    Returns
+    -------
+    int
+        The number of Scheduled Procedure Steps added or updated.
+    """
+    table = WorklistItem.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=["accession_number", "requested_procedure_id", "step_id"],
+        set_={
+            column.name: statement.excluded[column.name]
+            for column in table.columns
+            if column.name != "id"
+        },
+    )
+
+    nr_steps = 0
+    chunk = []
+    for ds in datasets:
+        chunk.extend(_rows(ds))
+        if len(chunk) >= chunk_size:
+            session.execute(statement, chunk)
+            nr_steps += len(chunk)
+            chunk = []
+
+    if chunk:
+        session.execute(statement, chunk)
+        nr_steps += len(chunk)
+
+    session.commit()
+
+    return nr_steps
+
+
+def remove_item(accession_number, session):
+    """Remove all the Scheduled Procedure Steps for an order.
+
+    Parameters
+    ----------
+    accession_number : str
+        The order's *Accession Number*.
+    session : sqlalchemy.orm.session.Session
+        The session we are using to query the database.
+
+    Returns
+    -------
+    int
+        The number of steps removed.
+    """
+    nr_steps = (
+        session.query(WorklistItem)
+        .filter(WorklistItem.accession_number == accession_number)
+        .delete()
+    )
+    session.commit()
+
+    return nr_steps
+
+
+def _keys(identifier):
+    """Return the matching keys in a Modality Worklist `identifier`.
+
+    Parameters
+    ----------
+    identifier : pydicom.dataset.Dataset
+        The C-FIND request's *Identifier*.
+
+    Returns
+    -------
+    list of pydicom.dataelem.DataElement
+        The keys with a column, including those in the *Scheduled Procedure
+        Step Sequence* item.
+
+    Raises
+    ------
+    InvalidIdentifier
+        If the *Scheduled Procedure Step Sequence* has more than one item.
+    """
+    keys = [identifier[kw] for kw in _ITEM_KEYS if kw in identifier]
+    if _SEQUENCE in identifier:
+        items = identifier[_SEQUENCE].value
+        # Part 4, C.2.2.2.6: only a single item is allowed
+        if len(items) > 1:
+            raise InvalidIdentifier(
+                "The Scheduled Procedure Step Sequence has more than one item"
+            )
+
+        if items:
+            keys.extend(items[0][kw] for kw in _STEP_KEYS if kw in items[0])
+
+    return keys
+
+
+def _matching_type(elem):
+    """Return the type of matching for a key, as from ``db._matching_type()``.
+
+    The wildcard plans that need the trigram or name part indexes of the
+    Query/Retrieve tables are replaced by a range scan of the column's
+    index if the value has a literal prefix, otherwise a scan.
+    """
+    if elem.VR != "UI" and isinstance(elem.value, MultiValue):
+        raise InvalidIdentifier(
+            f"Multiple values aren't supported for '{elem.keyword}'"
+        )
+
+    matching = db._matching_type(elem)
+    if matching.startswith("wildcard"):
+        prefix = db._literal_prefix(str(elem.value), elem.VR)
+        return "wildcard_prefix" if prefix else "wildcard"
+
+    if matching == "single" and elem.keyword in _TIME_COLUMNS:
+        # Matched as a range covering the precision of the value
+        return "range"
+
+    return matching
+
+
+def _bind_values(elem, matching):
+    """Return the bound values for a key, as from ``db._bind_values()``."""
+    params = db._bind_values(elem, matching)
+    if elem.keyword in _TIME_COLUMNS:
+        keyword = elem.keyword
+        if f"{keyword}_start" in params:
+            params[f"{keyword}_start"] = db._parse_time(params[f"{keyword}_start"])
+        if f"{keyword}_end" in params:
+            params[f"{keyword}_end"] = db._parse_time(
+                params[f"{keyword}_end"], end=True
+            )
+
+    return params
+
+
+def _column(keyword, suffix=""):
+    """Return the column for `keyword`, or its typed or normalized column."""
+    name = _ITEM_KEYS.get(keyword) or _STEP_KEYS[keyword]
+    return getattr(WorklistItem, f"{name}{suffix}")
+
+
+def _criteria(keyword, vr, matching):
+    """Return the criteria for the matching of a key.
+
+    Parameters
+    ----------
+    keyword : str
+        The element keyword of the key.
+    vr : str
+        The key's VR.
+    matching : str
+        The type of matching, as from :func:`_matching_type`.
+
+    Returns
+    -------
+    list of sqlalchemy.sql.ColumnElement
+        The criteria, using the bound parameters from :func:`_bind_values`.
+    """
+    column = _column(keyword)
+    if matching == "universal":
+        return []
+
+    if matching == "single":
+        return [column == bindparam(keyword)]
+
+    if matching == "uid_list":
+        return [column.in_(bindparam(keyword, expanding=True))]
+
+    if matching == "name":
+        return [_column(keyword, "_norm") == bindparam(keyword)]
+
+    if matching.startswith("wildcard"):
+        criteria = []
+        if matching == "wildcard_prefix":
+            # The normalized name for PN
+            indexed = _column(keyword, "_norm") if vr == "PN" else column
+            criteria.append(indexed >= bindparam(f"{keyword}_lower"))
+            criteria.append(indexed < bindparam(f"{keyword}_upper"))
+
+        if vr == "PN":
+            criteria.append(column.like(bindparam(keyword), escape="\\"))
+        else:
+            criteria.append(column.op("GLOB")(bindparam(keyword)))
+
+        return criteria
+
+    # Range matching
+    if keyword in _TIME_COLUMNS:
+        column = getattr(WorklistItem, _TIME_COLUMNS[keyword])
+
+    criteria = []
+    if matching in ("range", "range_from"):
+        criteria.append(column >= bindparam(f"{keyword}_start"))
+    if matching in ("range", "range_to"):
+        criteria.append(column <= bindparam(f"{keyword}_end"))
+
+    return criteria
+
+
+class _ResponseTemplate:
+    """Build the response *Identifiers* for a request from selected rows.
+
+    The response has each key in the request's *Identifier*, with the keys
+    in its *Scheduled Procedure Step Sequence* item in the single item of
+    the response's sequence. If the request's sequence has no items or an
+    empty item then all the step's keys are returned. Keys without a column
+    are returned with no value.
+
+    Parameters
+    ----------
+    identifier : pydicom.dataset.Dataset
+        The request's *Identifier* dataset.
+    """
+
+    def __init__(self, identifier):
+        # The columns to select, as (keyword, column)
+        self.columns = []
+        self._item = self._fields(
+            [elem.keyword for elem in identifier if elem.keyword != _SEQUENCE],
+            _ITEM_KEYS,
+        )
+
+        self._step = None
+        if _SEQUENCE in identifier:
+            items = identifier[_SEQUENCE].value
+            keywords = [elem.keyword for elem in items[0]] if items else []
+            self._step = self._fields(keywords or list(_STEP_KEYS), _STEP_KEYS)
+
+    def _fields(self, keywords, columns):
+        fields = []
+        for kw in keywords:
+            tag = Tag(kw)
+            index = None
+            if kw in columns:
+                index = len(self.columns)
+                self.columns.append((kw, getattr(WorklistItem, columns[kw])))
+
+            fields.append((tag, dictionary_VR(tag), index))
+
+        return fields
+
+    @staticmethod
+    def _dataset(fields, row):
+        elements = {}
+        for tag, vr, index in fields:
+            value = None if index is None else row[index]
+            elements[tag] = DataElement(
+                tag, vr, value, validation_mode=config.IGNORE
+            )
+
+        return Dataset(elements)
+
+    def __call__(self, row):
+        """Return the response *Identifier* for a row of values.
+
+        Parameters
+        ----------
+        row : sequence
+            The values for each of the columns in :attr:`columns`.
+
+        Returns
+        -------
+        pydicom.dataset.Dataset
+            The response *Identifier*.
+        """
+        ds = self._dataset(self._item, row)
+        if self._step is not None:
+            ds.ScheduledProcedureStepSequence = [self._dataset(self._step, row)]
+
+        return ds
+
+
+def iter_identifiers(identifier, session, trace=NULL_TRACE):
+    """Search the worklist, returning the response *Identifier* for each match.
+
+    Parameters
+    ----------
+    identifier : pydicom.dataset.Dataset
+        The C-FIND request's *Identifier*.
+    session : sqlalchemy.orm.session.Session
+        The session we are using to query the database, which must stay
+        open until the iteration is complete.
+    trace : tracing.Trace, optional
+        If used then the ``"validate"``, ``"build"``, ``"execute"`` and
+        ``"response"`` phases of the search are marked.
+
+    Returns
+    -------
+    iterable of pydicom.dataset.Dataset
+        The response *Identifier* for each matching Scheduled Procedure Step.
+
+    Raises
+    ------
+    InvalidIdentifier
+        If the `identifier` is invalid.
+    """
+    shape = []
+    params = {}
+    for elem in _keys(identifier):
+        try:
+            matching = _matching_type(elem)
+            params.update(_bind_values(elem, matching))
+        except ValueError as exc:
+            raise InvalidIdentifier(str(exc))
+
+        shape.append((elem.keyword, elem.VR, matching))
+
+    template = _ResponseTemplate(identifier)
+    trace.mark("validate")
+
+    # Statements are cached with those for the Query/Retrieve shapes
+    key = ("worklist", tuple(shape), tuple(kw for kw, _ in template.columns))
+    statement = db._STATEMENTS.get(key)
+    if statement is None:
+        criteria = []
+        for keyword, vr, matching in shape:
+            criteria.extend(_criteria(keyword, vr, matching))
+
+        columns = [column for _, column in template.columns] or [WorklistItem.id]
+        statement = select(*columns).select_from(WorklistItem)
+        if criteria:
+            statement = statement.where(and_(*criteria))
+
+        statement = statement.order_by(WorklistItem.id)
+        db._STATEMENTS.put(key, statement)
+
+    trace.mark("build")
+
+    rows = session.execute(statement, params)
+    trace.mark("execute")
+
+    return db.trace_responses(rows, template, trace)
@@ -0,0 +1,270 @@
+"""Load test the HTTP front end of the MPPS/worklist SCP.
+
+Starts the HTTP server on a temporary worklist database, or uses a running
+one with ``--url``, and has each of ``--clients`` threads send requests over
+its own keep-alive connection for ``--duration`` seconds. Most requests are
+health checks (``GET /``) and ``--post-ratio`` of them submit an order
+(``POST /``). A few ``--slow-clients`` trickle their request headers in a
+byte at a time, to show they don't hold up the other clients::
+
+    python dicom-app/bench_http.py --clients 200 --duration 20
+
+``--baseline`` runs the same load against the previous single-threaded
+``http.server.HTTPServer`` for comparison.
+"""
+
+import argparse
+import contextlib
+import http.client
+from http.server import HTTPServer as BaselineHTTPServer
+import json
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from httpserver import HTTPServer
+from mpps_modalityworklist_scp import SimpleHTTPRequestHandler
+from worklist import WorklistStore
+
+
+def _setup_argparser():
+    parser = argparse.ArgumentParser(
+        description="Load test the HTTP front end of the MPPS/worklist SCP"
+    )
+    parser.add_argument(
+        "--url",
+        metavar="[u]rl",
+        help="the server to test, if unset then one is started (default)",
+    )
+    parser.add_argument(
+        "--clients",
+        metavar="[n]umber",
+        help="number of concurrent clients (default: 200)",
+        type=int,
+        default=200,
+    )
+    parser.add_argument(
+        "--duration",
+        metavar="[s]econds",
+        help="how long to run the load for (default: 20)",
+        type=float,
+        default=20,
+    )
+    parser.add_argument(
+        "--post-ratio",
+        metavar="[r]atio",
+        help="the fraction of requests that submit an order (default: 0.1)",
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        "--slow-clients",
+        metavar="[n]umber",
+        help="number of clients sending their headers slowly (default: 4)",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="[n]umber",
+        help="the number of workers of the started server (default: 16)",
+        type=int,
+        default=16,
+    )
+    parser.add_argument(
+        "--baseline",
+        help="start the single-threaded HTTP/1.0 server instead",
+        action="store_true",
+    )
+
+    return parser.parse_args()
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        # Don't print every request
+        pass
+
+
+class _BaselineHandler(_QuietHandler):
+    # The single-threaded server can't keep connections alive
+    protocol_version = "HTTP/1.0"
+
+
+class _BaselineServer(BaselineHTTPServer):
+    request_queue_size = 1024
+    max_body_size = None
+
+
+def _order(template, index):
+    """Return the JSON order `template` with a unique Accession Number."""
+    return json.dumps(dict(template, AccessionNumber=f"LOAD{index:09d}")).encode()
+
+
+def _client(host, port, deadline, template, post_ratio, offset, results):
+    """Send requests over a keep-alive connection until the `deadline`."""
+    rng = random.Random(offset)
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    latencies = []
+    statuses = {}
+    errors = 0
+    sent = 0
+    while time.monotonic() < deadline:
+        if rng.random() < post_ratio:
+            method, path, body = "POST", "/", _order(template, offset + sent)
+            headers = {"Content-Type": "application/json"}
+        else:
+            method, path, body, headers = "GET", "/", None, {}
+
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            continue
+        finally:
+            sent += 1
+
+        latencies.append(time.perf_counter() - start)
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    conn.close()
+    results.append((latencies, statuses, errors))
+
+
+def _slow_client(host, port, deadline):
+    """Send a request's headers one byte a second until the `deadline`."""
+    request = b"GET / HTTP/1.1\r\nHost: localhost\r\nX-Padding: " + b"x" * 1000
+    try:
+        with socket.create_connection((host, port), timeout=5) as sock:
+            for byte in request:
+                if time.monotonic() >= deadline:
+                    return
+
+                sock.sendall(bytes([byte]))
+                time.sleep(1)
+    except OSError:
+        pass
+
+
+def _quantile(values, q):
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _run(host, port, args):
+    """Run the load and return the report."""
+    path = os.path.join(os.path.dirname(__file__), "dummy-data", "data1.json")
+    with open(path) as f:
+        template = json.load(f)
+
+    deadline = time.monotonic() + args.duration
+    results = []
+    threads = [
+        threading.Thread(target=_slow_client, args=(host, port, deadline))
+        for _ in range(args.slow_clients)
+    ]
+    threads.extend(
+        threading.Thread(
+            target=_client,
+            args=(
+                host,
+                port,
+                deadline,
+                template,
+                args.post_ratio,
+                index * 10**6,
+                results,
+            ),
+        )
+        for index in range(args.clients)
+    )
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(value for result in results for value in result[0])
+    statuses = {}
+    for _, counts, _ in results:
+        for status, count in counts.items():
+            statuses[status] = statuses.get(status, 0) + count
+
+    errors = sum(result[2] for result in results)
+    quantiles = ", ".join(
+        f"{name} {_quantile(latencies, q) * 1000:.1f} ms"
+        for name, q in (
+            ("p50", 0.5),
+            ("p90", 0.9),
+            ("p99", 0.99),
+            ("p99.9", 0.999),
+            ("max", 1.0),
+        )
+    )
+
+    return "\n".join(
+        [
+            f"{args.clients} clients, {args.slow_clients} slow clients, "
+            f"{elapsed:.1f} s",
+            f"  requests:   {len(latencies)} ({errors} errors)",
+            f"  statuses:   {dict(sorted(statuses.items()))}",
+            f"  throughput: {len(latencies) / elapsed:.0f} requests/s",
+            f"  latency:    {quantiles}",
+        ]
+    )
+
+
+def main():
+    args = _setup_argparser()
+
+    if args.url:
+        url = urlsplit(args.url)
+        print(_run(url.hostname, url.port or 80, args))
+        return
+
+    with tempfile.TemporaryDirectory() as tdir:
+        worklist = WorklistStore(os.path.join(tdir, "worklist.sqlite"))
+        if args.baseline:
+            httpd = _BaselineServer(("localhost", 0), _BaselineHandler)
+        else:
+            httpd = HTTPServer(
+                ("localhost", 0),
+                _QuietHandler,
+                max_workers=args.workers,
+                max_connections=args.clients + args.slow_clients + 100,
+            )
+
+        httpd.worklist = worklist
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        host, port = httpd.server_address[:2]
+        print(
+            f"Started the {'baseline' if args.baseline else 'thread pool'} "
+            f"server on port {port}"
+        )
+
+        # The order submissions print each worklist item
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                report = _run(host, port, args)
+
+        httpd.shutdown()
+        print(report)
+        print(f"  worklist:   {worklist.count()} scheduled steps")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,11 @@
+import datetime
+import re
+
+from pydicom.config import IGNORE
+from pydicom.datadict import dictionary_VM, dictionary_VR, tag_for_keyword
+from pydicom.dataelem import DataElement
 from pydicom.dataset import Dataset
+from pydicom.uid import UID
 # import requests
 import json
 
@@ -9,38 +16,175 @@ from sqlalchemy.orm import sessionmaker
 
 managed_instances = {}
 
-# Function to load JSON data and convert it to a Dataset
+# The elements of a worklist item and the field of the JSON order with the
+#   value of each
+_ITEM_FIELDS = [
+    ("PatientName", "PatientName"),
+    ("PatientID", "PatientID"),
+    ("PatientBirthDate", "PatientBirthDate"),
+    ("PatientSex", "PatientSex"),
+    ("StudyID", "StudyID"),
+    ("AccessionNumber", "AccessionNumber"),
+    ("ReferringPhysicianName", "ReferringPhysician"),
+    ("StudyDescription", "StudyDescription"),
+    ("RequestedProcedureID", "RequestedProcedureID"),
+    ("RequestedProcedureDescription", "RequestedProcedureDescription"),
+    ("SpecialNeeds", "SpecialNeeds"),
+]
+
+# ... and of its Scheduled Procedure Step Sequence item
+_STEP_FIELDS = [
+    ("ScheduledProcedureStepStartDate", "ScheduledProcedureStepStartDate"),
+    ("Modality", "Modality"),
+    ("ScheduledStationAETitle", "ScheduledStationAETitle"),
+    ("ScheduledPerformingPhysicianName", "ScheduledPerformingPhysician"),
+    ("ScheduledProcedureStepLocation", "ScheduledProcedureStepLocation"),
+    ("PreMedication", "PreMedication"),
+]
+
+# The fields a JSON order must have
+REQUIRED_FIELDS = [field for _, field in _ITEM_FIELDS + _STEP_FIELDS]
+
+# The (tag, VR, field) for each element, looked up once rather than per order
+_ITEM_ELEMENTS = [
+    (tag_for_keyword(keyword), dictionary_VR(keyword), field)
+    for keyword, field in _ITEM_FIELDS
+]
+_STEP_ELEMENTS = [
+    (tag_for_keyword(keyword), dictionary_VR(keyword), field)
+    for keyword, field in _STEP_FIELDS
+]
+
+# The (field, VR, whether multiple values are allowed) to check for each
+#   element
+_FIELD_CHECKS = [
+    (field, dictionary_VR(keyword), dictionary_VM(keyword) != "1")
+    for keyword, field in _ITEM_FIELDS + _STEP_FIELDS
+]
+
+# The maximum length of each VR in characters, for PN of each component group
+#   (Part 5, Table 6.2-1)
+_MAX_LENGTHS = {"AE": 16, "CS": 16, "DA": 8, "LO": 64, "PN": 64, "SH": 16}
+
+# Control characters other than ESC aren't allowed in the values
+_CONTROL_CHARACTERS = re.compile(r"[\x00-\x1a\x1c-\x1f\x7f]")
+_CS_VALUE = re.compile(r"[A-Z0-9 _]*")
+_DA_VALUE = re.compile(r"\d{8}")
+
+
+def _value_error(value, VR, multiple):
+    """Return why a JSON order `value` is invalid for `VR` or ``None``."""
+    if not isinstance(value, str):
+        return "must be a string"
+
+    if "\\" in value and not multiple:
+        return "must be a single value"
+
+    limit = _MAX_LENGTHS[VR]
+    for item in value.split("\\"):
+        if _CONTROL_CHARACTERS.search(item):
+            return "contains control characters"
+
+        groups = item.split("=") if VR == "PN" else [item]
+        if len(groups) > 3:
+            return "has more than 3 component groups"
+
+        if any(len(group) > limit for group in groups):
+            return f"is longer than {limit} characters"
+
+        if VR == "CS" and not _CS_VALUE.fullmatch(item):
+            return "may only contain A-Z, 0-9, space and underscore"
+
+        if VR == "DA" and item and not _is_date(item):
+            return "must be a date as YYYYMMDD"
+
+    return None
+
+
+def _is_date(value):
+    """Return ``True`` if `value` is a valid DA date as YYYYMMDD."""
+    if not _DA_VALUE.fullmatch(value):
+        return False
+
+    try:
+        datetime.date(int(value[:4]), int(value[4:6]), int(value[6:]))
+    except ValueError:
+        return False
+
+    return True
+
+
+def order_errors(json_data):
+    """Return the problems with a JSON order.
+
+    Each required field must be present and its value a string that's
+    valid for the VR of its element, so that nothing other than a valid
+    element value is stored.
+
+    Parameters
+    ----------
+    json_data : object
+        The decoded JSON order.
+
+    Returns
+    -------
+    list of str
+        A description of each problem, empty if the order is valid.
+    """
+    if not isinstance(json_data, dict):
+        return ["The order must be a JSON object"]
+
+    errors = []
+    missing = [field for field in REQUIRED_FIELDS if field not in json_data]
+    if missing:
+        errors.append(f"Missing fields: {', '.join(missing)}")
+
+    for field, VR, multiple in _FIELD_CHECKS:
+        if field in json_data:
+            reason = _value_error(json_data[field], VR, multiple)
+            if reason:
+                errors.append(f"{field} {reason}")
+
+    return errors
+
+
 def load_worklist_from_json(json_data):
-    ds = Dataset()
-    ds.PatientName = json_data['PatientName']
-    ds.PatientID = json_data['PatientID']
-    ds.PatientBirthDate = json_data['PatientBirthDate']
-    ds.PatientSex = json_data['PatientSex']
-    ds.StudyID = json_data['StudyID']
-    ds.AccessionNumber = json_data['AccessionNumber']
-    ds.ReferringPhysicianName = json_data['ReferringPhysician']
-    ds.StudyDescription = json_data['StudyDescription']
-
-    ds.ScheduledProcedureStepSequence = [Dataset()]
-    scheduled_procedure_step = ds.ScheduledProcedureStepSequence[0]
-    scheduled_procedure_step.ScheduledProcedureStepStartDate = json_data[
-        'ScheduledProcedureStepStartDate']
-    scheduled_procedure_step.Modality = json_data['Modality']
-    scheduled_procedure_step.ScheduledStationAETitle = json_data['ScheduledStationAETitle']
-    scheduled_procedure_step.ScheduledPerformingPhysicianName = json_data[
-        'ScheduledPerformingPhysician']
-    scheduled_procedure_step.ScheduledProcedureStepLocation = json_data[
-        'ScheduledProcedureStepLocation']
-    scheduled_procedure_step.PreMedication = json_data['PreMedication']
-
-    ds.ScheduledProcedureStepSequence = [scheduled_procedure_step]
-    ds.RequestedProcedureID = json_data['RequestedProcedureID']
-    ds.RequestedProcedureDescription = json_data['RequestedProcedureDescription']
-    ds.SpecialNeeds = json_data['SpecialNeeds']
+    """Return the worklist item for a JSON order.
+
+    The elements are created directly from the lookup tables without the
+    value validation done when setting a dataset attribute, as that's the
+    most expensive part of converting an order and the values are only
+    stored and returned.
+
+    Parameters
+    ----------
+    json_data : dict
+        The order, with all the fields in ``REQUIRED_FIELDS`` and no
+        :func:`order_errors`.
+
+    Returns
+    -------
+    pydicom.dataset.Dataset
+        The worklist item, with a single Scheduled Procedure Step.
+    """
+    step = Dataset(
+        {
+            tag: DataElement(tag, VR, json_data[field], validation_mode=IGNORE)
+            for tag, VR, field in _STEP_ELEMENTS
+        }
+    )
+    ds = Dataset(
+        {
+            tag: DataElement(tag, VR, json_data[field], validation_mode=IGNORE)
+            for tag, VR, field in _ITEM_ELEMENTS
+        }
+    )
+    ds.ScheduledProcedureStepSequence = [step]
 
     return ds
 
-def generate_dummy_data():
+
+def generate_dummy_data(worklist):
     # Load the dummy worklist JSON data
     with open('dummy_data/data.json', 'r') as file:
         worklist_data = json.load(file)
@@ -48,35 +192,29 @@ def generate_dummy_data():
     # Convert JSON data to Dataset
     ds = load_worklist_from_json(worklist_data)
 
-    # Assign the dataset to managed_instances[0]
-    # Assuming managed_instances is a list with at least one element
-    managed_instances[0] = ds
-
-    # Print out the dataset to verify
-    print(managed_instances[0])
-    
-def save_into_managed_instances(json_file_path):
-    """Save the JSON file data into the managed_instances dictionary."""
-    with open(json_file_path, 'r') as json_file:
-        worklist_data = json.load(json_file)
-        
-    # Convert JSON data to Dataset
-    ds = load_worklist_from_json(worklist_data)
-
-    # Assign the dataset to managed_instances[0]
-    # Assuming managed_instances is a list with at least one element
-    managed_instances[0] = ds
+    # Add the dataset to the worklist store
+    worklist.add(ds)
 
     # Print out the dataset to verify
-    print(managed_instances[0])
-    
+    print(ds)
     
-
-def handle_find(event):
-    """Handle a C-FIND request event."""
+def handle_find(event, worklist):
+    """Handle a Modality Worklist C-FIND request event.
+
+    Parameters
+    ----------
+    event : pynetdicom.events.Event
+        The C-FIND request :class:`~pynetdicom.events.Event`.
+    worklist : worklist.WorklistStore
+        The Modality Worklist to search.
+
+    Yields
+    ------
+    int, pydicom.dataset.Dataset or None
+        The C-FIND response's *Status* and if the *Status* is pending then
+        the dataset to be sent, otherwise ``None``.
+    """
     requestor = event.assoc.requestor
-    req = event.request
-    model =event.request.AffectedSOPClassUID
     ds = event.identifier
     timestamp = event.timestamp.strftime("%Y-%m-%d %H:%M:%S")
     addr, port = requestor.address, requestor.port
@@ -86,62 +224,26 @@ def handle_find(event):
     if 'ScheduledProcedureStepSequence' not in ds:
         # Failure
         yield 0xC000, None
-    
-    # item = ds.ScheduledStepAttributesSequence
-    item = ds.ScheduledProcedureStepSequence
-    schedule = item[0].ScheduledProcedureStepStartDate
-    ae_title = item[0].ScheduledStationAETitle
-
-    for uid, instance in managed_instances.items():
-        ScheduledProcedure = instance.get('ScheduledProcedureStepSequence')
-        matching = [
-            inst for inst in ScheduledProcedure if inst.ScheduledProcedureStepStartDate == schedule or inst.ScheduledAETitle == ae_title
-        ]
-    
-    for instance in matching:
+        return
+
+    # The matching on the indexed keys is done by the store, which returns
+    #   the responses already encoded for the negotiated transfer syntax
+    try:
+        matching = worklist.find(ds, UID(event.context.transfer_syntax))
+    except Exception as exc:
+        print("Exception occurred while searching the worklist")
+        print(exc)
+        yield 0xC001, None
+        return
+
+    for response in matching:
         # Check if C-CANCEL has been received
         if event.is_cancelled:
              yield (0xFE00, None)
              return
-        
-        # identifier = Dataset()
-        # identifier.PatientName = ds.PatientName
-        # identifier.ScheduledProcedureStepSequence = [Dataset()]
-        # identifier.ScheduledStationAETitle = instance.ScheduledStationAETitle
-        # identifier.ScheduledProcedureStepStartDate = instance.ScheduledProcedureStepStartDate
-        # identifier.Modality = instance.Modality
-        
-        # Create the identifier dataset
-        identifier = Dataset()
-        identifier.PatientName = ds.PatientName
-        # identifier.PatientID = ds.PatientID
-        # identifier.PatientBirthDate = ds.PatientBirthDate
-        # identifier.PatientSex = ds.PatientSex
-        # identifier.StudyID = ds.StudyID
-        # identifier.AccessionNumber = ds.AccessionNumber
-        # identifier.ReferringPhysicianName = ds.ReferringPhysician
-        # identifier.StudyDescription = ds.StudyDescription
-        
-        # Create the ScheduledProcedureStepSequence dataset
-        identifier.ScheduledProcedureStepSequence = [Dataset()]
-        scheduled_procedure_step = identifier.ScheduledProcedureStepSequence[0]
-        scheduled_procedure_step.ScheduledProcedureStepStartDate = instance.ScheduledProcedureStepStartDate
-        scheduled_procedure_step.Modality = instance.Modality
-        scheduled_procedure_step.ScheduledStationAETitle = instance.ScheduledStationAETitle
-        scheduled_procedure_step.ScheduledPerformingPhysicianName = instance.ScheduledPerformingPhysicianName
-        scheduled_procedure_step.ScheduledProcedureStepLocation = instance.ScheduledProcedureStepLocation
-        scheduled_procedure_step.PreMedication = instance.PreMedication
-        
-        # Add the ScheduledProcedureStepSequence to the identifier
-        identifier.ScheduledProcedureStepSequence = [scheduled_procedure_step]
-
-        # Continue adding the remaining fields directly to the identifier
-        # identifier.RequestedProcedureID = instance.RequestedProcedureID
-        # identifier.RequestedProcedureDescription = instance.RequestedProcedureDescription
-        # identifier.SpecialNeeds = instance.SpecialNeeds
-        
+
         # Pending
-        yield (0xFF00, identifier)
+        yield (0xFF00, response)
 
 # Implement the evt.EVT_N_CREATE handler
 def handle_create(event):
@@ -0,0 +1,387 @@
+"""A concurrent HTTP/1.1 server for the SCP's HTTP front end.
+
+Requests are handled by a fixed pool of worker threads, so a slow client only
+holds up its own request and the number of threads doesn't grow with the
+number of clients. Connections are kept alive between requests, and while a
+connection is idle it's watched by the server's selector rather than by a
+worker, so hundreds of open keep-alive connections only need a worker while
+one of their requests is being handled.
+
+Limits are applied to the number of open connections, the size of request
+bodies and how long a connection may be idle or a request may take, and
+:meth:`HTTPServer.shutdown` stops accepting connections and waits for the
+requests in progress to finish.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+import queue
+import selectors
+import socket
+import threading
+import time
+
+
+# The response sent to a connection over the limit before it's closed
+_BUSY_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n"
+    b"Retry-After: 1\r\n"
+    b"\r\n"
+)
+
+
+class HTTPRequestHandler(BaseHTTPRequestHandler):
+    """Base class for the request handlers of :class:`HTTPServer`.
+
+    Uses HTTP/1.1 so connections are kept alive, so every response must
+    have a ``Content-Length``. A request with a body larger than the
+    server's ``max_body_size``, or without a ``Content-Length``, is rejected
+    before it's passed to the ``do_*`` method unless its path is one of the
+    `streaming_paths`.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    # The paths whose handlers read the body as it's received rather than
+    #   all at once, so it isn't limited in size
+    streaming_paths = ()
+
+    def handle_expect_100(self):
+        # Reject the body before the client is told to send it
+        if not self._check_body():
+            return False
+
+        return super().handle_expect_100()
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+
+        return self._check_body()
+
+    def _check_body(self):
+        """Return ``True`` if the request's body is allowed, otherwise send
+        an error response and return ``False``.
+        """
+        if self.path.split("?", 1)[0] in self.streaming_paths:
+            return True
+
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            self.send_error(411, "A Content-Length is required")
+            return False
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.send_error(400, "Invalid Content-Length")
+            return False
+
+        limit = self.server.max_body_size
+        if length < 0 or (limit is not None and length > limit):
+            self.send_error(413, f"The request body is over {limit} bytes")
+            return False
+
+        return True
+
+
+class _Connection:
+    """A client connection and the handler for its requests."""
+
+    def __init__(self, sock, address, server):
+        self.sock = sock
+        self.idle_since = time.monotonic()
+        # The handler is kept for the life of the connection so its buffered
+        #   input isn't lost between requests
+        handler_class = server.handler_class
+        self.handler = handler_class.__new__(handler_class)
+        self.handler.request = sock
+        self.handler.client_address = address
+        self.handler.server = server
+        self.handler.setup()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def handle(self):
+        """Handle one request, return ``True`` if the connection stays open."""
+        handler = self.handler
+        handler.close_connection = True
+        handler.handle_one_request()
+
+        return not handler.close_connection
+
+    def has_buffered_input(self):
+        """Return ``True`` if the start of another request has been read."""
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            return bool(self.handler.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.sock.settimeout(timeout)
+
+    def close(self):
+        try:
+            self.handler.finish()
+        except OSError:
+            pass
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        self.sock.close()
+
+
+class HTTPServer:
+    """An HTTP/1.1 server with a bounded pool of worker threads.
+
+    Parameters
+    ----------
+    server_address : tuple of (str, int)
+        The address and port to listen on.
+    handler_class : type
+        The request handler, a subclass of :class:`HTTPRequestHandler`.
+    max_workers : int, optional
+        The number of requests handled at once (default ``16``).
+    max_connections : int, optional
+        The number of open connections, further connections get a ``503``
+        response and are closed (default ``1000``).
+    max_body_size : int or None, optional
+        The largest request body in bytes (default 1 MiB), ``None`` for no
+        limit.
+    keep_alive_timeout : float, optional
+        The time in seconds an idle connection is kept open (default
+        ``15``).
+    request_timeout : float, optional
+        The time in seconds a worker waits for the client while reading a
+        request or writing its response (default ``30``).
+    """
+
+    def __init__(
+        self,
+        server_address,
+        handler_class,
+        max_workers=16,
+        max_connections=1000,
+        max_body_size=1024 * 1024,
+        keep_alive_timeout=15,
+        request_timeout=30,
+    ):
+        self.handler_class = handler_class
+        self.max_workers = max_workers
+        self.max_connections = max_connections
+        self.max_body_size = max_body_size
+        self.keep_alive_timeout = keep_alive_timeout
+        self.request_timeout = request_timeout
+
+        self.socket = socket.create_server(server_address, backlog=1024)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+        # Used by BaseHTTPRequestHandler
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="http")
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.socket, selectors.EVENT_READ)
+        # Connections are returned to the selector by the workers through
+        #   the queue, the selector thread is woken by a byte on the pipe
+        self._returned = queue.SimpleQueue()
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+
+        self._lock = threading.Lock()
+        # All the open connections, idle or with a request in progress
+        self._connections = set()
+        self._busy = 0
+        self._stopping = threading.Event()
+        self._stopped = threading.Event()
+
+    def stats(self):
+        """Return the number of open connections and requests in progress."""
+        with self._lock:
+            return {"open": len(self._connections), "busy": self._busy}
+
+    def serve_forever(self):
+        """Accept connections and dispatch their requests until shutdown."""
+        last_expiry = time.monotonic()
+        try:
+            while not self._stopping.is_set():
+                for key, _ in self._selector.select(timeout=1.0):
+                    if key.fileobj is self.socket:
+                        self._accept()
+                    elif key.fileobj is self._wakeup:
+                        self._drain_wakeup()
+                    else:
+                        self._selector.unregister(key.fileobj)
+                        self._dispatch(key.fileobj)
+
+                self._reregister()
+
+                now = time.monotonic()
+                if now - last_expiry >= 1.0:
+                    self._expire(now)
+                    last_expiry = now
+        finally:
+            self._close_idle()
+            self._stopped.set()
+
+    def shutdown(self, timeout=None):
+        """Stop the server, letting the requests in progress finish.
+
+        New connections are refused and idle connections are closed at
+        once, a connection with a request in progress is closed after its
+        response is sent.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The time in seconds to wait for the server loop to stop, the
+            requests in progress are always waited for.
+        """
+        self._stopping.set()
+        self._wake()
+        self._stopped.wait(timeout)
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            remaining = list(self._connections)
+            self._connections.clear()
+
+        for conn in remaining:
+            conn.close()
+
+        self._wakeup.close()
+        self._waker.close()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # Such as too many open files, try again on the next event
+                return
+
+            sock.setblocking(True)
+            # Headers and body are written separately, don't delay the body
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                full = len(self._connections) >= self.max_connections
+
+            if full:
+                try:
+                    sock.settimeout(1.0)
+                    sock.sendall(_BUSY_RESPONSE)
+                except OSError:
+                    pass
+                sock.close()
+                continue
+
+            try:
+                conn = _Connection(sock, address, self)
+            except OSError:
+                sock.close()
+                continue
+
+            with self._lock:
+                self._connections.add(conn)
+
+            self._selector.register(conn, selectors.EVENT_READ)
+
+    def _dispatch(self, conn):
+        with self._lock:
+            self._busy += 1
+
+        try:
+            self._executor.submit(self._serve, conn)
+        except RuntimeError:
+            # The executor has been shut down
+            with self._lock:
+                self._busy -= 1
+
+            self._close(conn)
+
+    def _serve(self, conn):
+        """Handle the requests on `conn` that are ready, in a worker."""
+        keep_alive = False
+        try:
+            conn.sock.settimeout(self.request_timeout)
+            while True:
+                keep_alive = conn.handle() and not self._stopping.is_set()
+                # A pipelined request won't wake the selector if it's
+                #   already been read into the buffer
+                if not (keep_alive and conn.has_buffered_input()):
+                    break
+        except Exception as exc:
+            print(f"Error handling HTTP request: {exc}")
+            keep_alive = False
+        finally:
+            with self._lock:
+                self._busy -= 1
+
+        if keep_alive:
+            conn.idle_since = time.monotonic()
+            self._returned.put(conn)
+            self._wake()
+        else:
+            self._close(conn)
+
+    def _reregister(self):
+        """Watch the connections returned by the workers again."""
+        while True:
+            try:
+                conn = self._returned.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                self._selector.register(conn, selectors.EVENT_READ)
+            except (ValueError, OSError):
+                self._close(conn)
+
+    def _expire(self, now):
+        """Close the connections idle for longer than the keep-alive timeout."""
+        for key in list(self._selector.get_map().values()):
+            conn = key.fileobj
+            if not isinstance(conn, _Connection):
+                continue
+
+            if now - conn.idle_since > self.keep_alive_timeout:
+                self._selector.unregister(conn)
+                self._close(conn)
+
+    def _close_idle(self):
+        """Stop listening and close the idle connections."""
+        for key in list(self._selector.get_map().values()):
+            self._selector.unregister(key.fileobj)
+            if isinstance(key.fileobj, _Connection):
+                self._close(key.fileobj)
+
+        self._selector.close()
+        self.socket.close()
+
+    def _close(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+
+        conn.close()
+
+    def _wake(self):
+        try:
+            self._waker.send(b"\0")
+        except OSError:
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
@@ -0,0 +1,414 @@
+"""Metrics for the MPPS and Modality Worklist SCP.
+
+The metrics are reported in the Prometheus text format by the ``/metrics``
+endpoint of the HTTP server.
+
+The association threads never take a lock to update a metric: each thread
+updates its own shard of every counter and histogram, and a scrape sums the
+shards. A shard is only ever written by its own thread, so a scrape can read
+it at any time, and the only lock is taken once per thread when its shard is
+created. As pynetdicom runs a thread per association, when a thread exits its
+shard is folded into a retired total, so the number of shards stays at the
+number of live threads.
+"""
+
+import abc
+from bisect import bisect_left
+import functools
+import inspect
+import threading
+import time
+import weakref
+
+
+# The upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# The latency quantiles to report
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class _Holder:
+    """A thread's reference to its shard, released when the thread exits."""
+
+    __slots__ = ("shard", "__weakref__")
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class _Sharded(abc.ABC):
+    """Per-thread storage for a metric, so updates need no lock."""
+
+    def __init__(self):
+        self._local = threading.local()
+        # Re-entrant as a shard may be retired by the garbage collector
+        #   while the lock is held
+        self._lock = threading.RLock()
+        self._shards = []
+        # The merged shards of the threads that have exited
+        self._retired = self._new_shard()
+
+    @abc.abstractmethod
+    def _new_shard(self):
+        """Return an empty shard."""
+
+    @abc.abstractmethod
+    def _merge(self, total, shard):
+        """Add the values in `shard` to those in `total`."""
+
+    def _shard(self):
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            holder = self._local.holder = _Holder(self._new_shard())
+            with self._lock:
+                self._shards.append(holder.shard)
+
+            # The thread-local holder is released when the thread exits
+            weakref.finalize(holder, self._retire, holder.shard)
+
+        return holder.shard
+
+    def _retire(self, shard):
+        """Fold the shard of a thread that has exited into the retired total."""
+        with self._lock:
+            self._shards = [other for other in self._shards if other is not shard]
+            self._merge(self._retired, shard)
+
+    def shards(self):
+        """Return a copy of the list of the live threads' shards."""
+        with self._lock:
+            return list(self._shards)
+
+    def _totals(self):
+        """Return the retired total merged with the live threads' shards."""
+        totals = self._new_shard()
+        with self._lock:
+            self._merge(totals, self._retired)
+            shards = list(self._shards)
+
+        for shard in shards:
+            # Copying a dict is atomic, the owner may be adding a key
+            self._merge(totals, shard.copy())
+
+        return totals
+
+
+class Counter(_Sharded):
+    """A monotonically increasing count for each set of label values."""
+
+    def _new_shard(self):
+        return {}
+
+    def _merge(self, total, shard):
+        for labels, value in shard.items():
+            total[labels] = total.get(labels, 0) + value
+
+    def inc(self, labels=(), amount=1):
+        """Increase the count for `labels` by `amount`.
+
+        Parameters
+        ----------
+        labels : tuple of str, optional
+            The label values.
+        amount : int, optional
+            The amount to increase the count by (default ``1``).
+        """
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self):
+        """Return the total for each set of label values as a :class:`dict`."""
+        return self._totals()
+
+
+class Histogram(_Sharded):
+    """A latency histogram with fixed buckets for each set of label values.
+
+    Parameters
+    ----------
+    buckets : sequence of float, optional
+        The upper bounds of the buckets in seconds, in increasing order.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        super().__init__()
+        self.buckets = tuple(buckets)
+
+    def _new_shard(self):
+        return {}
+
+    def _merge(self, total, shard):
+        for labels, counts in shard.items():
+            counts = list(counts)
+            merged = total.setdefault(labels, [0] * len(counts))
+            for index, value in enumerate(counts):
+                merged[index] += value
+
+    def observe(self, labels, value):
+        """Add a `value` in seconds for `labels`."""
+        shard = self._shard()
+        # [bucket counts..., overflow count, sum]
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def values(self):
+        """Return the merged counts for each set of label values.
+
+        Returns
+        -------
+        dict
+            ``{labels: (bucket counts, sum)}``, with a final overflow bucket.
+        """
+        return {
+            labels: (counts[:-1], counts[-1])
+            for labels, counts in self._totals().items()
+        }
+
+    def quantile(self, counts, q):
+        """Return an estimate of the `q` quantile from the bucket `counts`.
+
+        The estimate interpolates within the bucket containing the quantile,
+        values in the overflow bucket are reported as the last bound.
+        """
+        count = sum(counts)
+        if not count:
+            return 0.0
+
+        rank = q * count
+        lower = 0.0
+        total = 0
+        for bound, bucket in zip(self.buckets, counts):
+            if bucket and total + bucket >= rank:
+                return lower + (bound - lower) * (rank - total) / bucket
+
+            total += bucket
+            lower = bound
+
+        return self.buckets[-1]
+
+
+class Metrics:
+    """The SCP's metrics.
+
+    Attributes
+    ----------
+    connections : Counter
+        The number of connections opened and closed, labelled by ``event``.
+    operations : Counter
+        The number of DIMSE requests, labelled by ``type``.
+    responses : Counter
+        The number of responses sent, labelled by ``type`` and ``status``.
+    latency : Histogram
+        The time taken to handle each request, labelled by ``type``.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.connections = Counter()
+        self.operations = Counter()
+        self.responses = Counter()
+        self.latency = Histogram()
+        # {metric name: (help, callable returning the value)}
+        self._gauges = {}
+        # The time and operation totals from the previous scrape
+        self._scrape_lock = threading.Lock()
+        self._previous = (self.start, {})
+
+    def gauge(self, name, help_text, func):
+        """Add a gauge whose value is returned by `func` at each scrape.
+
+        Parameters
+        ----------
+        name : str
+            The metric name.
+        help_text : str
+            The metric's description.
+        func : callable
+            Returns the current value, or a :class:`dict` of
+            ``{label string: value}`` for a labelled gauge.
+        """
+        self._gauges[name] = (help_text, func)
+
+    def on_connection_open(self, event):
+        """Handler for ``evt.EVT_CONN_OPEN``."""
+        self.connections.inc(("open",))
+
+    def on_connection_close(self, event):
+        """Handler for ``evt.EVT_CONN_CLOSE``."""
+        self.connections.inc(("close",))
+
+    def instrument(self, operation, handler):
+        """Return `handler` wrapped to record its requests and responses.
+
+        Parameters
+        ----------
+        operation : str
+            The DIMSE service, such as ``"C-FIND"``.
+        handler : callable
+            The event handler, which either returns a ``(status, dataset)``
+            or is a generator yielding them.
+
+        Returns
+        -------
+        callable
+            The wrapped handler.
+        """
+        if inspect.isgeneratorfunction(handler):
+
+            @functools.wraps(handler)
+            def wrapper(event, *args):
+                self.operations.inc((operation,))
+                start = time.perf_counter()
+                try:
+                    for status, dataset in handler(event, *args):
+                        self.responses.inc((operation, _status(status)))
+                        yield status, dataset
+                finally:
+                    self.latency.observe((operation,), time.perf_counter() - start)
+
+            return wrapper
+
+        @functools.wraps(handler)
+        def wrapper(event, *args):
+            self.operations.inc((operation,))
+            start = time.perf_counter()
+            try:
+                status, dataset = handler(event, *args)
+                self.responses.inc((operation, _status(status)))
+                return status, dataset
+            finally:
+                self.latency.observe((operation,), time.perf_counter() - start)
+
+        return wrapper
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        now = time.monotonic()
+        operations = self.operations.values()
+        with self._scrape_lock:
+            previous_time, previous = self._previous
+            self._previous = (now, operations)
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        connections = self.connections.values()
+        opened = connections.get(("open",), 0)
+        metric(
+            "dicom_active_associations",
+            "gauge",
+            "The number of open associations.",
+            [("", opened - connections.get(("close",), 0))],
+        )
+        metric(
+            "dicom_associations_total",
+            "counter",
+            "The number of associations received.",
+            [("", opened)],
+        )
+        metric(
+            "dicom_dimse_operations_total",
+            "counter",
+            "The number of DIMSE requests received.",
+            [
+                (_labels(type=op), value)
+                for (op,), value in sorted(operations.items())
+            ],
+        )
+        elapsed = max(now - previous_time, 1e-9)
+        metric(
+            "dicom_dimse_operations_per_second",
+            "gauge",
+            "The rate of DIMSE requests since the previous scrape.",
+            [
+                (_labels(type=op), (value - previous.get((op,), 0)) / elapsed)
+                for (op,), value in sorted(operations.items())
+            ],
+        )
+        metric(
+            "dicom_responses_total",
+            "counter",
+            "The number of responses sent, by status.",
+            [
+                (_labels(type=op, status=status), value)
+                for (op, status), value in sorted(self.responses.values().items())
+            ],
+        )
+
+        # A summary, with the quantiles estimated from the histogram buckets
+        name = "dicom_request_latency_seconds"
+        samples = []
+        for (op,), (counts, total) in sorted(self.latency.values().items()):
+            for q in QUANTILES:
+                value = self.latency.quantile(counts, q)
+                samples.append((_labels(type=op, quantile=q), value))
+
+            samples.append((f"_sum{_labels(type=op)}", total))
+            samples.append((f"_count{_labels(type=op)}", sum(counts)))
+
+        metric(name, "summary", "The time taken to handle each request.", samples)
+
+        for name, (help_text, func) in self._gauges.items():
+            value = func()
+            if isinstance(value, dict):
+                samples = sorted(value.items())
+            else:
+                samples = [("", value)]
+
+            metric(name, "gauge", help_text, samples)
+
+        metric(
+            "dicom_uptime_seconds",
+            "gauge",
+            "The time since the SCP started.",
+            [("", now - self.start)],
+        )
+
+        return "\n".join(lines) + "\n"
+
+
+def _status(status):
+    """Return the status from a handler as a hex string."""
+    # The status may be a Dataset with a Status element
+    status = getattr(status, "Status", status)
+
+    return f"0x{status:04X}"
+
+
+def _labels(**labels):
+    """Return the Prometheus label string for `labels`."""
+    if not labels:
+        return ""
+
+    pairs = ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+    return f"{{{pairs}}}"
+
+
+# The process-wide metrics
+METRICS = Metrics()
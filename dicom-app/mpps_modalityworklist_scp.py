@@ -1,8 +1,11 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import codecs
+from itertools import chain
+import signal
 import threading
 import json
 import subprocess
 import tempfile
+from urllib.parse import parse_qs, urlsplit
 from pydicom.dataset import Dataset
 from pydicom.uid import generate_uid
 from pynetdicom import AE, evt
@@ -13,6 +16,9 @@ from pynetdicom.sop_class import (
 )
 
 import handlers as hd
+from httpserver import HTTPRequestHandler, HTTPServer
+from metrics import METRICS
+from worklist import WorklistStore
 import argparse
 import os
 import db
@@ -24,6 +30,15 @@ import sys
 __aetitle__ = "admin-scp"
 __version__ = "0.6.0"
 
+# The number of orders added to the worklist per transaction by a bulk import
+IMPORT_BATCH_SIZE = 1000
+
+# The size of each read of a bulk import's request body
+_READ_SIZE = 64 * 1024
+
+# The largest JSON array element a bulk import will buffer
+_MAX_RECORD_SIZE = 1024 * 1024
+
 def _setup_argparser():
     parser = argparse.ArgumentParser(
         description=(
@@ -83,59 +98,383 @@ def _setup_argparser():
         type=str,
         default="app/data/CTImageStorage.dcm"  # Default value set to "data/"
     )
+    db_opts.add_argument(
+        "--response-cache-size",
+        metavar="[n]umber",
+        help="the number of encoded worklist responses cached (default: 10000)",
+        type=int,
+        default=10000,
+    )
+
+    # HTTP
+    http_opts = parser.add_argument_group("HTTP Options")
+    http_opts.add_argument(
+        "--http-workers",
+        metavar="[n]umber",
+        help="the number of HTTP requests handled at once (default: 16)",
+        type=int,
+        default=16,
+    )
+    http_opts.add_argument(
+        "--http-max-connections",
+        metavar="[n]umber",
+        help="the number of open HTTP connections allowed (default: 1000)",
+        type=int,
+        default=1000,
+    )
+    http_opts.add_argument(
+        "--http-max-body-size",
+        metavar="[b]ytes",
+        help=(
+            "the largest HTTP request body, except for a bulk import "
+            "(default: 1 MiB)"
+        ),
+        type=int,
+        default=1024 * 1024,
+    )
+    http_opts.add_argument(
+        "--http-keep-alive-timeout",
+        metavar="[s]econds",
+        help="the time an idle HTTP connection is kept open (default: 15 s)",
+        type=float,
+        default=15,
+    )
 
     return parser.parse_args()
 
+def _store_sizes(worklist):
+    """Return the number of worklist steps and managed MPPS instances."""
+    return {
+        '{store="worklist"}': worklist.count(),
+        '{store="mpps"}': len(hd.managed_instances),
+    }
+
+
+def _pool_status(pool):
+    """Return the worklist database's connection pool size and usage."""
+    return {
+        '{stat="pool_size"}': pool.size(),
+        '{stat="checked_out_connections"}': pool.checkedout(),
+        '{stat="overflow"}': pool.overflow(),
+    }
+
+
+def _iter_body(rfile, headers):
+    """Yield the request body in pieces as it's received.
+
+    Parameters
+    ----------
+    rfile : io.BufferedIOBase
+        The request's input stream.
+    headers : email.message.Message
+        The request headers, the body must have either a ``Content-Length``
+        or a chunked ``Transfer-Encoding``.
+
+    Yields
+    ------
+    bytes
+        The next piece of the body.
+    """
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        while True:
+            line = rfile.readline()
+            try:
+                size = int(line.split(b";", 1)[0], 16)
+            except ValueError:
+                raise ValueError(f"Invalid chunk size {line!r}")
+
+            if not size:
+                # Skip any trailer fields
+                while rfile.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+
+            yield from _read(rfile, size)
+            rfile.readline()
+
+    yield from _read(rfile, int(headers["Content-Length"]))
+
+
+def _read(rfile, size):
+    """Yield `size` bytes from `rfile` in pieces."""
+    while size:
+        data = rfile.read(min(size, _READ_SIZE))
+        if not data:
+            raise ValueError("The request body ended early")
+
+        size -= len(data)
+        yield data
+
+
+def _iter_records(pieces):
+    """Yield each record of a JSON array or newline-delimited JSON body.
+
+    The format is decided by the first character of the body, a body
+    starting with ``[`` is a JSON array and anything else is one record per
+    line. A line that isn't valid JSON is reported and the next line is
+    read, but a JSON array can't be read past an invalid record so the
+    body can't be read any further.
+
+    Parameters
+    ----------
+    pieces : iterable of bytes
+        The body, as it's received.
+
+    Yields
+    ------
+    object or None, str or None
+        The decoded record, or ``None`` and why it couldn't be decoded.
+
+    Raises
+    ------
+    ValueError
+        If the body can't be read, including a JSON array that's invalid or
+        isn't closed.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    text = (decoder.decode(piece) for piece in chain(pieces, [b""]))
+    buffer = ""
+    for piece in text:
+        buffer += piece
+        if buffer.strip():
+            break
+
+    buffer = buffer.lstrip()
+    if buffer.startswith("["):
+        yield from _iter_array(buffer[1:], text)
+    else:
+        yield from _iter_lines(buffer, text)
+
+
+def _iter_lines(buffer, text):
+    """Yield the records of a newline-delimited JSON body."""
+    pending = ""
+    for piece in chain([buffer], text):
+        lines = (pending + piece).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield _decode(line)
+
+    if pending.strip():
+        yield _decode(pending)
+
+
+def _decode(line):
+    try:
+        return json.loads(line), None
+    except ValueError as exc:
+        return None, f"Invalid JSON: {exc}"
+
+
+def _iter_array(buffer, text):
+    """Yield the elements of a JSON array body, after its opening bracket."""
+    decoder = json.JSONDecoder()
+    pos = 0
+    while True:
+        # Skip to the start of the next element
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+
+        if pos == len(buffer):
+            piece = next(text, None)
+            if piece is None:
+                raise ValueError("The JSON array isn't closed")
+
+            buffer, pos = piece, 0
+            continue
+
+        if buffer[pos] == "]":
+            return
+
+        try:
+            record, pos = decoder.raw_decode(buffer, pos)
+        except ValueError as exc:
+            # The element may continue in the next piece of the body
+            piece = next(text, None)
+            if piece is None or len(buffer) - pos > _MAX_RECORD_SIZE:
+                raise ValueError(f"Invalid JSON: {exc}")
+
+            buffer, pos = buffer[pos:] + piece, 0
+            continue
+
+        yield record, None
+
+
+def _import_batch(worklist, batch):
+    """Add a batch of orders to the worklist in a single transaction.
+
+    Parameters
+    ----------
+    worklist : worklist.WorklistStore
+        The Modality Worklist.
+    batch : list of (int, str, pydicom.dataset.Dataset)
+        The index in the body, *Accession Number* and worklist item of each
+        order.
+
+    Returns
+    -------
+    list of dict
+        The result for each order.
+    """
+    try:
+        worklist.add_many([ds for _, _, ds in batch])
+    except Exception as exc:
+        print(f"Failed to import {len(batch)} orders: {exc}")
+        return [
+            {
+                "index": index,
+                "accession_number": accession_number,
+                "status": "failed",
+                "error": str(exc),
+            }
+            for index, accession_number, _ in batch
+        ]
+
+    return [
+        {"index": index, "accession_number": accession_number, "status": "imported"}
+        for index, accession_number, _ in batch
+    ]
+
+
 # Handlers for HTTP requests
-class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
+class SimpleHTTPRequestHandler(HTTPRequestHandler):
+    # The bulk import reads its body as it arrives, so has no size limit
+    streaming_paths = ("/worklist/import",)
+
+    def _send_json(self, status, response):
+        # Keep-alive needs the Content-Length of every response
+        body = json.dumps(response).encode()
+        self.send_response(status)
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
         self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/worklist":
+            self._list_worklist(parse_qs(url.query))
+            return
+
+        if self.path == "/metrics":
+            body = METRICS.render().encode()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
 
         response = {
             "message": "HTTP server is running"
         }
-        self.wfile.write(json.dumps(response).encode())
+        self._send_json(200, response)
+
+    def _list_worklist(self, query):
+        """Send the worklist, or the changes to it since ``?since=<seq>``.
+
+        The ETag is the worklist's last change sequence number, so a poll
+        with a matching ``If-None-Match`` gets a ``304``, and one with a
+        ``since`` of the last number no changes, without the database being
+        read. The
+        number to poll from next is the ``seq`` in the response, if
+        ``more`` is set then the response was cut short by ``?limit=<n>``
+        and there are more changes after it. If ``full`` is set then
+        ``items`` is the whole worklist rather than the changes, such as
+        when ``since`` is from another database, and replaces any copy the
+        client has.
+        """
+        worklist = self.server.worklist
+        try:
+            since = query.get("since")
+            since = None if since is None else int(since[-1])
+            limit = query.get("limit")
+            limit = None if limit is None else int(limit[-1])
+        except ValueError:
+            self._send_json(400, {"message": "since and limit must be integers"})
+            return
+
+        if (since is not None and since < 0) or (limit is not None and limit < 1):
+            self._send_json(400, {"message": "Invalid since or limit"})
+            return
+
+        etag = f'"{worklist.seq}"'
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if etag in tags or "*" in tags:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+
+        changes = worklist.changes(since, limit)
+        # The datasets are already JSON, so they're joined as they are
+        items = ", ".join(
+            f'{{"seq": {seq}, "dataset": {dataset}}}'
+            for seq, dataset in changes["items"]
+        )
+        deleted = json.dumps(
+            [
+                {
+                    "seq": seq,
+                    "AccessionNumber": accession_number,
+                    "RequestedProcedureID": requested_procedure_id,
+                    "ScheduledProcedureStepID": step_id,
+                }
+                for seq, accession_number, requested_procedure_id, step_id in (
+                    changes["deleted"]
+                )
+            ]
+        )
+        body = (
+            f'{{"seq": {changes["seq"]}, "full": {json.dumps(changes["full"])}, '
+            f'"more": {json.dumps(changes["more"])}, "items": [{items}], '
+            f'"deleted": {deleted}}}'
+        ).encode()
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header("ETag", etag)
+        # Caches must check the ETag, the worklist changes at any time
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
 
     def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
+        if self.path == "/worklist/import":
+            self._import_worklist()
+            return
+
+        content_length = int(self.headers.get('Content-Length') or 0)
         post_data = self.rfile.read(content_length)
-        patient_data = json.loads(post_data)
+        try:
+            patient_data = json.loads(post_data)
+        except ValueError:
+            self._send_json(400, {"message": "Invalid JSON"})
+            return
 
         # Validate the received data
-        required_fields = ['PatientName', 'PatientID',
-                           'PatientBirthDate', 'PatientSex',
-                           'StudyID', 'AccessionNumber',
-                           'ReferringPhysician', 'StudyDescription',
-                           'ScheduledProcedureStepStartDate',
-                           'Modality', 'RequestedProcedureID',
-                           'RequestedProcedureDescription',
-                           'ScheduledStationAETitle',
-                           'ScheduledPerformingPhysician',
-                           'ScheduledProcedureStepLocation',
-                           'PreMedication', 'SpecialNeeds']
-
-        if all(field in patient_data for field in required_fields):
+        errors = hd.order_errors(patient_data)
+        if not errors:
+            # Add or update the item, keyed on its Accession Number
+            ds = hd.load_worklist_from_json(patient_data)
+            self.server.worklist.add(ds)
+
+            # Print out the dataset to verify
+            print(ds)
+
             # Respond that the data was received
             response = {
                 "message": "Data received successfully",
                 "data": patient_data
             }
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(response).encode())
-            
-           # Write the JSON data to the specified file
-            json_file_path = 'dummy-data/data1.json'
-            os.makedirs(os.path.dirname(json_file_path), exist_ok=True)
-            with open(json_file_path, 'w') as json_file:
-                json.dump(patient_data, json_file)
-
-            # Save the JSON file data into managed_instances dict
-            hd.save_into_managed_instances(json_file_path)
-            
+            self._send_json(200, response)
+
             # Execute the external script with the temporary file path
             # try:
             #     subprocess.run(["python3", "mpps_scu_create.py",
@@ -145,22 +484,121 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
         else:
             response = {
                 "message": "Invalid data format",
+                "errors": errors,
                 "data": patient_data
             }
-            self.send_response(400)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(response).encode())
+            self._send_json(400, response)
+
+    def _import_worklist(self):
+        """Add the orders in the request body to the worklist.
+
+        The body is either a JSON array of orders or one order per line
+        (newline-delimited JSON), and is read and decoded as it's received.
+        Each order is checked for the required fields and converted, and the
+        valid orders are added to the worklist in batches of
+        ``IMPORT_BATCH_SIZE``, so a large backfill is neither held in memory
+        nor committed one order at a time. The response has the result for
+        each order in the body.
+
+        If the body can't be read past some point, such as an invalid
+        element of a JSON array, the orders before it are imported and the
+        response is a ``400`` with the ``error`` and, as ``unread_from``,
+        the index of the first order that wasn't read. The orders from
+        there on aren't imported and the connection is closed.
+        """
+        chunked = self.headers.get("Transfer-Encoding", "").lower() == "chunked"
+        if not chunked and "Content-Length" not in self.headers:
+            self.send_error(411)
+            return
+
+        worklist = self.server.worklist
+        results = []
+        batch = []
+        error = None
+        # The number of records read from the body
+        nr_read = 0
+        try:
+            records = _iter_records(_iter_body(self.rfile, self.headers))
+            for index, (record, reason) in enumerate(records):
+                nr_read += 1
+                accession_number = None
+                if isinstance(record, dict):
+                    accession_number = record.get("AccessionNumber")
+
+                if reason is None:
+                    errors = hd.order_errors(record)
+                    if errors:
+                        reason = "; ".join(errors)
+
+                if reason is None:
+                    try:
+                        ds = hd.load_worklist_from_json(record)
+                    except Exception as exc:
+                        reason = str(exc)
+                    else:
+                        batch.append((index, accession_number, ds))
+
+                if reason is not None:
+                    results.append(
+                        {
+                            "index": index,
+                            "accession_number": accession_number,
+                            "status": "failed",
+                            "error": reason,
+                        }
+                    )
+
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    results.extend(_import_batch(worklist, batch))
+                    batch = []
+        except ValueError as exc:
+            # The body couldn't be read, the orders before it are imported
+            error = str(exc)
+
+        if batch:
+            results.extend(_import_batch(worklist, batch))
+
+        results.sort(key=lambda result: result["index"])
+        imported = sum(result["status"] == "imported" for result in results)
+        print(
+            f"Imported {imported} of {len(results)} worklist orders"
+            + (f" ({error})" if error else "")
+        )
+
+        response = {
+            "imported": imported,
+            "failed": len(results) - imported,
+            "results": results,
+        }
+        if error:
+            # The rest of the body can't be found, so the connection can't
+            #   be reused
+            response["error"] = error
+            response["unread_from"] = nr_read
+            self.close_connection = True
+
+        self._send_json(400 if error else 200, response)
 
 # Function to start the HTTP server
-def start_http_server():
+def start_http_server(worklist, args):
     server_address = ('localhost', 8080)
-    httpd = HTTPServer(server_address, SimpleHTTPRequestHandler)
-    print("HTTP server running on port 8080")
-    httpd.serve_forever()
+    httpd = HTTPServer(
+        server_address,
+        SimpleHTTPRequestHandler,
+        max_workers=args.http_workers,
+        max_connections=args.http_max_connections,
+        max_body_size=args.http_max_body_size,
+        keep_alive_timeout=args.http_keep_alive_timeout,
+    )
+    httpd.worklist = worklist
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    print(f"HTTP server running on port 8080 ({args.http_workers} workers)")
+
+    return httpd
 
 # Function to start the DICOM AE server
-def start_dicom_ae():
+def start_dicom_ae(worklist):
     
     ae = AE(ae_title=__aetitle__)
 
@@ -169,24 +607,80 @@ def start_dicom_ae():
     ae.add_supported_context(ModalityWorklistInformationFind)
     ae.add_supported_context(PatientRootQueryRetrieveInformationModelFind)
 
-    handlers = [(evt.EVT_N_CREATE, hd.handle_create),
-                (evt.EVT_N_SET, hd.handle_set),
-                (evt.EVT_C_FIND, hd.handle_find)]
+    handlers = [
+        (evt.EVT_N_CREATE, METRICS.instrument("N-CREATE", hd.handle_create)),
+        (evt.EVT_N_SET, METRICS.instrument("N-SET", hd.handle_set)),
+        (
+            evt.EVT_C_FIND,
+            METRICS.instrument("C-FIND", hd.handle_find),
+            [worklist],
+        ),
+        (evt.EVT_CONN_OPEN, METRICS.on_connection_open),
+        (evt.EVT_CONN_CLOSE, METRICS.on_connection_close),
+    ]
     
     # Generate dummy data
-    # hd.generate_dummy_data()
+    # hd.generate_dummy_data(worklist)
     
     # Start listening for incoming association requests
+    server = ae.start_server(
+        ("127.0.0.1", 1234), block=False, evt_handlers=handlers
+    )
     print("DICOM AE server running on port 1234")
-    ae.start_server(("127.0.0.1", 1234), evt_handlers=handlers)
-    
+
+    return server
+
 # Run both servers in parallel
 if __name__ == "__main__":
-    http_thread = threading.Thread(target=start_http_server)
-    dicom_thread = threading.Thread(target=start_dicom_ae)
+    args = _setup_argparser()
+
+    # The worklist is kept in the database, so survives a restart
+    current_dir = os.path.abspath(os.path.dirname(__file__))
+    db_path = os.path.join(current_dir, args.database_location)
+    worklist = WorklistStore(
+        db_path, response_cache_size=args.response_cache_size
+    )
+    print(f"Worklist database: {db_path} ({worklist.count()} scheduled steps)")
+
+    METRICS.gauge(
+        "dicom_managed_instances",
+        "The number of managed instances in each store.",
+        lambda: _store_sizes(worklist),
+    )
+
+    METRICS.gauge(
+        "dicom_worklist_response_cache",
+        "The size of the worklist C-FIND response cache and its hits and misses.",
+        lambda: {
+            f'{{stat="{stat}"}}': value
+            for stat, value in worklist.response_cache.info().items()
+        },
+    )
+
+    METRICS.gauge(
+        "dicom_worklist_db_pool",
+        "The worklist database's pool size, checked out and overflow connections.",
+        lambda: _pool_status(worklist.engine.pool),
+    )
+
+    httpd = start_http_server(worklist, args)
+    METRICS.gauge(
+        "http_connections",
+        "The number of open HTTP connections and those with a request.",
+        lambda: {
+            f'{{state="{state}"}}': value for state, value in httpd.stats().items()
+        },
+    )
+    dicom_server = start_dicom_ae(worklist)
 
-    http_thread.start()
-    dicom_thread.start()
+    # Run until interrupted or terminated, then let the requests in
+    #   progress finish
+    stopping = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    while not stopping.is_set():
+        stopping.wait(1)
 
-    http_thread.join()
-    dicom_thread.join()
+    print("Shutting down")
+    httpd.shutdown()
+    dicom_server.shutdown()
@@ -0,0 +1,82 @@
+"""Tests for the C-FIND response cache in worklist.py.
+
+Run from the dicom-app directory::
+
+    python -m pytest test_worklist.py
+"""
+
+from pydicom.dataelem import RawDataElement
+from pydicom.dataset import Dataset
+from pydicom.uid import ExplicitVRLittleEndian
+from pynetdicom.dsutils import encode, pretty_dataset
+import pytest
+
+from handlers import load_worklist_from_json
+from worklist import WorklistStore
+
+
+ORDER = {
+    "PatientName": "DOE^JOHN",
+    "PatientID": "123456",
+    "PatientBirthDate": "19800101",
+    "PatientSex": "M",
+    "StudyID": "78910",
+    "AccessionNumber": "A12345",
+    "ReferringPhysician": "Dr. Smith",
+    "StudyDescription": "Chest X-Ray",
+    "ScheduledProcedureStepStartDate": "20181005",
+    "Modality": "CT",
+    "RequestedProcedureID": "RP12345",
+    "RequestedProcedureDescription": "Routine Chest X-Ray",
+    "ScheduledStationAETitle": "CTSCANNER",
+    "ScheduledPerformingPhysician": "Dr. Brown",
+    "ScheduledProcedureStepLocation": "Radiology Dept",
+    "PreMedication": "None",
+    "SpecialNeeds": "Wheelchair access",
+}
+
+
+@pytest.fixture
+def worklist(tmp_path):
+    worklist = WorklistStore(str(tmp_path / "worklist.sqlite"))
+    worklist.add(load_worklist_from_json(ORDER))
+    yield worklist
+
+    worklist.engine.dispose()
+
+
+def _identifier():
+    identifier = Dataset()
+    identifier.PatientName = ""
+    identifier.AccessionNumber = ""
+    step = Dataset()
+    step.Modality = "CT"
+    step.ScheduledProcedureStepStartDate = ""
+    identifier.ScheduledProcedureStepSequence = [step]
+
+    return identifier
+
+
+def _is_raw(ds):
+    return all(isinstance(ds.get_item(tag), RawDataElement) for tag in ds.keys())
+
+
+def test_cached_response_stays_encoded_after_sending(worklist):
+    """Sending a response, which decodes its elements when pynetdicom logs
+    it, doesn't decode the cached response.
+    """
+    (response,) = worklist.find(_identifier(), ExplicitVRLittleEndian)
+    assert _is_raw(response)
+    expected = encode(response, False, True)
+
+    # As pynetdicom's C-FIND service does for each response
+    pretty_dataset(response)
+    assert not _is_raw(response)
+    assert encode(response, False, True) == expected
+
+    (cached,) = worklist.find(_identifier(), ExplicitVRLittleEndian)
+    assert worklist.response_cache.info()["hits"] == 1
+    assert cached is not response
+    assert _is_raw(cached)
+    assert cached.PatientName == "DOE^JOHN"
+    assert encode(cached, False, True) == expected
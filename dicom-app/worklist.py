@@ -0,0 +1,1132 @@
+"""Persistent store for the Modality Worklist.
+
+Each Scheduled Procedure Step is a row of the ``worklist_item`` table, with
+the keys that modalities query on in indexed columns and the whole worklist
+item, with only that step in its *Scheduled Procedure Step Sequence*, saved
+as DICOM JSON. A worklist item with several steps is stored as one row per
+step, as each step is a separate C-FIND match (Part 4, Annex K.6).
+
+Rows are keyed on the *Accession Number*, *Requested Procedure ID* and
+*Scheduled Procedure Step ID*, so sending an order again updates it rather
+than adding a duplicate.
+
+The store also keeps in-memory inverted indexes of the steps by *Scheduled
+Station AE Title*, *Scheduled Procedure Step Start Date* and *Modality*,
+which are used to find the candidate rows for a query before the database
+is searched, so a modality polling for its own day's worklist only reads
+its own steps.
+
+The C-FIND responses are cached already encoded, as modalities poll for the
+same items many times a day. A response depends on the item, the keys in
+the request and the transfer syntax, so that's the cache key, and the
+cached responses for an item are dropped when it's updated or removed.
+
+Every change is numbered from a sequence that only increases: each row has
+the number of its last update in ``seq``, and a removed step leaves a row in
+``worklist_deletion`` with the number of its removal. A client that has
+synced up to a number only needs the changes after it (see
+:meth:`WorklistStore.changes`), and the last number is kept in memory so a
+client that's up to date is told so without reading the database.
+"""
+
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from io import BytesIO
+import json
+import threading
+
+from pydicom.dataelem import DataElement
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filereader import read_dataset
+from pydicom.filewriter import write_dataset
+from pydicom.multival import MultiValue
+from sqlalchemy import (
+    bindparam,
+    create_engine,
+    delete,
+    event,
+    func,
+    inspect,
+    select,
+    text,
+    Column,
+    Index,
+    Integer,
+    String,
+    Text,
+)
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+
+Base = declarative_base()
+
+
+# Translate from the element keyword to the column for the matching keys
+#   at the top level of the worklist item
+_ITEM_COLUMNS = {
+    "AccessionNumber": "accession_number",  # SH
+    "RequestedProcedureID": "requested_procedure_id",  # SH
+    "PatientID": "patient_id",  # LO
+    "PatientName": "patient_name",  # PN
+}
+
+# ... and in the Scheduled Procedure Step Sequence item
+_STEP_COLUMNS = {
+    "ScheduledProcedureStepID": "scheduled_procedure_step_id",  # SH
+    "ScheduledStationAETitle": "scheduled_station_ae_title",  # AE
+    "ScheduledProcedureStepStartDate": "scheduled_procedure_step_start_date",  # DA
+    "ScheduledProcedureStepStartTime": "scheduled_procedure_step_start_time",  # TM
+    "Modality": "modality",  # CS
+}
+
+# The keys that support range matching
+_RANGE_KEYWORDS = {"ScheduledProcedureStepStartDate", "ScheduledProcedureStepStartTime"}
+
+# The keys with an in-memory inverted index, the date key supports ranges
+_INDEXED_KEYWORDS = (
+    "ScheduledStationAETitle",
+    "ScheduledProcedureStepStartDate",
+    "Modality",
+)
+
+# The number of candidate rows read from the database per statement
+_CHUNK_SIZE = 500
+
+
+class WorklistItem(Base):
+    __tablename__ = "worklist_item"
+
+    id = Column(Integer, primary_key=True)
+
+    # (0008,0050) Accession Number | VR SH, VM 1
+    accession_number = Column(String(16), nullable=False, default="")
+    # (0040,1001) Requested Procedure ID | VR SH, VM 1
+    requested_procedure_id = Column(String(16), nullable=False, default="")
+    # (0010,0020) Patient ID | VR LO, VM 1
+    patient_id = Column(String(64))
+    # (0010,0010) Patient's Name | VR PN, VM 1
+    patient_name = Column(String(324))
+
+    # Scheduled Procedure Step Sequence item
+    # (0040,0009) Scheduled Procedure Step ID | VR SH, VM 1
+    scheduled_procedure_step_id = Column(String(16), nullable=False, default="")
+    # (0040,0001) Scheduled Station AE Title | VR AE, VM 1-n
+    scheduled_station_ae_title = Column(String(16))
+    # (0040,0002) Scheduled Procedure Step Start Date | VR DA, VM 1
+    scheduled_procedure_step_start_date = Column(String(8))
+    # (0040,0003) Scheduled Procedure Step Start Time | VR TM, VM 1
+    scheduled_procedure_step_start_time = Column(String(14))
+    # (0008,0060) Modality | VR CS, VM 1
+    modality = Column(String(16))
+
+    # The worklist item as DICOM JSON, with only this step in the sequence
+    dataset = Column(Text, nullable=False)
+
+    # The change sequence number of the row's last update
+    seq = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index(
+            "ix_worklist_item_key",
+            "accession_number",
+            "requested_procedure_id",
+            "scheduled_procedure_step_id",
+            unique=True,
+        ),
+        # A modality polling for its own worklist for the day
+        Index(
+            "ix_worklist_item_station_date",
+            "scheduled_station_ae_title",
+            "scheduled_procedure_step_start_date",
+        ),
+        Index(
+            "ix_worklist_item_start_date", "scheduled_procedure_step_start_date"
+        ),
+        Index("ix_worklist_item_modality", "modality"),
+        Index("ix_worklist_item_patient_id", "patient_id"),
+        # Listing the changes since a sequence number
+        Index("ix_worklist_item_seq", "seq"),
+    )
+
+
+class WorklistDeletion(Base):
+    """A removed Scheduled Procedure Step, kept for the clients syncing."""
+
+    __tablename__ = "worklist_deletion"
+
+    accession_number = Column(String(16), primary_key=True)
+    requested_procedure_id = Column(String(16), primary_key=True)
+    scheduled_procedure_step_id = Column(String(16), primary_key=True)
+
+    # The change sequence number of the removal
+    seq = Column(Integer, nullable=False)
+
+    __table_args__ = (Index("ix_worklist_deletion_seq", "seq"),)
+
+
+# The columns that key a Scheduled Procedure Step
+_KEY_COLUMNS = (
+    "accession_number",
+    "requested_procedure_id",
+    "scheduled_procedure_step_id",
+)
+
+
+# The columns for the keys with an in-memory index
+_INDEX_COLUMNS = [
+    getattr(WorklistItem, _STEP_COLUMNS[keyword]) for keyword in _INDEXED_KEYWORDS
+]
+
+
+def _set_pragmas(dbapi_connection, connection_record):
+    """Use WAL so C-FIND reads aren't blocked while orders are written."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def _value(ds, keyword):
+    """Return the value of `keyword` in `ds` as a :class:`str` or ``None``."""
+    value = ds.get(keyword)
+    if value is None or value == "":
+        return None
+
+    # AE and CS may be multi-valued, only the first value is indexed
+    if isinstance(value, MultiValue):
+        value = value[0] if value else None
+
+    return None if value is None else str(value)
+
+
+# The VRs whose DICOM JSON values are the element's string values
+_STRING_VRS = {
+    "AE", "AS", "CS", "DA", "DT", "LO", "LT", "SH", "ST", "TM", "UC", "UI", "UR", "UT"
+}
+
+# The DICOM JSON key for the Scheduled Procedure Step Sequence
+_STEPS_TAG = "00400100"
+
+
+def _json_dict(ds):
+    """Return `ds` in the DICOM JSON model (Part 18, Annex F).
+
+    The same as :meth:`~pydicom.dataset.Dataset.to_json_dict` for the string,
+    PN and SQ elements of a worklist item, but without its per-element
+    overhead, which dominates the cost of storing an order. Any other
+    elements are converted by pydicom.
+    """
+    json_dict = {}
+    for elem in ds.values():
+        if not isinstance(elem, DataElement):
+            # Only a raw element read from a file needs converting
+            elem = ds[elem.tag]
+
+        key = f"{elem.tag:08X}"
+        VR = elem.VR
+        value = elem.value
+        if VR in _STRING_VRS:
+            if value is None or value == "":
+                json_dict[key] = {"vr": VR}
+            elif isinstance(value, str):
+                json_dict[key] = {"vr": VR, "Value": [value]}
+            elif isinstance(value, MultiValue):
+                json_dict[key] = {
+                    "vr": VR,
+                    "Value": [str(v) for v in value],
+                }
+            else:
+                json_dict[key] = {"vr": VR, "Value": [str(value)]}
+        elif VR == "PN" and value:
+            names = value if isinstance(value, MultiValue) else [value]
+            json_dict[key] = {
+                "vr": VR,
+                "Value": [_person_name(name) for name in names],
+            }
+        elif VR == "SQ":
+            json_dict[key] = {
+                "vr": VR,
+                "Value": [_json_dict(item) for item in value],
+            }
+        else:
+            json_dict[key] = elem.to_json_dict(None, 1024)
+
+    return json_dict
+
+
+def _person_name(name):
+    """Return the DICOM JSON value for a PN `name`."""
+    components = getattr(name, "components", None) or str(name).split("=")
+    value = {"Alphabetic": components[0]}
+    if len(components) > 1:
+        value["Ideographic"] = components[1]
+    if len(components) > 2:
+        value["Phonetic"] = components[2]
+
+    return value
+
+
+def _rows(ds):
+    """Return the table rows for the worklist item `ds`, one per step.
+
+    Parameters
+    ----------
+    ds : pydicom.dataset.Dataset
+        The worklist item.
+
+    Returns
+    -------
+    list of dict
+        The column values for each Scheduled Procedure Step.
+    """
+    steps = ds.get("ScheduledProcedureStepSequence") or [Dataset()]
+    item = {attr: _value(ds, kw) for kw, attr in _ITEM_COLUMNS.items()}
+    item["accession_number"] = item["accession_number"] or ""
+    item["requested_procedure_id"] = item["requested_procedure_id"] or ""
+
+    # The item is encoded once and each step's JSON is added to a copy
+    item_json = _json_dict(ds)
+    item_json.pop(_STEPS_TAG, None)
+
+    rows = []
+    for index, step in enumerate(steps, start=1):
+        row = dict(item)
+        row.update({attr: _value(step, kw) for kw, attr in _STEP_COLUMNS.items()})
+        # Steps without an ID are keyed on their position in the sequence
+        row["scheduled_procedure_step_id"] = (
+            row["scheduled_procedure_step_id"] or str(index)
+        )
+
+        single = dict(item_json)
+        single[_STEPS_TAG] = {"vr": "SQ", "Value": [_json_dict(step)]}
+        row["dataset"] = json.dumps(single)
+        rows.append(row)
+
+    return rows
+
+
+def _criterion(column, elem):
+    """Return the filter on `column` for the key `elem` or ``None``.
+
+    Supports single value, wildcard and universal matching for all keys and
+    range matching for the date and time keys. Values are matched
+    case-sensitively (Part 4, C.2.2.2.4), except PN values which are matched
+    case-insensitively (ASCII only) by both single value and wildcard
+    matching.
+    """
+    value = elem.value
+    if value is None or value == "":
+        # Universal matching
+        return None
+
+    if isinstance(value, MultiValue):
+        value = value[0]
+
+    value = str(value)
+    if elem.keyword in _RANGE_KEYWORDS and "-" in value:
+        start, end = value.split("-", 1)
+        if start and end:
+            return column.between(start, end)
+
+        return column >= start if start else column <= end
+
+    if elem.VR == "PN":
+        # LIKE is case-insensitive, a single value is a pattern without
+        #   wildcards so both are matched the same way
+        pattern = (
+            value.replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_")
+            .replace("*", "%")
+            .replace("?", "_")
+        )
+        return column.like(pattern, escape="\\")
+
+    if "*" in value or "?" in value:
+        # GLOB is case-sensitive and uses the same wildcards, but '[' starts
+        #   a character class
+        return column.op("GLOB")(value.replace("[", "[[]"))
+
+    return column == value
+
+
+def _shape(identifier):
+    """Return the keys requested by `identifier`, which decide the response.
+
+    Only the keys and their VRs are used, the values only affect which
+    items match.
+    """
+    shape = []
+    for elem in identifier:
+        if elem.keyword == "ScheduledProcedureStepSequence":
+            step = elem.value[0] if elem.value else None
+            shape.append(
+                (
+                    elem.tag,
+                    elem.VR,
+                    None if step is None else tuple((e.tag, e.VR) for e in step),
+                )
+            )
+        else:
+            shape.append((elem.tag, elem.VR))
+
+    return tuple(shape)
+
+
+def _response(identifier, item):
+    """Return the C-FIND response for a matching worklist `item`.
+
+    The response has the same keys as the request's `identifier`, with the
+    values from `item`, including the keys in the *Scheduled Procedure Step
+    Sequence* item.
+    """
+    response = Dataset()
+    for elem in identifier:
+        keyword = elem.keyword
+        if keyword == "ScheduledProcedureStepSequence":
+            step = item.ScheduledProcedureStepSequence[0]
+            response_step = Dataset()
+            for step_elem in elem.value[0] if elem.value else step:
+                response_step.add(
+                    step[step_elem.tag]
+                    if step_elem.tag in step
+                    else DataElement(step_elem.tag, step_elem.VR, None)
+                )
+            response.ScheduledProcedureStepSequence = [response_step]
+        elif elem.tag in item:
+            response.add(item[elem.tag])
+        else:
+            response.add(DataElement(elem.tag, elem.VR, None))
+
+    return response
+
+
+def _encode(ds, is_implicit_VR, is_little_endian):
+    """Return `ds` with its elements encoded.
+
+    The returned dataset's elements are raw elements in the given encoding,
+    which are written as they are when pynetdicom encodes the response, so
+    sending it doesn't convert or encode any values.
+    """
+    fp = DicomBytesIO()
+    fp.is_implicit_VR = is_implicit_VR
+    fp.is_little_endian = is_little_endian
+    write_dataset(fp, ds)
+
+    return read_dataset(BytesIO(fp.getvalue()), is_implicit_VR, is_little_endian)
+
+
+def _copy(ds):
+    """Return a new dataset with the raw elements of a dataset from
+    :func:`_encode`.
+
+    Accessing an element of a dataset converts its raw element in place, as
+    pynetdicom does when logging a response, so each response gets its own
+    dataset and the cached one is only read with :meth:`Dataset.get_item`,
+    keeping it encoded and safe to share between associations.
+    """
+    copy = Dataset({tag: ds.get_item(tag) for tag in ds.keys()})
+    copy.set_original_encoding(
+        ds.read_implicit_vr, ds.read_little_endian, ds.read_encoding
+    )
+
+    return copy
+
+
+class ResponseCache:
+    """A least recently used cache of the encoded C-FIND responses.
+
+    Responses are keyed on ``(row ID, requested keys, encoding)``.
+    Invalidating a row drops all its responses and increments the
+    :attr:`generation`, and a response is only added if no row has been
+    invalidated since its row was read, so a search that read an item before
+    it was updated can't add the outdated response afterwards.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        The number of responses kept (default ``10000``), ``0`` to disable
+        the cache.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._responses = OrderedDict()
+        # {row ID: set of the keys of its responses}
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._responses)
+
+    def get(self, key):
+        """Return the cached response for `key` or ``None``."""
+        with self._lock:
+            response = self._responses.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+
+            self._responses.move_to_end(key)
+            self.hits += 1
+
+            return response
+
+    def put(self, key, response, generation):
+        """Add a response, unless a row was invalidated after `generation`.
+
+        Parameters
+        ----------
+        key : tuple
+            The response's ``(row ID, requested keys, encoding)``.
+        response : pydicom.dataset.Dataset
+            The encoded response.
+        generation : int
+            The value of :attr:`generation` before the row was read.
+        """
+        with self._lock:
+            if generation != self.generation or not self.capacity:
+                return
+
+            self._responses[key] = response
+            self._responses.move_to_end(key)
+            self._keys.setdefault(key[0], set()).add(key)
+            while len(self._responses) > self.capacity:
+                oldest, _ = self._responses.popitem(last=False)
+                keys = self._keys[oldest[0]]
+                keys.discard(oldest)
+                if not keys:
+                    del self._keys[oldest[0]]
+
+    def invalidate(self, row_ids):
+        """Drop the responses for the rows with `row_ids`."""
+        with self._lock:
+            self.generation += 1
+            for row_id in row_ids:
+                for key in self._keys.pop(row_id, ()):
+                    del self._responses[key]
+
+    def info(self):
+        """Return the cache's size and the number of hits and misses."""
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "size": len(self._responses),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class WorklistIndex:
+    """In-memory inverted indexes of the worklist steps.
+
+    For each of the keywords in ``_INDEXED_KEYWORDS`` the index maps each
+    value to the set of row IDs with that value, its posting list. The
+    distinct start dates are also kept sorted so a date range only needs the
+    posting lists for the dates in the range.
+    """
+
+    def __init__(self):
+        # {keyword: {value: set of row IDs}}
+        self._postings = {keyword: {} for keyword in _INDEXED_KEYWORDS}
+        # {row ID: tuple of the indexed values}
+        self._values = {}
+        # The distinct start dates in increasing order
+        self._dates = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, row_id, values):
+        """Add or update the indexed `values` for a row.
+
+        Parameters
+        ----------
+        row_id : int
+            The row's ID.
+        values : sequence of str or None
+            The row's value for each of the keywords in
+            ``_INDEXED_KEYWORDS``, ``None`` if it has no value.
+        """
+        values = tuple(values)
+        with self._lock:
+            if self._values.get(row_id) == values:
+                return
+
+            self._discard(row_id)
+            self._values[row_id] = values
+            for keyword, value in zip(_INDEXED_KEYWORDS, values):
+                if value is None:
+                    continue
+
+                postings = self._postings[keyword]
+                if value not in postings:
+                    postings[value] = set()
+                    if keyword == "ScheduledProcedureStepStartDate":
+                        insort(self._dates, value)
+
+                postings[value].add(row_id)
+
+    def remove(self, row_id):
+        """Remove a row from the index."""
+        with self._lock:
+            self._discard(row_id)
+
+    def _discard(self, row_id):
+        """Remove a row, must be called with the lock held."""
+        values = self._values.pop(row_id, None)
+        if values is None:
+            return
+
+        for keyword, value in zip(_INDEXED_KEYWORDS, values):
+            if value is None:
+                continue
+
+            postings = self._postings[keyword]
+            postings[value].discard(row_id)
+            if not postings[value]:
+                del postings[value]
+                if keyword == "ScheduledProcedureStepStartDate":
+                    del self._dates[bisect_left(self._dates, value)]
+
+    def _posting_lists(self, keyword, value):
+        """Return the posting lists matching `value` for `keyword`.
+
+        Returns
+        -------
+        list of set or None
+            The posting lists whose union is the matching rows, or ``None``
+            if the index can't be used for the matching, such as for
+            universal or wildcard matching.
+        """
+        if not value or "*" in value or "?" in value:
+            return None
+
+        postings = self._postings[keyword]
+        if keyword == "ScheduledProcedureStepStartDate" and "-" in value:
+            start, end = value.split("-", 1)
+            first = bisect_left(self._dates, start) if start else 0
+            last = bisect_right(self._dates, end) if end else len(self._dates)
+            return [postings[date] for date in self._dates[first:last]]
+
+        matches = postings.get(value)
+        return [matches] if matches else []
+
+    def candidates(self, values):
+        """Return the IDs of the rows that match the indexed keys.
+
+        The posting lists for the key with the fewest matches are used first
+        and each of the others only has to be checked for those rows, so the
+        cost is proportional to the smallest posting list rather than to
+        the size of the worklist.
+
+        Parameters
+        ----------
+        values : dict
+            The query value for each keyword, as ``{keyword: str}``.
+
+        Returns
+        -------
+        set of int or None, set of str
+            The IDs of the matching rows, or ``None`` if none of the keys
+            could use the index, and the keywords the index matched.
+        """
+        with self._lock:
+            lists = []
+            for keyword in _INDEXED_KEYWORDS:
+                if keyword in values:
+                    matching = self._posting_lists(keyword, values[keyword])
+                    if matching is not None:
+                        lists.append(
+                            (sum(len(ids) for ids in matching), keyword, matching)
+                        )
+
+            if not lists:
+                return None, set()
+
+            lists.sort(key=lambda item: item[0])
+            _, _, smallest = lists[0]
+            row_ids = set().union(*smallest)
+            for _, _, matching in lists[1:]:
+                if not row_ids:
+                    break
+
+                if len(matching) == 1:
+                    row_ids &= matching[0]
+                else:
+                    row_ids = {
+                        row_id
+                        for row_id in row_ids
+                        if any(row_id in ids for ids in matching)
+                    }
+
+            return row_ids, {keyword for _, keyword, _ in lists}
+
+
+class WorklistStore:
+    """The Modality Worklist, kept in a SQLite database.
+
+    Parameters
+    ----------
+    db_location : str
+        The path to the SQLite database, created if it doesn't exist.
+    echo : bool, optional
+        Turn the sqlalchemy logging on (default ``False``).
+    response_cache_size : int, optional
+        The number of encoded C-FIND responses cached (default ``10000``),
+        ``0`` to disable the cache.
+    """
+
+    def __init__(self, db_location, echo=False, response_cache_size=10000):
+        self.engine = create_engine(f"sqlite:///{db_location}", echo=echo)
+        event.listen(self.engine, "connect", _set_pragmas)
+        # Create the table (won't recreate a table already present)
+        Base.metadata.create_all(self.engine)
+        self._migrate()
+        self.Session = sessionmaker(bind=self.engine)
+        self.index = WorklistIndex()
+        self.response_cache = ResponseCache(response_cache_size)
+        # SQLite has a single writer, so concurrent writers queue on the lock
+        #   rather than retrying on a busy database
+        self._write_lock = threading.Lock()
+        self._load_index()
+        # The last change sequence number, only updated once the change is
+        #   committed
+        self.seq = self._last_seq()
+
+    def _migrate(self):
+        """Add the change sequence numbers to a database from before them.
+
+        The existing rows are numbered in the order they were added.
+        """
+        columns = inspect(self.engine).get_columns(WorklistItem.__tablename__)
+        if any(column["name"] == "seq" for column in columns):
+            return
+
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "ALTER TABLE worklist_item "
+                    "ADD COLUMN seq INTEGER NOT NULL DEFAULT 0"
+                )
+            )
+            conn.execute(text("UPDATE worklist_item SET seq = id"))
+            for index in WorklistItem.__table__.indexes:
+                if index.name == "ix_worklist_item_seq":
+                    index.create(conn)
+
+    def _last_seq(self):
+        """Return the last change sequence number in the database."""
+        with self.Session() as session:
+            return max(
+                session.scalar(select(func.max(WorklistItem.seq))) or 0,
+                session.scalar(select(func.max(WorklistDeletion.seq))) or 0,
+            )
+
+    def _load_index(self):
+        """Build the in-memory index from the rows in the database."""
+        with self.engine.connect() as conn:
+            statement = select(WorklistItem.id, *_INDEX_COLUMNS)
+            for row_id, *values in conn.execute(statement):
+                self.index.add(row_id, values)
+
+    def add(self, ds):
+        """Add a worklist item, replacing any with the same key.
+
+        Parameters
+        ----------
+        ds : pydicom.dataset.Dataset
+            The worklist item.
+
+        Returns
+        -------
+        int
+            The number of Scheduled Procedure Steps added or updated.
+        """
+        return self.add_many([ds])
+
+    def add_many(self, datasets):
+        """Add worklist items in a single transaction.
+
+        Either all the items are added or, if the transaction fails, none
+        of them are.
+
+        Parameters
+        ----------
+        datasets : sequence of pydicom.dataset.Dataset
+            The worklist items, each replaces any with the same key.
+
+        Returns
+        -------
+        int
+            The number of Scheduled Procedure Steps added or updated.
+        """
+        rows = [row for ds in datasets for row in _rows(ds)]
+        if not rows:
+            return 0
+
+        accession_numbers = list({row["accession_number"] for row in rows})
+        with self._write_lock:
+            for seq, row in enumerate(rows, start=self.seq + 1):
+                row["seq"] = seq
+
+            with self.engine.begin() as conn:
+                self._upsert(conn, rows)
+                self._undelete(conn, rows)
+                indexed = []
+                for index in range(0, len(accession_numbers), _CHUNK_SIZE):
+                    indexed.extend(
+                        self._indexed_rows(
+                            conn, accession_numbers[index : index + _CHUNK_SIZE]
+                        )
+                    )
+
+            # Only once the rows are committed, so the index never has rows
+            #   a reader can't see, and before the next write so the index
+            #   is updated in the same order as the table
+            for row_id, *values in indexed:
+                self.index.add(row_id, values)
+
+            self.response_cache.invalidate([row_id for row_id, *_ in indexed])
+            self.seq += len(rows)
+
+        return len(rows)
+
+    def _indexed_rows(self, conn, accession_numbers):
+        """Return the ID and indexed values of the rows for the orders."""
+        statement = select(WorklistItem.id, *_INDEX_COLUMNS).where(
+            WorklistItem.accession_number.in_(
+                [str(value) for value in accession_numbers]
+            )
+        )
+
+        return conn.execute(statement).all()
+
+    def _upsert(self, conn, rows):
+        statement = insert(WorklistItem)
+        statement = statement.on_conflict_do_update(
+            index_elements=[
+                "accession_number",
+                "requested_procedure_id",
+                "scheduled_procedure_step_id",
+            ],
+            set_={
+                column: statement.excluded[column]
+                for column in (
+                    *_ITEM_COLUMNS.values(),
+                    *_STEP_COLUMNS.values(),
+                    "dataset",
+                    "seq",
+                )
+            },
+        )
+        conn.execute(statement, rows)
+
+    def _undelete(self, conn, rows):
+        """Remove the deletions of the steps in `rows` that are added again."""
+        # Most imports don't re-add removed steps
+        if conn.scalar(select(WorklistDeletion.seq).limit(1)) is None:
+            return
+
+        statement = delete(WorklistDeletion).where(
+            *(
+                getattr(WorklistDeletion, column) == bindparam(f"key_{column}")
+                for column in _KEY_COLUMNS
+            )
+        )
+        conn.execute(
+            statement,
+            [{f"key_{column}": row[column] for column in _KEY_COLUMNS} for row in rows],
+        )
+
+    def remove(self, accession_number):
+        """Remove all the steps for an order.
+
+        Parameters
+        ----------
+        accession_number : str
+            The order's *Accession Number*.
+
+        Returns
+        -------
+        int
+            The number of Scheduled Procedure Steps removed.
+        """
+        criterion = WorklistItem.accession_number == accession_number
+        keys = select(
+            WorklistItem.id, *(getattr(WorklistItem, column) for column in _KEY_COLUMNS)
+        ).where(criterion)
+        with self._write_lock:
+            with self.engine.begin() as conn:
+                removed = conn.execute(keys).all()
+                if removed:
+                    conn.execute(delete(WorklistItem).where(criterion))
+                    deletions = [
+                        dict(zip(_KEY_COLUMNS, key), seq=seq)
+                        for seq, (_, *key) in enumerate(removed, start=self.seq + 1)
+                    ]
+                    statement = insert(WorklistDeletion)
+                    statement = statement.on_conflict_do_update(
+                        index_elements=list(_KEY_COLUMNS),
+                        set_={"seq": statement.excluded.seq},
+                    )
+                    conn.execute(statement, deletions)
+
+            for row_id, *_ in removed:
+                self.index.remove(row_id)
+
+            self.response_cache.invalidate([row_id for row_id, *_ in removed])
+            self.seq += len(removed)
+
+        return len(removed)
+
+    def changes(self, since=None, limit=None):
+        """Return the changes to the worklist after a sequence number.
+
+        Parameters
+        ----------
+        since : int or None, optional
+            The sequence number the client has synced up to, or ``None``
+            (default) for all the steps in the worklist. A number later
+            than the last change, such as one from before the database was
+            replaced, is treated as ``None``.
+        limit : int or None, optional
+            The most changes to return (default no limit). If there are more
+            then the returned sequence number is that of the last change
+            returned, so the rest are returned by asking again from it.
+
+        Returns
+        -------
+        dict
+            With the keys:
+
+            * ``"seq"``: the sequence number the changes bring the client
+              up to
+            * ``"full"``: ``True`` if the changes are all the steps in the
+              worklist rather than those since `since`
+            * ``"more"``: ``True`` if `limit` left out some changes
+            * ``"items"``: the ``(seq, dataset)`` of each added or updated
+              step, the dataset as DICOM JSON text
+            * ``"deleted"``: the ``(seq, accession_number,
+              requested_procedure_id, scheduled_procedure_step_id)`` of each
+              removed step
+
+            The changes are ordered by sequence number.
+        """
+        # Changes committed after this aren't returned, so none are missed
+        #   or returned twice
+        last = self.seq
+        if since is not None and since > last:
+            since = None
+
+        changes = {
+            "seq": last,
+            "full": since is None,
+            "more": False,
+            "items": [],
+            "deleted": [],
+        }
+        if since == last:
+            # The client is up to date
+            return changes
+
+        items = (
+            select(WorklistItem.seq, WorklistItem.dataset)
+            .where(WorklistItem.seq <= last)
+            .order_by(WorklistItem.seq)
+        )
+        deleted = (
+            select(
+                WorklistDeletion.seq,
+                *(getattr(WorklistDeletion, column) for column in _KEY_COLUMNS),
+            )
+            .where(WorklistDeletion.seq <= last, WorklistDeletion.seq > (since or 0))
+            .order_by(WorklistDeletion.seq)
+        )
+        if since is not None:
+            items = items.where(WorklistItem.seq > since)
+
+        if limit is not None:
+            items = items.limit(limit + 1)
+            deleted = deleted.limit(limit + 1)
+
+        with self.Session() as session:
+            changes["items"] = [tuple(row) for row in session.execute(items)]
+            if since is not None:
+                changes["deleted"] = [tuple(row) for row in session.execute(deleted)]
+
+        count = len(changes["items"]) + len(changes["deleted"])
+        if limit is not None and count > limit:
+            # Keep the first `limit` changes of the two lists
+            seqs = sorted(
+                [seq for seq, *_ in changes["items"]]
+                + [seq for seq, *_ in changes["deleted"]]
+            )
+            changes["seq"] = seqs[limit - 1]
+            changes["more"] = True
+            for key in ("items", "deleted"):
+                changes[key] = [
+                    change for change in changes[key] if change[0] <= changes["seq"]
+                ]
+
+        return changes
+
+    def count(self):
+        """Return the number of Scheduled Procedure Steps in the worklist."""
+        with self.Session() as session:
+            return session.scalar(select(func.count()).select_from(WorklistItem))
+
+    def search(self, identifier):
+        """Return the worklist items that match a C-FIND *Identifier*.
+
+        Only the keys with a column are matched on, the others are return
+        keys. The keys in the *Scheduled Procedure Step Sequence* are
+        matched against each step separately.
+
+        Parameters
+        ----------
+        identifier : pydicom.dataset.Dataset
+            The C-FIND request's *Identifier*.
+
+        Returns
+        -------
+        list of pydicom.dataset.Dataset
+            The matching worklist items, each with the matching step as the
+            only item in its *Scheduled Procedure Step Sequence*.
+        """
+        rows = self._matching(identifier, WorklistItem.dataset)
+
+        return [Dataset.from_json(dataset) for _, dataset in rows]
+
+    def find(self, identifier, transfer_syntax):
+        """Return the C-FIND responses for the items matching *Identifier*.
+
+        The responses are from the cache when possible, only the items
+        without a cached response for the requested keys and transfer
+        syntax are read and their responses built and encoded.
+
+        Parameters
+        ----------
+        identifier : pydicom.dataset.Dataset
+            The C-FIND request's *Identifier*.
+        transfer_syntax : pydicom.uid.UID
+            The transfer syntax the responses will be sent with.
+
+        Returns
+        -------
+        list of pydicom.dataset.Dataset
+            The responses, with the requested keys of each matching step,
+            already encoded for `transfer_syntax`. Each is a new dataset,
+            so it can be changed without affecting the cache.
+        """
+        shape = _shape(identifier)
+        encoding = (transfer_syntax.is_implicit_VR, transfer_syntax.is_little_endian)
+        generation = self.response_cache.generation
+        row_ids = [row_id for row_id, in self._matching(identifier)]
+
+        responses = {}
+        missing = []
+        for row_id in row_ids:
+            response = self.response_cache.get((row_id, shape, encoding))
+            if response is None:
+                missing.append(row_id)
+            else:
+                responses[row_id] = _copy(response)
+
+        for row_id, dataset in self._datasets(missing):
+            response = _encode(
+                _response(identifier, Dataset.from_json(dataset)), *encoding
+            )
+            self.response_cache.put((row_id, shape, encoding), response, generation)
+            responses[row_id] = _copy(response)
+
+        # A row removed since it was matched has no response
+        return [responses[row_id] for row_id in row_ids if row_id in responses]
+
+    def _datasets(self, row_ids):
+        """Return the ID and DICOM JSON of the rows with `row_ids`."""
+        statement = select(WorklistItem.id, WorklistItem.dataset)
+        rows = []
+        with self.Session() as session:
+            for index in range(0, len(row_ids), _CHUNK_SIZE):
+                chunk = row_ids[index : index + _CHUNK_SIZE]
+                rows.extend(
+                    session.execute(statement.where(WorklistItem.id.in_(chunk)))
+                )
+
+        return rows
+
+    def _matching(self, identifier, *columns):
+        """Return the rows that match a C-FIND *Identifier*.
+
+        Parameters
+        ----------
+        identifier : pydicom.dataset.Dataset
+            The C-FIND request's *Identifier*.
+        *columns
+            The columns to return after the row ID.
+
+        Returns
+        -------
+        list of tuple
+            The ID and `columns` of each matching row, ordered by ID.
+        """
+        keys = {}
+        for keyword in _ITEM_COLUMNS:
+            if keyword in identifier:
+                keys[keyword] = identifier[keyword]
+
+        steps = identifier.get("ScheduledProcedureStepSequence")
+        if steps:
+            for keyword in _STEP_COLUMNS:
+                if keyword in steps[0]:
+                    keys[keyword] = steps[0][keyword]
+
+        # Find the candidates for the indexed keys in memory first
+        values = {
+            keyword: _value(steps[0], keyword) or ""
+            for keyword in _INDEXED_KEYWORDS
+            if keyword in keys
+        }
+        row_ids, indexed = self.index.candidates(values)
+        if row_ids is not None and not row_ids:
+            return []
+
+        criteria = []
+        for keyword, elem in keys.items():
+            if keyword in indexed:
+                continue
+
+            attr = _ITEM_COLUMNS.get(keyword) or _STEP_COLUMNS[keyword]
+            criterion = _criterion(getattr(WorklistItem, attr), elem)
+            if criterion is not None:
+                criteria.append(criterion)
+
+        if row_ids is not None and not criteria and not columns:
+            # The index matched all the keys, the database isn't needed
+            return [(row_id,) for row_id in sorted(row_ids)]
+
+        statement = select(WorklistItem.id, *columns).where(*criteria)
+        with self.Session() as session:
+            if row_ids is None:
+                rows = session.execute(statement).all()
+            else:
+                row_ids = sorted(row_ids)
+                rows = []
+                for index in range(0, len(row_ids), _CHUNK_SIZE):
+                    chunk = row_ids[index : index + _CHUNK_SIZE]
+                    rows.extend(
+                        session.execute(
+                            statement.where(WorklistItem.id.in_(chunk))
+                        ).all()
+                    )
+
+        rows.sort(key=lambda row: row[0])
+
+        return rows